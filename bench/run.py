@@ -0,0 +1,307 @@
+"""
+offline benchmarks of parsing and fan-out with recorded bilibili responses
+and a fake telegram bot, results are written as json so runs can be compared
+
+    cp config.example config.py
+    python -m bench.run --output before.json
+    # change something
+    python -m bench.run --output after.json --compare before.json
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from types import SimpleNamespace
+from typing import Callable, Dict, List
+
+import httpx
+import telegram
+
+from bilibili.api import Bilibili, parse_card
+from bilibili.model import Dynamic, DynamicType, LiveStatus
+
+FIXTURES = os.path.join(os.path.dirname(__file__), "fixtures")
+UID = 745493
+ROOM_ID = 12345
+
+
+def fixture(name: str) -> bytes:
+    with open(os.path.join(FIXTURES, name), "rb") as f:
+        return f.read()
+
+
+def percentile(values: List[float], p: float) -> float:
+    if len(values) == 0:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def summary(latencies: List[float]) -> Dict[str, float]:
+    """
+    p50/p99 in milliseconds
+    """
+    return {
+        "p50_ms": round(percentile(latencies, 0.5) * 1000, 4),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 4),
+    }
+
+
+def bench_parse_card(iterations: int) -> dict:
+    cards = json.loads(fixture("space_history.json"))["data"]["cards"]
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(iterations):
+        for c in cards:
+            t = time.perf_counter()
+            parse_card(c)
+            latencies.append(time.perf_counter() - t)
+    elapsed = time.perf_counter() - start
+    return {"cards": len(latencies), "cards_per_s": round(len(latencies) / elapsed), **summary(latencies)}
+
+
+def bilibili_transport() -> httpx.MockTransport:
+    """
+    replays the fixtures, live status flips on every request so every response is new
+    """
+    space_history = fixture("space_history.json")
+    room = json.loads(fixture("get_info_by_room.json"))
+    flip = [LiveStatus.LIVE, LiveStatus.PREPARE]
+    count = 0
+
+    def handle(request: httpx.Request) -> httpx.Response:
+        nonlocal count
+        path = request.url.path
+        if path.endswith("/space_history"):
+            return httpx.Response(200, content=space_history)
+        if path.startswith("/bili/living_v2/"):
+            return httpx.Response(200, json={"code": 0, "data": {"url": f"https://live.bilibili.com/{ROOM_ID}"}})
+        if path.endswith("/getInfoByRoom"):
+            count += 1
+            room["data"]["room_info"]["live_status"] = flip[count % 2]
+            return httpx.Response(200, json=room)
+        return httpx.Response(404)
+
+    return httpx.MockTransport(handle)
+
+
+async def timed(n: int, call: Callable) -> List[float]:
+    latencies = []
+    for _ in range(n):
+        t = time.perf_counter()
+        await call()
+        latencies.append(time.perf_counter() - t)
+    return latencies
+
+
+async def bench_fetch(iterations: int) -> dict:
+    fetcher = Bilibili(transport=bilibili_transport())
+    cards = json.loads(fixture("space_history.json"))["data"]["cards"]
+    ids = [c["desc"]["dynamic_id"] for c in cards]
+    result = {}
+    try:
+        # everything is new and parsed
+        latencies = await timed(iterations, lambda: fetcher.fetch(UID, min(ids) - 1, limit=len(ids)))
+        elapsed = sum(latencies)
+        result["new"] = {"fetch_per_s": round(iterations / elapsed), "cards_per_s": round(iterations * len(ids) / elapsed),
+                         **summary(latencies)}
+        # nothing is new, the body is not parsed
+        latencies = await timed(iterations, lambda: fetcher.fetch(UID, max(ids)))
+        result["unchanged"] = {"fetch_per_s": round(iterations / sum(latencies)), **summary(latencies)}
+    finally:
+        await fetcher.close()
+    return result
+
+
+async def bench_live(iterations: int) -> dict:
+    fetcher = Bilibili(transport=bilibili_transport())
+    try:
+        latencies = await timed(iterations, lambda: fetcher.live(UID, LiveStatus.DISABLED))
+    finally:
+        await fetcher.close()
+    return {"live_per_s": round(iterations / sum(latencies)), **summary(latencies)}
+
+
+class FakeBot:
+    """
+    answers like the bot api after a random latency, and with flood control now and then
+    """
+
+    def __init__(self, latency: float, flood_rate: float, retry_after: int):
+        self.__latency = latency
+        self.__flood_rate = flood_rate
+        self.__retry_after = retry_after
+        self.__file_ids = 0
+        self.calls = 0
+        self.floods = 0
+        # chat_id -> when its last message is sent
+        self.done: Dict[int, float] = {}
+
+    def __message(self):
+        self.__file_ids += 1
+        photo = [SimpleNamespace(file_id=f"file_{self.__file_ids}")]
+        return SimpleNamespace(photo=photo, animation=None, document=None)
+
+    async def __call(self, chat_id: int):
+        await asyncio.sleep(random.expovariate(1 / self.__latency) if self.__latency > 0 else 0)
+        if random.random() < self.__flood_rate:
+            self.floods += 1
+            raise telegram.error.RetryAfter(self.__retry_after)
+        self.calls += 1
+        self.done[chat_id] = time.perf_counter()
+
+    async def send_message(self, chat_id, text, reply_markup=None, **kwargs):
+        await self.__call(chat_id)
+        return self.__message()
+
+    async def send_photo(self, chat_id, photo, caption=None, reply_markup=None, **kwargs):
+        await self.__call(chat_id)
+        return self.__message()
+
+    async def send_animation(self, chat_id, animation, caption=None, reply_markup=None, **kwargs):
+        await self.__call(chat_id)
+        return self.__message()
+
+    async def send_media_group(self, chat_id, media, **kwargs):
+        await self.__call(chat_id)
+        return [self.__message() for _ in media]
+
+
+async def bench_fan_out(chats: int, dyns: List[Dynamic], args) -> dict:
+    # send_to_all works on the globals which are set up in `main`
+    import main
+    from db import open_database
+    from media import MediaCache
+    from outbox import Outbox
+    from sender import Sender
+
+    with tempfile.TemporaryDirectory() as path:
+        db = open_database("json", os.path.join(path, "data.json"), default_uids=[UID])
+        for chat_id in range(1, chats + 1):
+            db.add_subscribe(chat_id, [UID])
+        bot = FakeBot(args.latency / 1000, args.flood_rate, args.retry_after)
+        sender = Sender(global_rate=args.global_rate, private_rate=args.chat_rate, workers=args.workers)
+        main.db = db
+        main.shard = None
+        main.sender = sender
+        main.media = MediaCache()
+        main.application = SimpleNamespace(bot=bot)
+        main.outbox = Outbox(db, sender, main.send_payloads, lambda chat_id: db.del_subscribe(chat_id))
+        sender.start()
+        tracemalloc.start()
+        start = time.perf_counter()
+        try:
+            for d in dyns:
+                await main.send_to_all(UID, d=d)
+            elapsed = time.perf_counter() - start
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+            await sender.stop()
+            db.close()
+    latencies = [t - start for t in bot.done.values()]
+    return {
+        "chats": chats,
+        "dynamics": len(dyns),
+        "elapsed_s": round(elapsed, 3),
+        "sends_per_s": round(bot.calls / elapsed),
+        "flood_control": bot.floods,
+        "peak_memory_kb": round(peak / 1024),
+        "delivered_p50_ms": round(percentile(latencies, 0.5) * 1000, 1),
+        "delivered_p99_ms": round(percentile(latencies, 0.99) * 1000, 1),
+    }
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return ""
+
+
+def flatten(d: dict, prefix: str = "") -> Dict[str, float]:
+    out = {}
+    for k, v in d.items():
+        if isinstance(v, dict):
+            out.update(flatten(v, f"{prefix}{k}."))
+        elif isinstance(v, (int, float)):
+            out[f"{prefix}{k}"] = v
+    return out
+
+
+def compare(old: dict, new: dict):
+    old = flatten(old["results"])
+    new = flatten(new["results"])
+    width = max(len(k) for k in new)
+    for k, v in new.items():
+        if k not in old:
+            print(f"{k:<{width}} {v:>12}")
+            continue
+        change = "" if old[k] == 0 else f"{(v - old[k]) / old[k] * 100:+.1f}%"
+        print(f"{k:<{width}} {old[k]:>12} -> {v:>12} {change:>8}")
+
+
+async def run(args) -> dict:
+    results = {"parse_card": bench_parse_card(args.iterations)}
+    results["fetch"] = await bench_fetch(args.iterations // 10)
+    results["live"] = await bench_live(args.iterations // 10)
+    cards = json.loads(fixture("space_history.json"))["data"]["cards"]
+    dyns = [d for d in map(parse_card, cards) if d is not None]
+    # an album, a photo and a text message
+    dyns = [d for d in dyns if d.type in (DynamicType.PHOTO, DynamicType.VIDEO, DynamicType.PLAIN)]
+    results["fan_out"] = {}
+    for chats in args.chats:
+        logging.warning(f"fan out to {chats} chats")
+        results["fan_out"][str(chats)] = await bench_fan_out(chats, dyns, args)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=20000, help="parse_card rounds, fetch and live do 1/10")
+    parser.add_argument("--chats", type=int, nargs="+", default=[10, 100, 1000, 10000])
+    parser.add_argument("--latency", type=float, default=50, help="mean bot api latency, unit ms")
+    parser.add_argument("--flood-rate", type=float, default=0.001, help="share of sends hit by flood control")
+    parser.add_argument("--retry-after", type=int, default=1, help="retry_after of flood control, unit second")
+    parser.add_argument("--global-rate", type=float, default=1000, help="sends per second of all chats")
+    parser.add_argument("--chat-rate", type=float, default=1, help="sends per second of a chat")
+    parser.add_argument("--workers", type=int, default=64, help="concurrent send workers")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write results to this json file")
+    parser.add_argument("--compare", help="compare with results of an earlier run")
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(asctime)s %(message)s", level=logging.WARNING)
+    random.seed(args.seed)
+    report = {
+        "meta": {
+            "time": time.strftime("%Y-%m-%d %H:%M:%S %z"),
+            "commit": git_commit(),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "args": {k: v for k, v in vars(args).items() if k not in ("output", "compare")},
+        },
+        "results": asyncio.run(run(args)),
+    }
+    print(json.dumps(report["results"], indent=2))
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.compare is not None:
+        with open(args.compare) as f:
+            old = json.load(f)
+        if old["meta"]["args"] != report["meta"]["args"]:
+            print("warning: the runs have different arguments")
+        compare(old, report)
+
+
+if __name__ == "__main__":
+    main()
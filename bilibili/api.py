@@ -1,194 +1,498 @@
-import datetime
-import json
-import logging
-
-from typing import List, Optional
-from urllib.error import HTTPError, URLError
-from urllib.request import build_opener, HTTPCookieProcessor, Request
-
-from utils import async_wrap
-from .model import Dynamic, DynamicType, Live, LiveStatus
-
-
-def parse_card(c) -> Optional[Dynamic]:
-    try:
-        card = json.loads(c["card"])
-    except json.JSONDecodeError:
-        logging.error(f"Malformed Bilibili dynamic card: {c}")
-        return None
-
-    dt = DynamicType.from_int(c["desc"]["type"])
-    did = c["desc"]["dynamic_id"]
-
-    if dt == DynamicType.FORWARD:
-        dyn = card["item"]
-        user = card["user"]["uname"]
-
-        origin_card = {
-            "desc": {
-                "type": dyn["orig_type"],
-                "dynamic_id": dyn["orig_dy_id"]
-            },
-            "card": card["origin"]
-        }
-        origin = parse_card(origin_card)
-        if origin is None:
-            return None
-
-        text = f'{dyn["content"]}\n------\nRT\n{origin.text}'
-        link = f"https://t.bilibili.com/{did}"
-        img = origin.photos
-        t = dyn["timestamp"]
-    elif dt == DynamicType.PHOTO:
-        dyn = card["item"]
-        user = card["user"]["name"]
-
-        text = dyn["description"]
-        link = f"https://t.bilibili.com/{did}"
-        img = [entry["img_src"] for entry in dyn["pictures"]]
-        t = dyn["upload_time"]
-    elif dt == DynamicType.PLAIN:
-        dyn = card["item"]
-        user = card["user"]["uname"]
-
-        text = dyn["content"]
-        link = f"https://t.bilibili.com/{did}"
-        img = []
-        t = dyn["timestamp"]
-    elif dt == DynamicType.VIDEO:
-        text = card["title"]
-        user = card["owner"]["name"]
-        link = f'https://www.bilibili.com/video/av{card["aid"]}'
-        img = [card["pic"]]
-        t = card["pubdate"]
-        if t == 0:
-            t = card["ctime"]
-    else:
-        return None
-
-    return Dynamic(user, dt, text, img, link, t)
-
-
-class Bilibili:
-    def __init__(self):
-        self.__disabled_until: Optional[datetime.datetime] = None
-        self.__uid_room_id = {}
-
-    async def request(self, url: str, payload: dict = None):
-        @async_wrap
-        def open_req(r):
-            if not hasattr(open_req, "_opener"):
-                open_req._opener = build_opener(HTTPCookieProcessor())
-                open_req._opener.addheaders.clear()
-                open_req._opener.addheaders.append(("User-Agent",
-                                                    "Dalvik/2.1.0 (Linux; U; Android 7.1.2; Test Build/Test)"))
-            opener = open_req._opener
-            return opener.open(r)
-
-        if payload is None:
-            data = None
-        else:
-            data = json.dumps(payload).encode()
-        req = Request(url, data=data, headers={"Content-Type": "application/json"})
-        return await open_req(req)
-
-    async def fetch(self, user_id: int, timestamp: int = 0) -> List[Dynamic]:
-        logging.debug(f"fetch for user {user_id}")
-        if self.__disabled_until:
-            logging.debug(f"throttled, skip fetch for user {user_id}")
-            if self.__disabled_until < datetime.datetime.now():
-                logging.info("Bilibili crawler resumed.")
-                self.__disabled_until = None
-            else:
-                return []
-
-        url = "https://api.vc.bilibili.com/dynamic_svr/v1/dynamic_svr/space_history"
-        payload = {
-            "visitor_uid": 0,
-            "host_uid": user_id,
-            "offset_dynamic_id": 0,
-            "need_top": 0
-        }
-        try:
-            resp = await self.request(url, payload)
-        except (HTTPError, URLError) as e:
-            logging.warning(f"request {url}: {e}")
-            return []
-        except Exception as e:
-            logging.error(f"request {url} got unknown exception: {e}")
-            return []
-        code = resp.getcode()
-        if code == -412:
-            logging.error("bilibili api throttled")
-            self.__disabled_until = datetime.datetime.now() + datetime.timedelta(minutes=30)
-            return []
-        resp = resp.read().decode()
-        resp = json.loads(resp)
-        cards = resp["data"]["cards"]
-
-        dyn_list = []
-
-        counter = 0
-
-        for c in cards:
-            dyn = parse_card(c)
-            if dyn is None:
-                continue
-            if dyn.timestamp <= timestamp:
-                break
-            dyn_list.append(dyn)
-            counter += 1
-            if counter == 6:
-                logging.info(f"total {len(cards)}, but only return 6")
-                break
-        return dyn_list
-
-    async def uid_to_room_id(self, uid) -> int:
-        url = f"http://api.live.bilibili.com/bili/living_v2/{uid}"
-        try:
-            resp = await self.request(url)
-        except (HTTPError, URLError) as e:
-            logging.warning(f"request {url}: {e}")
-            return 0
-        except Exception as e:
-            logging.error(f"request {url} got unknown exception: {e}")
-            return 0
-        resp = resp.read().decode()
-        data = json.loads(resp)["data"]
-        url = data["url"]
-        if len(url) == 0:
-            return 0
-        uid = int(url.split("/").pop())
-        return uid
-
-    async def live(self, uid: int, last_status: LiveStatus = 0) -> Optional[Live]:
-        if uid in self.__uid_room_id:
-            room_id = self.__uid_room_id[uid]
-        else:
-            room_id = await self.uid_to_room_id(uid)
-            self.__uid_room_id[uid] = room_id
-            if room_id == 0:
-                logging.info(f"there's no room_id for user {uid}, maybe live is disabled")
-
-        if room_id == 0:
-            return
-        url = f"https://api.live.bilibili.com/xlive/web-room/v1/index/getInfoByRoom?room_id={room_id}"
-        try:
-            resp = await self.request(url)
-        except (HTTPError, URLError) as e:
-            logging.warning(f"request {url}: {e}")
-            return None
-        except Exception as e:
-            logging.error(f"request {url} got unknown exception: {e}")
-            return None
-        resp = resp.read().decode()
-        data = json.loads(resp)["data"]
-        room_info = data["room_info"]
-        cover = room_info["cover"]
-        if len(cover) == 0:
-            cover = room_info["keyframe"]
-        status = LiveStatus(room_info["live_status"])
-        if status == last_status:
-            return None
-        user = data["anchor_info"]["base_info"]["uname"]
-        return Live(uid, user, room_id, room_info["title"], cover, status, room_info["live_start_time"])
+import asyncio
+import json
+import logging
+import time
+
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+import httpx
+
+import metrics
+from utils import TokenBucket
+from .cache import ResponseCache, space_history_digest, room_info_digest, room_info_status
+from .model import Dynamic, DynamicType, Live, LiveStatus
+from .throttle import BreakerState, CircuitBreaker, RateController, Throttled, is_throttled
+
+try:
+    # optional, much faster for the big space_history responses
+    import orjson
+
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+
+def parse_card(c) -> Optional[Dynamic]:
+    try:
+        card = json_loads(c["card"])
+    except json.JSONDecodeError:
+        logging.error(f"Malformed Bilibili dynamic card: {c}")
+        return None
+
+    dt = DynamicType.from_int(c["desc"]["type"])
+    did = c["desc"]["dynamic_id"]
+
+    if dt == DynamicType.FORWARD:
+        dyn = card["item"]
+        user = card["user"]["uname"]
+
+        origin_card = {
+            "desc": {
+                "type": dyn["orig_type"],
+                "dynamic_id": dyn["orig_dy_id"]
+            },
+            "card": card["origin"]
+        }
+        origin = parse_card(origin_card)
+        if origin is None:
+            return None
+
+        text = f'{dyn["content"]}\n------\nRT\n{origin.text}'
+        link = f"https://t.bilibili.com/{did}"
+        img = origin.photos
+        t = dyn["timestamp"]
+    elif dt == DynamicType.PHOTO:
+        dyn = card["item"]
+        user = card["user"]["name"]
+
+        text = dyn["description"]
+        link = f"https://t.bilibili.com/{did}"
+        img = [entry["img_src"] for entry in dyn["pictures"]]
+        t = dyn["upload_time"]
+    elif dt == DynamicType.PLAIN:
+        dyn = card["item"]
+        user = card["user"]["uname"]
+
+        text = dyn["content"]
+        link = f"https://t.bilibili.com/{did}"
+        img = []
+        t = dyn["timestamp"]
+    elif dt == DynamicType.VIDEO:
+        text = card["title"]
+        user = card["owner"]["name"]
+        link = f'https://www.bilibili.com/video/av{card["aid"]}'
+        img = [card["pic"]]
+        t = card["pubdate"]
+        if t == 0:
+            t = card["ctime"]
+    else:
+        return None
+
+    return Dynamic(user, dt, text, img, link, t, did)
+
+
+def iter_dynamics(cards: list, cursor: int = 0) -> Iterator[Dynamic]:
+    """
+    parse cards newer than the `cursor` dynamic_id lazily, newest first
+
+    the cheap outer `desc` is checked before the inner card json is decoded,
+    so cards which are already seen are never parsed
+    """
+    for c in cards:
+        if c["desc"]["dynamic_id"] <= cursor:
+            break
+        start = time.perf_counter()
+        dyn = parse_card(c)
+        metrics.PARSE_CARD.observe(time.perf_counter() - start)
+        if dyn is None:
+            continue
+        yield dyn
+
+
+def http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+class Bilibili:
+    def __init__(self, timeout: float = 10, max_connections: int = 8,
+                 vc_api: str = "https://api.vc.bilibili.com", live_api: str = "https://api.live.bilibili.com",
+                 budget: TokenBucket = None, controller: RateController = None,
+                 throttle_backoff: float = 60, throttle_max_backoff: float = 1800,
+                 room_ttl: float = 86400, no_room_ttl: float = 3600,
+                 on_room: Callable[[int, int, float], None] = None,
+                 transport: httpx.AsyncBaseTransport = None):
+        """
+        every request takes a token from `budget` if it's set,
+        `controller` adjusts the rate of `budget` from the responses,
+        room ids are looked up again after `room_ttl` seconds, or `no_room_ttl`
+        seconds if there's no room, `on_room` is called with the uid, room id
+        and time of every lookup so they can be kept across restarts,
+        `transport` replaces the network, e.g. with recorded responses
+        """
+        self.__vc_api = vc_api
+        self.__live_api = live_api
+        self.__budget = budget
+        self.__controller = controller
+        self.__throttle_backoff = throttle_backoff
+        self.__throttle_max_backoff = throttle_max_backoff
+        self.__breakers: Dict[str, CircuitBreaker] = {}
+        self.__room_ttl = room_ttl
+        self.__no_room_ttl = no_room_ttl
+        self.__on_room = on_room
+        # uid -> (room_id, when it's looked up), 0 means there's no room
+        self.__rooms: Dict[int, Tuple[int, float]] = {}
+        self.__room_lookups: Dict[int, asyncio.Task] = {}
+        self.__cache = ResponseCache()
+        # uids and data of the last full get_status_info_by_uids response, a 304 means it's still the same
+        self.__batch: Optional[Tuple[Set[int], dict]] = None
+        self.__timeout = timeout
+        # caps the number of in-flight requests, connections are kept alive per host by the pool
+        self.__semaphore = asyncio.Semaphore(max_connections)
+        self.__client = httpx.AsyncClient(
+            http2=http2_available(),
+            timeout=timeout,
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+            transport=transport,
+            headers={
+                "User-Agent": "Dalvik/2.1.0 (Linux; U; Android 7.1.2; Test Build/Test)",
+                "Accept-Encoding": "gzip, deflate",
+            },
+        )
+
+    async def close(self):
+        for task in list(self.__room_lookups.values()):
+            task.cancel()
+        await asyncio.gather(*self.__room_lookups.values(), return_exceptions=True)
+        await self.__client.aclose()
+
+    def cache_stats(self) -> Dict[str, Dict[str, int]]:
+        """
+        hit/miss counters of the response cache per endpoint
+        """
+        return self.__cache.stats()
+
+    def breaker(self, endpoint: str) -> CircuitBreaker:
+        if endpoint not in self.__breakers:
+            self.__breakers[endpoint] = CircuitBreaker(endpoint, self.__throttle_backoff, self.__throttle_max_backoff)
+        return self.__breakers[endpoint]
+
+    async def request(self, url: str, payload: dict = None, timeout: float = None,
+                      endpoint: str = "", cache_key: str = None) -> httpx.Response:
+        """
+        raises `Throttled` if `endpoint` is throttled by bilibili
+
+        with `cache_key` the request is conditional, check for status 304
+        """
+        breaker = self.breaker(endpoint)
+        if not breaker.allow():
+            raise Throttled(f"{endpoint} is throttled, retry after {breaker.retry_after():.0f}s")
+        # only the probe is allowed while it's not closed
+        probe = breaker.state != BreakerState.CLOSED
+        if timeout is None:
+            timeout = self.__timeout
+        headers = None
+        if cache_key is not None:
+            headers = self.__cache.conditional_headers(cache_key)
+        try:
+            if self.__budget is not None:
+                await self.__budget.acquire()
+            async with self.__semaphore:
+                # waiting for the semaphore is our own queueing, not bilibili's latency
+                start = time.monotonic()
+                if payload is None:
+                    resp = await self.__client.get(url, timeout=timeout, headers=headers)
+                else:
+                    resp = await self.__client.post(url, json=payload, timeout=timeout, headers=headers)
+            latency = time.monotonic() - start
+        except BaseException as e:
+            breaker.release(probe)
+            if isinstance(e, Exception):
+                metrics.BILIBILI_ERRORS.inc(endpoint=endpoint)
+            raise
+        metrics.BILIBILI_LATENCY.observe(latency, endpoint=endpoint)
+        if is_throttled(resp.status_code, resp.content):
+            metrics.BILIBILI_THROTTLED.inc(endpoint=endpoint)
+            breaker.failure()
+            if self.__controller is not None:
+                self.__controller.throttled()
+            raise Throttled(f"{endpoint} is throttled")
+        breaker.success(probe)
+        if self.__controller is not None:
+            self.__controller.success(latency)
+        if cache_key is not None:
+            if resp.status_code == 304:
+                self.__cache.hit(endpoint)
+                return resp
+            self.__cache.update_validators(cache_key, resp)
+        # keep the old urllib behaviour, non 2xx status is raised as an error
+        resp.raise_for_status()
+        return resp
+
+    async def space_history(self, user_id: int, offset: int = 0, cursor: int = 0) -> Optional[dict]:
+        """
+        one page of dynamics of `user_id` older than `offset`, None if the request failed
+
+        if the newest dynamic is not newer than the `cursor` dynamic_id,
+        the body is not parsed and an empty page is returned
+        """
+        url = f"{self.__vc_api}/dynamic_svr/v1/dynamic_svr/space_history"
+        payload = {
+            "visitor_uid": 0,
+            "host_uid": user_id,
+            "offset_dynamic_id": offset,
+            "need_top": 0
+        }
+        # only the first page is polled again and again
+        cache_key = f"space_history:{user_id}" if offset == 0 else None
+        try:
+            resp = await self.request(url, payload, endpoint="space_history", cache_key=cache_key)
+        except Throttled as e:
+            logging.warning("skip fetch for user %d: %s", user_id, e, extra={"uid": user_id})
+            return None
+        except httpx.HTTPError as e:
+            logging.warning("request %s: %s", url, e, extra={"uid": user_id})
+            return None
+        except Exception as e:
+            logging.error(f"request {url} got unknown exception: {e}")
+            return None
+        if resp.status_code == 304:
+            return {"cards": []}
+        if cache_key is not None and cursor != 0:
+            top = space_history_digest(resp.content)
+            if top is not None and int(top) <= cursor:
+                self.__cache.hit("space_history")
+                return {"cards": []}
+            self.__cache.miss("space_history")
+        return json_loads(resp.content)["data"]
+
+    async def fetch(self, user_id: int, cursor: int = 0, limit: int = 6) -> List[Dynamic]:
+        """
+        dynamics of `user_id` newer than the `cursor` dynamic_id, newest first
+
+        pages are followed with `offset_dynamic_id` until `cursor` is reached or
+        `limit` dynamics are found, without a cursor only the first page is read,
+        nothing is returned if a page fails before that, so the caller doesn't
+        move its cursor past the dynamics in between
+        """
+        logging.debug("fetch for user %d", user_id)
+        dyn_list = []
+        offset = 0
+        while True:
+            data = await self.space_history(user_id, offset, cursor)
+            if data is None:
+                if offset != 0:
+                    logging.warning("backfill user %d failed at %d, retry from %d next time", user_id, offset, cursor,
+                                    extra={"uid": user_id})
+                    # or the first page is answered with a 304 next time
+                    self.__cache.forget(f"space_history:{user_id}")
+                return []
+            cards = data.get("cards", [])
+            for dyn in iter_dynamics(cards, cursor):
+                dyn_list.append(dyn)
+                if len(dyn_list) == limit:
+                    # without a cursor nothing is skipped, the caller only wants the newest ones
+                    if cursor != 0:
+                        logging.info(f"reach fetch limit {limit} for user {user_id}, older dynamics are skipped")
+                    return dyn_list
+            if cursor == 0 or len(cards) == 0 or cards[-1]["desc"]["dynamic_id"] <= cursor:
+                break
+            if not data.get("has_more"):
+                break
+            offset = data["next_offset"]
+            logging.info(f"backfill user {user_id} from {offset}")
+        return dyn_list
+
+    async def uid_to_room_id(self, uid) -> Optional[int]:
+        """
+        0 if there's no room, None if the request failed
+        """
+        url = f"{self.__live_api}/bili/living_v2/{uid}"
+        try:
+            resp = await self.request(url, endpoint="living_v2")
+        except Throttled as e:
+            logging.warning(f"skip room_id of {uid}: {e}")
+            return None
+        except httpx.HTTPError as e:
+            logging.warning(f"request {url}: {e}")
+            return None
+        except Exception as e:
+            logging.error(f"request {url} got unknown exception: {e}")
+            return None
+        data = json_loads(resp.content)["data"]
+        url = data["url"]
+        if len(url) == 0:
+            return 0
+        uid = int(url.split("/").pop())
+        return uid
+
+    def set_rooms(self, rooms: Dict[int, Tuple[int, float]]):
+        """
+        room ids and when they're looked up, e.g. by the last run
+        """
+        for uid, (room_id, t) in rooms.items():
+            if uid not in self.__rooms or self.__rooms[uid][1] < t:
+                self.__rooms[uid] = (room_id, t)
+
+    def __set_room(self, uid: int, room_id: int):
+        now = time.time()
+        self.__rooms[uid] = (room_id, now)
+        if self.__on_room is not None:
+            self.__on_room(uid, room_id, now)
+
+    def __expired(self, uid: int) -> bool:
+        room_id, t = self.__rooms[uid]
+        ttl = self.__room_ttl if room_id != 0 else self.__no_room_ttl
+        return time.time() - t > ttl
+
+    async def __lookup_room(self, uid: int) -> Optional[int]:
+        room_id = await self.uid_to_room_id(uid)
+        if room_id is None:
+            # try again next time
+            return None
+        if room_id == 0 and self.__rooms.get(uid, (None,))[0] != 0:
+            logging.info(f"there's no room_id for user {uid}, maybe live is disabled")
+        self.__set_room(uid, room_id)
+        return room_id
+
+    def __start_lookup(self, uid: int) -> asyncio.Task:
+        # concurrent callers share one request
+        task = self.__room_lookups.get(uid)
+        if task is None:
+            task = asyncio.create_task(self.__lookup_room(uid))
+            self.__room_lookups[uid] = task
+            task.add_done_callback(lambda _: self.__room_lookups.pop(uid, None))
+        return task
+
+    async def room_id(self, uid: int) -> int:
+        """
+        live room of `uid`, 0 if there's none or it can't be looked up now,
+        an expired room id is returned while it's looked up again in the background
+        """
+        if uid in self.__rooms:
+            if self.__expired(uid):
+                self.__start_lookup(uid)
+            return self.__rooms[uid][0]
+        room_id = await asyncio.shield(self.__start_lookup(uid))
+        return room_id or 0
+
+    async def warm_rooms(self, uids: Iterable[int]):
+        """
+        look up unknown room ids of `uids` concurrently, expired ones are left to `room_id`
+        """
+        await asyncio.gather(*[self.room_id(uid) for uid in uids if uid not in self.__rooms])
+
+    async def danmu_info(self, room_id: int) -> Optional[Tuple[str, str]]:
+        """
+        auth token and websocket url of the live message stream of `room_id`, None if the request failed
+        """
+        url = f"{self.__live_api}/xlive/web-room/v1/index/getDanmuInfo?id={room_id}&type=0"
+        try:
+            resp = await self.request(url, endpoint="getDanmuInfo")
+        except Throttled as e:
+            logging.warning(f"skip danmu info of {room_id}: {e}")
+            return None
+        except httpx.HTTPError as e:
+            logging.warning(f"request {url}: {e}")
+            return None
+        except Exception as e:
+            logging.error(f"request {url} got unknown exception: {e}")
+            return None
+        resp = json_loads(resp.content)
+        if resp["code"] != 0:
+            logging.warning(f"request {url} got code {resp['code']}: {resp.get('message')}")
+            return None
+        data = resp["data"]
+        hosts = data.get("host_list", [])
+        if len(hosts) == 0:
+            return None
+        return data["token"], f"wss://{hosts[0]['host']}:{hosts[0]['wss_port']}/sub"
+
+    async def live(self, uid: int, last_status: LiveStatus = 0) -> Optional[Live]:
+        room_id = await self.room_id(uid)
+        if room_id == 0:
+            return
+        url = f"{self.__live_api}/xlive/web-room/v1/index/getInfoByRoom?room_id={room_id}"
+        cache_key = f"getInfoByRoom:{room_id}"
+        try:
+            resp = await self.request(url, endpoint="getInfoByRoom", cache_key=cache_key)
+        except Throttled as e:
+            logging.warning("skip live of %d: %s", uid, e, extra={"uid": uid})
+            return None
+        except httpx.HTTPError as e:
+            logging.warning("request %s: %s", url, e, extra={"uid": uid})
+            return None
+        except Exception as e:
+            logging.error(f"request {url} got unknown exception: {e}")
+            return None
+        if resp.status_code == 304 or \
+                self.__cache.unchanged("getInfoByRoom", cache_key, room_info_digest(resp.content)):
+            # live status and title are the same as last time, but the caller
+            # may have seen another status since then, e.g. from the live stream
+            digest = self.__cache.digest(cache_key)
+            if digest is not None and room_info_status(digest) == last_status:
+                return None
+            if resp.status_code == 304:
+                # there's no body to tell the status, ask again without validators
+                self.__cache.forget(cache_key)
+                return await self.live(uid, last_status)
+        data = json_loads(resp.content)["data"]
+        room_info = data["room_info"]
+        cover = room_info["cover"]
+        if len(cover) == 0:
+            cover = room_info["keyframe"]
+        status = LiveStatus(room_info["live_status"])
+        if status == last_status:
+            return None
+        user = data["anchor_info"]["base_info"]["uname"]
+        return Live(uid, user, room_id, room_info["title"], cover, status, room_info["live_start_time"])
+
+    async def live_batch(self, last_status: Dict[int, LiveStatus]) -> Optional[List[Live]]:
+        """
+        live status of all uids in `last_status` with a single request,
+        returns the lives whose status changed, or None if the request failed
+        and the caller should fall back to `live`
+        """
+        url = f"{self.__live_api}/room/v1/Room/get_status_info_by_uids"
+        payload = {"uids": list(last_status.keys())}
+        try:
+            resp = await self.request(url, payload, endpoint="get_status_info_by_uids",
+                                      cache_key="get_status_info_by_uids")
+        except Throttled as e:
+            # falling back to one request per uid would make it worse
+            logging.warning(f"skip live status of all: {e}")
+            return []
+        except httpx.HTTPError as e:
+            logging.warning(f"request {url}: {e}")
+            return None
+        except Exception as e:
+            logging.error(f"request {url} got unknown exception: {e}")
+            return None
+        if resp.status_code == 304:
+            # the statuses are the same as last time, but the caller may have seen
+            # another status since then, e.g. from the live stream
+            if self.__batch is None or self.__batch[0] != set(last_status):
+                # there's no body for these uids, ask again without validators
+                self.__cache.forget("get_status_info_by_uids")
+                return await self.live_batch(last_status)
+            data = self.__batch[1]
+        else:
+            resp = json_loads(resp.content)
+            if resp["code"] != 0:
+                logging.warning(f"request {url} got code {resp['code']}: {resp.get('message')}")
+                return None
+            data = resp["data"]
+            if isinstance(data, list):
+                # empty result is an empty list instead of an object
+                data = {}
+            self.__batch = (set(last_status), data)
+        result = []
+        for uid, last in last_status.items():
+            info = data.get(str(uid))
+            if info is None:
+                continue
+            room_id = info["room_id"]
+            # room ids come for free here
+            if room_id != 0 and (uid not in self.__rooms or self.__rooms[uid][0] != room_id or self.__expired(uid)):
+                self.__set_room(uid, room_id)
+            status = LiveStatus(info["live_status"])
+            if status == last:
+                continue
+            cover = info["cover_from_user"]
+            if len(cover) == 0:
+                cover = info["keyframe"]
+            result.append(Live(uid, info["uname"], room_id, info["title"], cover, status, info["live_time"]))
+        return result
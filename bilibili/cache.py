@@ -0,0 +1,91 @@
+import re
+from collections import defaultdict
+from typing import Dict, Optional, Tuple
+
+import httpx
+
+# the first `dynamic_id` of a space_history body belongs to the newest card
+TOP_DYNAMIC_ID = re.compile(rb'"dynamic_id":\s*(\d+)')
+# the first `live_status` and `title` of a getInfoByRoom body belong to `room_info`
+LIVE_STATUS = re.compile(rb'"live_status":\s*(\d+)')
+TITLE = re.compile(rb'"title":\s*"((?:[^"\\]|\\.)*)"')
+
+
+def space_history_digest(body: bytes) -> Optional[bytes]:
+    m = TOP_DYNAMIC_ID.search(body)
+    if m is None:
+        return None
+    return m.group(1)
+
+
+def room_info_digest(body: bytes) -> Optional[bytes]:
+    status = LIVE_STATUS.search(body)
+    title = TITLE.search(body)
+    if status is None or title is None:
+        return None
+    return status.group(1) + b"\0" + title.group(1)
+
+
+def room_info_status(digest: bytes) -> int:
+    return int(digest.split(b"\0", 1)[0])
+
+
+class ResponseCache:
+    """
+    change detection for polled endpoints
+
+    remembers ETag/Last-Modified for conditional requests, and a cheap
+    digest of the part of a response we care about, a response with the
+    same digest as last time can skip parsing and diffing
+    """
+
+    def __init__(self):
+        self.__validators: Dict[str, Tuple[Optional[str], Optional[str]]] = {}
+        self.__digests: Dict[str, bytes] = {}
+        self.__hits = defaultdict(int)
+        self.__misses = defaultdict(int)
+
+    def conditional_headers(self, key: str) -> dict:
+        etag, last_modified = self.__validators.get(key, (None, None))
+        headers = {}
+        if etag is not None:
+            headers["If-None-Match"] = etag
+        if last_modified is not None:
+            headers["If-Modified-Since"] = last_modified
+        return headers
+
+    def update_validators(self, key: str, resp: httpx.Response):
+        etag = resp.headers.get("ETag")
+        last_modified = resp.headers.get("Last-Modified")
+        if etag is not None or last_modified is not None:
+            self.__validators[key] = (etag, last_modified)
+
+    def unchanged(self, endpoint: str, key: str, digest: Optional[bytes]) -> bool:
+        """
+        compare `digest` with the one seen last time for `key` and remember it,
+        None digest is never unchanged
+        """
+        if digest is not None and self.__digests.get(key) == digest:
+            self.hit(endpoint)
+            return True
+        if digest is not None:
+            self.__digests[key] = digest
+        self.miss(endpoint)
+        return False
+
+    def digest(self, key: str) -> Optional[bytes]:
+        return self.__digests.get(key)
+
+    def forget(self, key: str):
+        self.__digests.pop(key, None)
+        self.__validators.pop(key, None)
+
+    def hit(self, endpoint: str):
+        self.__hits[endpoint] += 1
+
+    def miss(self, endpoint: str):
+        self.__misses[endpoint] += 1
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        endpoints = set(self.__hits) | set(self.__misses)
+        return {e: {"hit": self.__hits[e], "miss": self.__misses[e]} for e in endpoints}
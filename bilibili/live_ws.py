@@ -0,0 +1,212 @@
+import asyncio
+import json
+import logging
+import random
+import struct
+import zlib
+from typing import Awaitable, Callable, Dict, Iterable, Iterator, Optional, Set, Tuple
+
+from .api import Bilibili
+from .model import LiveStatus
+
+try:
+    # optional, real-time live status
+    import websockets
+except ImportError:
+    websockets = None
+
+DEFAULT_URL = "wss://broadcastlv.chat.bilibili.com/sub"
+
+# every packet starts with a 16 bytes header:
+# packet length, header length, protocol version, operation, sequence
+HEADER = struct.Struct(">IHHII")
+
+PROTO_JSON = 0
+PROTO_INT = 1
+PROTO_ZLIB = 2
+PROTO_BROTLI = 3
+
+OP_HEARTBEAT = 2
+OP_HEARTBEAT_REPLY = 3
+OP_MESSAGE = 5
+OP_AUTH = 7
+OP_AUTH_REPLY = 8
+
+# the `cmd` of room messages we care about
+LIVE_EVENTS = {
+    "LIVE": LiveStatus.LIVE,
+    "PREPARING": LiveStatus.PREPARE,
+}
+
+
+def live_stream_available() -> bool:
+    return websockets is not None
+
+
+def pack(op: int, body: bytes = b"", proto: int = PROTO_INT) -> bytes:
+    return HEADER.pack(HEADER.size + len(body), HEADER.size, proto, op, 1) + body
+
+
+def unpack(data: bytes) -> Iterator[Tuple[int, bytes]]:
+    """
+    (operation, body) of every packet in `data`, compressed packets are expanded
+    """
+    offset = 0
+    while offset + HEADER.size <= len(data):
+        length, header_length, proto, op, _ = HEADER.unpack_from(data, offset)
+        if length < header_length:
+            logging.warning(f"malformed live message packet of length {length}")
+            return
+        body = data[offset + header_length:offset + length]
+        offset += length
+        if op == OP_MESSAGE and proto == PROTO_ZLIB:
+            yield from unpack(zlib.decompress(body))
+        elif op == OP_MESSAGE and proto == PROTO_BROTLI:
+            # only asked for zlib in auth, skip it
+            logging.debug("skip brotli live message")
+        else:
+            yield op, body
+
+
+def auth_body(room_id: int, token: Optional[str]) -> bytes:
+    body = {"uid": 0, "roomid": room_id, "protover": PROTO_ZLIB, "platform": "web", "type": 2}
+    if token is not None:
+        body["key"] = token
+    return json.dumps(body).encode()
+
+
+def live_event(body: bytes) -> Optional[LiveStatus]:
+    """
+    live status in a room message, None if it's not a live status message
+    """
+    try:
+        msg = json.loads(body)
+    except ValueError:
+        return None
+    # some commands have a suffix, e.g. `DANMU_MSG:4:0:2:2:2:0`
+    cmd = msg.get("cmd", "").split(":")[0]
+    return LIVE_EVENTS.get(cmd)
+
+
+class LiveStream:
+    """
+    live status of rooms pushed by the bilibili live message websocket
+
+    there's a connection for every room, `on_event` is called with the uid
+    and the new status once a LIVE or PREPARING message arrives, dropped
+    connections are reconnected with backoff, `connected` tells the caller
+    which uids still need polling, rooms can be watched and unwatched while
+    it's running
+    """
+
+    def __init__(self, fetcher: Bilibili, on_event: Callable[[int, LiveStatus], Awaitable],
+                 url: str = DEFAULT_URL, heartbeat: float = 30, max_backoff: float = 300):
+        """
+        `url` is used if the stream server of a room can't be looked up
+        """
+        self.__fetcher = fetcher
+        self.__on_event = on_event
+        self.__url = url
+        self.__heartbeat = heartbeat
+        self.__max_backoff = max_backoff
+        self.__connected: Set[int] = set()
+        self.__no_room: Set[int] = set()
+        self.__watchers: Dict[int, asyncio.Task] = {}
+        self.__tasks = set()
+
+    def connected(self, uid: int) -> bool:
+        """
+        live status of `uid` is pushed, or it has no live room at all
+        """
+        return uid in self.__connected or uid in self.__no_room
+
+    def watch(self, uid: int):
+        if uid not in self.__watchers:
+            self.__watchers[uid] = asyncio.create_task(self.__watch(uid))
+
+    def unwatch(self, uid: int):
+        watcher = self.__watchers.pop(uid, None)
+        if watcher is not None:
+            watcher.cancel()
+        self.__connected.discard(uid)
+        self.__no_room.discard(uid)
+
+    async def run(self, uids: Iterable[int], stop: asyncio.Event):
+        for uid in uids:
+            self.watch(uid)
+        await stop.wait()
+        watchers = list(self.__watchers.values())
+        self.__watchers.clear()
+        for w in watchers:
+            w.cancel()
+        await asyncio.gather(*watchers, return_exceptions=True)
+        for task in self.__tasks:
+            task.cancel()
+        await asyncio.gather(*self.__tasks, return_exceptions=True)
+
+    async def __watch(self, uid: int):
+        backoff = 1
+        while True:
+            room_id = await self.__fetcher.room_id(uid)
+            if room_id == 0:
+                self.__no_room.add(uid)
+                await asyncio.sleep(self.__max_backoff)
+                continue
+            self.__no_room.discard(uid)
+            try:
+                await self.__connect(uid, room_id)
+                backoff = 1
+            except asyncio.CancelledError:
+                raise
+            except asyncio.TimeoutError:
+                logging.warning(f"live stream of {uid} in {room_id} timed out")
+            except Exception as e:
+                logging.warning(f"live stream of {uid} in {room_id}: {e}")
+            finally:
+                self.__connected.discard(uid)
+            t = random.uniform(backoff / 2, backoff)
+            logging.info(f"reconnect live stream of {uid} in {t:.1f}s")
+            await asyncio.sleep(t)
+            backoff = min(backoff * 2, self.__max_backoff)
+
+    async def __connect(self, uid: int, room_id: int):
+        info = await self.__fetcher.danmu_info(room_id)
+        token, url = info if info is not None else (None, self.__url)
+        async with websockets.connect(url, ping_interval=None, close_timeout=1) as ws:
+            await ws.send(pack(OP_AUTH, auth_body(room_id, token)))
+            heartbeat = asyncio.create_task(self.__keepalive(ws))
+            try:
+                while True:
+                    # the server answers every heartbeat, silence means the connection is dead
+                    data = await asyncio.wait_for(ws.recv(), self.__heartbeat * 2)
+                    if isinstance(data, str):
+                        continue
+                    for op, body in unpack(data):
+                        self.__handle(uid, room_id, op, body)
+            finally:
+                heartbeat.cancel()
+
+    def __handle(self, uid: int, room_id: int, op: int, body: bytes):
+        if op == OP_AUTH_REPLY:
+            code = json.loads(body).get("code", 0)
+            if code != 0:
+                raise ConnectionError(f"auth failed with code {code}")
+            logging.info(f"live stream of {uid} in {room_id} connected")
+            self.__connected.add(uid)
+        elif op == OP_MESSAGE:
+            status = live_event(body)
+            if status is None:
+                return
+            logging.info(f"live stream of {uid} got {status.name}")
+            # don't block reading the socket
+            task = asyncio.create_task(self.__on_event(uid, status))
+            self.__tasks.add(task)
+            task.add_done_callback(self.__tasks.discard)
+
+    async def __keepalive(self, ws):
+        while True:
+            await ws.send(pack(OP_HEARTBEAT))
+            await asyncio.sleep(self.__heartbeat)
+
+    def stats(self) -> Dict[str, int]:
+        return {"connected": len(self.__connected), "no_room": len(self.__no_room)}
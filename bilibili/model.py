@@ -35,6 +35,7 @@ class Dynamic:
     photos: List[str]
     link: str
     timestamp: int
+    dynamic_id: int = 0
 
 
 class LiveStatus(IntEnum):
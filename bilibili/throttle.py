@@ -0,0 +1,128 @@
+import logging
+import random
+import re
+import time
+from enum import Enum
+
+from utils import TokenBucket
+
+# bilibili reports throttling with http 412 or with code -412 in the body
+THROTTLED_BODY = re.compile(rb'^\s*\{\s*"code"\s*:\s*-412\b')
+
+
+class Throttled(Exception):
+    pass
+
+
+def is_throttled(status_code: int, body: bytes) -> bool:
+    return status_code == 412 or THROTTLED_BODY.match(body) is not None
+
+
+class BreakerState(Enum):
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+
+class CircuitBreaker:
+    """
+    stops requests to a throttled endpoint
+
+    a throttled response opens the breaker for a jittered exponential backoff,
+    after that a single probe request is let through (half-open), the breaker
+    closes if the probe succeeds and opens again with a longer backoff if not
+
+    requests in flight when the breaker opens may still succeed, only the
+    probe tells the caller `allow`ed it in the half-open state closes it
+    """
+
+    def __init__(self, name: str, backoff: float = 60, max_backoff: float = 1800):
+        self.name = name
+        self.state = BreakerState.CLOSED
+        self.__backoff = backoff
+        self.__max_backoff = max_backoff
+        self.__failures = 0
+        self.__open_until = 0
+        self.__probing = False
+
+    def retry_after(self) -> float:
+        return max(0.0, self.__open_until - time.monotonic())
+
+    def allow(self) -> bool:
+        if self.state == BreakerState.CLOSED:
+            return True
+        if self.state == BreakerState.OPEN:
+            if time.monotonic() < self.__open_until:
+                return False
+            logging.info(f"{self.name} half-open, probing")
+            self.state = BreakerState.HALF_OPEN
+        if self.__probing:
+            return False
+        self.__probing = True
+        return True
+
+    def success(self, probe: bool = False):
+        """
+        `probe` is whether the request is allowed as the probe in the half-open state
+        """
+        if self.state == BreakerState.CLOSED:
+            return
+        if self.state == BreakerState.OPEN or not probe:
+            # sent before the breaker opened, it doesn't mean we're not throttled anymore
+            return
+        logging.info(f"{self.name} resumed")
+        self.state = BreakerState.CLOSED
+        self.__failures = 0
+        self.__probing = False
+
+    def failure(self):
+        self.__failures += 1
+        t = min(self.__backoff * 2 ** (self.__failures - 1), self.__max_backoff)
+        # full jitter in the upper half, so the backoff never shrinks too much
+        t = random.uniform(t / 2, t)
+        self.state = BreakerState.OPEN
+        self.__open_until = time.monotonic() + t
+        self.__probing = False
+        logging.error(f"{self.name} throttled, open for {t:.0f}s")
+
+    def release(self, probe: bool = False):
+        """
+        the request ended without telling if we're still throttled
+        """
+        if probe:
+            self.__probing = False
+
+
+class RateController:
+    """
+    additive-increase/multiplicative-decrease of the global request rate
+
+    every fast success adds `increase` requests per second, a slow response
+    backs off a little and a throttled one cuts the rate by `decrease`
+    """
+
+    def __init__(self, bucket: TokenBucket, min_rate: float, max_rate: float,
+                 increase: float = 0.01, decrease: float = 0.5, slow: float = 2):
+        self.__bucket = bucket
+        self.__min_rate = min_rate
+        self.__max_rate = max_rate
+        self.__increase = increase
+        self.__decrease = decrease
+        self.__slow = slow
+
+    @property
+    def rate(self) -> float:
+        return self.__bucket.rate
+
+    def __set(self, rate: float):
+        self.__bucket.rate = min(max(rate, self.__min_rate), self.__max_rate)
+
+    def success(self, latency: float):
+        if latency > self.__slow:
+            self.__set(self.rate * 0.9)
+        else:
+            self.__set(self.rate + self.__increase)
+
+    def throttled(self):
+        self.__set(self.rate * self.__decrease)
+        logging.warning(f"request rate decreased to {self.rate:.3f}/s")
@@ -0,0 +1,49 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable, List, Tuple
+
+from bilibili.model import Dynamic
+
+
+class Coalescer:
+    """
+    holds new dynamics for `window` seconds after the first one arrives,
+    then hands all of them to `flush` at once, so a burst of posts can be
+    merged into fewer messages
+    """
+
+    def __init__(self, window: float, flush: Callable[[List[Tuple[int, Dynamic]]], Awaitable]):
+        self.__window = window
+        self.__flush = flush
+        self.__pending: List[Tuple[int, Dynamic]] = []
+        self.__timer = None
+        self.__tasks = set()
+
+    def add(self, uid: int, d: Dynamic):
+        self.__pending.append((uid, d))
+        if self.__timer is None:
+            self.__timer = asyncio.get_running_loop().call_later(self.__window, self.__start_flush)
+
+    def __start_flush(self):
+        self.__timer = None
+        items, self.__pending = self.__pending, []
+        if len(items) == 0:
+            return
+        task = asyncio.create_task(self.__run_flush(items))
+        self.__tasks.add(task)
+        task.add_done_callback(self.__tasks.discard)
+
+    async def __run_flush(self, items: List[Tuple[int, Dynamic]]):
+        try:
+            await self.__flush(items)
+        except Exception as e:
+            logging.error(f"failed to flush {len(items)} dynamics: {e}")
+
+    async def close(self):
+        """
+        flush what's pending now and wait for all flushes
+        """
+        if self.__timer is not None:
+            self.__timer.cancel()
+        self.__start_flush()
+        await asyncio.gather(*self.__tasks)
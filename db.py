@@ -1,64 +1,426 @@
 import json
 import logging
+import os
+import sqlite3
+import threading
+from typing import Dict, Iterable, List, Set, Tuple
 
 
 class Database:
-    def __init__(self, file: str):
-        self.__file = file
+    """
+    in-memory bot state with a background writer
+
+    every change is applied in memory and queued as a small record
+    `{"op": "set" | "del", "t": table, "k": key, "v": value}`,
+    a background thread hands queued records to the storage backend every
+    `flush_interval` seconds, so callers never wait for the disk
+
+    subclasses implement `_load`, `_write` and optionally `_compact`,
+    storage shared by several processes also implements `_load_tables`
+
+    pending deliveries go to the `outbox_table` table, processes sharing
+    the storage have their own
+    """
+
+    def __init__(self, flush_interval: float = 1, default_uids: Iterable[int] = (), outbox_table: str = "outbox"):
+        self.__flush_interval = flush_interval
+        self.__default_uids = list(default_uids)
+        self.__outbox = outbox_table
         self.__data = {}
-        self.__load_data()
+        self.__pending = []
+        # uid -> chats, the fan-out index
+        self.__index: Dict[int, Set[int]] = {}
+        self.__lock = threading.Lock()
+        # storage has everything not pending while this is held
+        self.__flush_lock = threading.Lock()
+        self.__stop = threading.Event()
+        self.__writer = None
+
+    def _open(self):
+        self.__data = self._load()
+        keys = ["subscriber", "live", "cursor", "room", self.__outbox]
+        for k in keys:
+            if k not in self.__data:
+                self.__data[k] = {}
+        self.__migrate_subscriber()
+        self.__index = self.__build_index()
+        self.__writer = threading.Thread(target=self.__write_loop, daemon=True)
+        self.__writer.start()
+
+    def __migrate_subscriber(self):
+        # old data subscribes a chat to every uid with `True`
+        for chat_id, uids in list(self.__data["subscriber"].items()):
+            if uids is True:
+                self.__record("set", "subscriber", chat_id, self.__default_uids)
+
+    def _load(self) -> dict:
+        raise NotImplementedError
+
+    def _load_tables(self, tables: Iterable[str]) -> dict:
+        raise NotImplementedError(f"{type(self).__name__} can't be shared by processes")
+
+    def _write(self, records: List[dict]):
+        raise NotImplementedError
+
+    def _compact(self, snapshot: str):
+        pass
+
+    def _needs_compact(self) -> bool:
+        return False
+
+    def _close(self):
+        pass
+
+    @staticmethod
+    def _apply(data: dict, r: dict):
+        table = data.setdefault(r["t"], {})
+        if r["op"] == "set":
+            table[r["k"]] = r["v"]
+        elif r["op"] == "del":
+            table.pop(r["k"], None)
+
+    def __build_index(self) -> Dict[int, Set[int]]:
+        index = {}
+        for chat_id, uids in self.__data["subscriber"].items():
+            for uid in uids:
+                index.setdefault(uid, set()).add(chat_id)
+        return index
+
+    def __index_chat(self, chat_id: int, old: Iterable[int], new: Iterable[int]):
+        for uid in old:
+            chats = self.__index.get(uid)
+            if chats is not None:
+                chats.discard(chat_id)
+                if len(chats) == 0:
+                    del self.__index[uid]
+        for uid in new:
+            self.__index.setdefault(uid, set()).add(chat_id)
+
+    def __record(self, op: str, table: str, key, value=None):
+        with self.__lock:
+            self.__record_locked(op, table, key, value)
+
+    def __record_locked(self, op: str, table: str, key, value=None):
+        r = {"op": op, "t": table, "k": key}
+        if value is not None:
+            r["v"] = value
+        self._apply(self.__data, r)
+        self.__pending.append(r)
+
+    def __write_loop(self):
+        while not self.__stop.wait(self.__flush_interval):
+            try:
+                self.__flush()
+            except (OSError, sqlite3.Error) as e:
+                logging.error(f"failed to write data: {e}")
+
+    def __flush(self):
+        with self.__flush_lock:
+            with self.__lock:
+                records, self.__pending = self.__pending, []
+            if len(records) != 0:
+                self._write(records)
+            if self._needs_compact():
+                self.__compact()
+
+    def flush(self):
+        """
+        write pending changes now
+        """
+        self.__flush()
+
+    def refresh(self, tables: Iterable[str] = ("subscriber", "live", "cursor", "room")):
+        """
+        reload `tables` changed by other processes sharing the storage,
+        changes of this process not written yet are kept
+        """
+        tables = list(tables)
+        with self.__flush_lock:
+            data = self._load_tables(tables)
+            with self.__lock:
+                for t in tables:
+                    self.__data[t] = data.get(t, {})
+                for r in self.__pending:
+                    if r["t"] in tables:
+                        self._apply(self.__data, r)
+                # may run in another thread, subscriptions change the index under the lock too
+                self.__index = self.__build_index()
+
+    def __compact(self):
+        with self.__lock:
+            # everything pending is already in the snapshot
+            snapshot = json.dumps(self.__data)
+            self.__pending.clear()
+        self._compact(snapshot)
+
+    def close(self):
+        self.__stop.set()
+        if self.__writer is not None:
+            self.__writer.join()
+        self.__flush()
+        self.__compact()
+        self._close()
+
+    def add_subscribe(self, chat_id: int, uids: Iterable[int]):
+        with self.__lock:
+            old = self.__data["subscriber"].get(chat_id, [])
+            new = sorted(set(old) | set(uids))
+            if new == old:
+                return
+            self.__index_chat(chat_id, old, new)
+            self.__record_locked("set", "subscriber", chat_id, new)
+
+    def del_subscribe(self, chat_id: int, uids: Iterable[int] = None):
+        """
+        unsubscribe `uids` for `chat_id`, all of them if `uids` is None
+        """
+        with self.__lock:
+            if chat_id not in self.__data["subscriber"]:
+                return
+            old = self.__data["subscriber"][chat_id]
+            if uids is None:
+                new = []
+            else:
+                new = sorted(set(old) - set(uids))
+            self.__index_chat(chat_id, old, new)
+            if len(new) == 0:
+                self.__record_locked("del", "subscriber", chat_id)
+            else:
+                self.__record_locked("set", "subscriber", chat_id, new)
+
+    def subscriber(self) -> list:
+        return list(self.__data["subscriber"].keys())
+
+    def subscriptions(self, chat_id: int) -> list:
+        return list(self.__data["subscriber"].get(chat_id, []))
+
+    def chats_of(self, uid: int) -> Set[int]:
+        """
+        chats subscribed to `uid`, the returned set must not be modified
+        """
+        return self.__index.get(uid, set())
+
+    def add_live(self, chat_id: int):
+        if chat_id not in self.__data["live"]:
+            self.__record("set", "live", chat_id, True)
+
+    def del_live(self, chat_id: int):
+        if chat_id in self.__data["live"]:
+            self.__record("del", "live", chat_id)
+
+    def live(self) -> list:
+        return list(self.__data["live"].keys())
+
+    def set_cursor(self, uid: int, dynamic_id: int):
+        if self.__data["cursor"].get(uid) != dynamic_id:
+            self.__record("set", "cursor", uid, dynamic_id)
+
+    def cursor(self) -> dict:
+        """
+        uid -> dynamic_id of the last sent dynamic
+        """
+        return dict(self.__data["cursor"])
+
+    def set_room(self, uid: int, room_id: int, checked_at: float):
+        self.__record("set", "room", uid, [room_id, checked_at])
+
+    def room(self) -> Dict[int, Tuple[int, float]]:
+        """
+        uid -> (live room id, when it's looked up), 0 means there's no room
+        """
+        return {uid: (room_id, t) for uid, (room_id, t) in self.__data["room"].items()}
+
+    @property
+    def outbox_table(self) -> str:
+        return self.__outbox
+
+    def add_outbox(self, key: str, record: dict):
+        self.__record("set", self.__outbox, key, record)
+
+    def del_outbox(self, key: str):
+        if key in self.__data[self.__outbox]:
+            self.__record("del", self.__outbox, key)
+
+    def outbox(self) -> dict:
+        """
+        pending deliveries, key -> record
+        """
+        return dict(self.__data[self.__outbox])
+
+
+class JsonDatabase(Database):
+    """
+    json snapshot plus an append-only journal
+
+    queued records are appended to the journal and fsynced, the journal is
+    folded into a new snapshot once it holds `compact_threshold` records
+    """
 
-    def __convert_to_int(self):
+    def __init__(self, file: str, flush_interval: float = 1, compact_threshold: int = 1000,
+                 default_uids: Iterable[int] = (), outbox_table: str = "outbox"):
+        super().__init__(flush_interval, default_uids, outbox_table)
+        self.__file = file
+        self.__journal_file = f"{file}.journal"
+        self.__compact_threshold = compact_threshold
+        self.__journal_size = 0
+        self._open()
+
+    @staticmethod
+    def __convert_to_int(data: dict) -> dict:
         # json saves key with str, we need to convert to int
         d = {}
-        for k in self.__data:
+        for k in data:
             d[k] = {}
-            m = self.__data[k]
-            for uid in m:
-                d[k][int(uid)] = m[uid]
-        self.__data = d
+            m = data[k]
+            for key in m:
+                # tables keyed by url or other strings keep their keys
+                if key.lstrip("-").isdigit():
+                    d[k][int(key)] = m[key]
+                else:
+                    d[k][key] = m[key]
+        return d
 
-    def __load_data(self):
+    def _load(self) -> dict:
+        result = {}
         try:
             with open(self.__file) as f:
                 data = f.read()
                 try:
-                    self.__data = json.loads(data)
-                    self.__convert_to_int()
+                    result = self.__convert_to_int(json.loads(data))
                 except json.JSONDecodeError:
                     logging.warning(f"failed to load {self.__file}, content is {data}")
         except FileNotFoundError:
             logging.info("no old data file")
-        keys = ["subscriber", "live"]
-        for k in keys:
-            if k not in self.__data:
-                self.__data[k] = {}
+        self.__replay_journal(result)
+        return result
 
-    def __save_data(self):
-        with open(self.__file, "w") as f:
-            f.write(json.dumps(self.__data))
+    def __replay_journal(self, data: dict):
+        try:
+            with open(self.__journal_file) as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            return
+        broken = False
+        for line in lines:
+            try:
+                r = json.loads(line)
+            except json.JSONDecodeError:
+                # only the tail can be broken, it's a record interrupted by a crash
+                logging.warning(f"skip broken journal record: {line}")
+                broken = True
+                continue
+            self._apply(data, r)
+        self.__journal_size = len(lines)
+        logging.info(f"replayed {len(lines)} journal records")
+        if broken:
+            # don't append new records after a broken line
+            self._compact(json.dumps(data))
 
-    def add_subscribe(self, chat_id: int):
-        self.__data["subscriber"][chat_id] = True
-        self.__save_data()
+    def _write(self, records: List[dict]):
+        with open(self.__journal_file, "a") as f:
+            for r in records:
+                f.write(json.dumps(r))
+                f.write("\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self.__journal_size += len(records)
 
-    def del_subscribe(self, chat_id: int):
-        if chat_id in self.__data["subscriber"]:
-            del self.__data["subscriber"][chat_id]
-        self.__save_data()
+    def _needs_compact(self) -> bool:
+        return self.__journal_size >= self.__compact_threshold
 
-    def subscriber(self) -> list:
-        return self.__data["subscriber"].keys()
+    def _compact(self, snapshot: str):
+        tmp = f"{self.__file}.tmp"
+        with open(tmp, "w") as f:
+            f.write(snapshot)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.__file)
+        # crash before truncating only replays records the snapshot already has
+        with open(self.__journal_file, "w") as f:
+            f.flush()
+            os.fsync(f.fileno())
+        self.__journal_size = 0
+        logging.debug(f"compacted {self.__file}")
 
-    def add_live(self, chat_id: int):
-        self.__data["live"][chat_id] = True
-        self.__save_data()
 
-    def del_live(self, chat_id: int):
-        if chat_id in self.__data["live"]:
-            del self.__data["live"][chat_id]
-        self.__save_data()
+class SqliteDatabase(Database):
+    """
+    sqlite storage, subscriptions are kept as indexed (chat_id, uid) rows,
+    other tables are kept as json key/value rows
+    """
+
+    def __init__(self, file: str, flush_interval: float = 1, default_uids: Iterable[int] = (),
+                 outbox_table: str = "outbox"):
+        super().__init__(flush_interval, default_uids, outbox_table)
+        # only the writer thread uses the connection after loading
+        self.__conn = sqlite3.connect(file, check_same_thread=False)
+        # reloads changes of other processes
+        self.__reader = sqlite3.connect(file, check_same_thread=False)
+        self.__conn.execute("PRAGMA journal_mode=WAL")
+        self.__conn.execute("PRAGMA synchronous=NORMAL")
+        with self.__conn:
+            self.__conn.execute(
+                "CREATE TABLE IF NOT EXISTS subscription ("
+                "chat_id INTEGER NOT NULL, uid INTEGER NOT NULL, PRIMARY KEY (chat_id, uid))"
+            )
+            self.__conn.execute("CREATE INDEX IF NOT EXISTS subscription_uid ON subscription (uid)")
+            self.__conn.execute(
+                "CREATE TABLE IF NOT EXISTS kv ("
+                "tbl TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, PRIMARY KEY (tbl, key))"
+            )
+        self._open()
+
+    def _load(self) -> dict:
+        data = {"subscriber": {}}
+        for chat_id, uid in self.__conn.execute("SELECT chat_id, uid FROM subscription ORDER BY chat_id, uid"):
+            data["subscriber"].setdefault(chat_id, []).append(uid)
+        for tbl, key, value in self.__conn.execute("SELECT tbl, key, value FROM kv"):
+            data.setdefault(tbl, {})[json.loads(key)] = json.loads(value)
+        return data
+
+    def _load_tables(self, tables: Iterable[str]) -> dict:
+        data = {}
+        with self.__reader:
+            for t in tables:
+                data[t] = {}
+                if t == "subscriber":
+                    rows = self.__reader.execute("SELECT chat_id, uid FROM subscription ORDER BY chat_id, uid")
+                    for chat_id, uid in rows:
+                        data[t].setdefault(chat_id, []).append(uid)
+                    continue
+                for key, value in self.__reader.execute("SELECT key, value FROM kv WHERE tbl = ?", (t,)):
+                    data[t][json.loads(key)] = json.loads(value)
+        return data
+
+    def _write(self, records: List[dict]):
+        with self.__conn:
+            for r in records:
+                if r["t"] == "subscriber":
+                    self.__conn.execute("DELETE FROM subscription WHERE chat_id = ?", (r["k"],))
+                    if r["op"] == "set":
+                        self.__conn.executemany(
+                            "INSERT INTO subscription (chat_id, uid) VALUES (?, ?)",
+                            [(r["k"], uid) for uid in r["v"]]
+                        )
+                elif r["op"] == "set":
+                    self.__conn.execute(
+                        "INSERT OR REPLACE INTO kv (tbl, key, value) VALUES (?, ?, ?)",
+                        (r["t"], json.dumps(r["k"]), json.dumps(r["v"]))
+                    )
+                else:
+                    self.__conn.execute("DELETE FROM kv WHERE tbl = ? AND key = ?", (r["t"], json.dumps(r["k"])))
+
+    def _close(self):
+        self.__conn.close()
+        self.__reader.close()
 
-    def live(self) -> list:
-        return self.__data["live"].keys()
 
+def open_database(backend: str, file: str, flush_interval: float = 1, compact_threshold: int = 1000,
+                  default_uids: Iterable[int] = (), outbox_table: str = "outbox") -> Database:
+    if backend == "sqlite":
+        return SqliteDatabase(file, flush_interval=flush_interval, default_uids=default_uids,
+                              outbox_table=outbox_table)
+    if backend == "json":
+        return JsonDatabase(file, flush_interval=flush_interval, compact_threshold=compact_threshold,
+                            default_uids=default_uids, outbox_table=outbox_table)
+    raise ValueError(f"unknown database backend {backend}")
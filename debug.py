@@ -1,5 +1,17 @@
+import asyncio
+import cProfile
 import faulthandler
+import io
+import logging
+import os
 import signal
+import time
+import tracemalloc
+
+# frames kept for every traced allocation
+TRACE_FRAMES = 25
+# lines of allocation diffs written to the log
+TOP_ALLOCATIONS = 20
 
 
 def handle_sigusr1():
@@ -7,3 +19,82 @@ def handle_sigusr1():
         faulthandler.dump_traceback()
 
     signal.signal(signal.SIGUSR1, handle)
+
+
+def output(path: str, prefix: str, ext: str) -> str:
+    return os.path.join(path, f"{prefix}-{time.strftime('%Y%m%d-%H%M%S')}.{ext}")
+
+
+def dump_tasks(file):
+    tasks = asyncio.all_tasks()
+    file.write(f"{len(tasks)} tasks\n")
+    for task in sorted(tasks, key=lambda t: t.get_name()):
+        file.write(f"\n{task!r}\n")
+        task.print_stack(file=file)
+    return len(tasks)
+
+
+def take_snapshot() -> tracemalloc.Snapshot:
+    # leave out the memory used by tracemalloc itself
+    return tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+
+
+class Debugger:
+    """
+    diagnose a running bot with signals
+
+    SIGUSR1 dumps tracebacks of all threads and stacks of all asyncio tasks,
+    SIGUSR2 starts a cProfile session and the next one writes it to a pstats file,
+    SIGTTIN takes a tracemalloc snapshot and logs the top allocations since the last one
+    """
+
+    def __init__(self, path: str = "."):
+        self.__path = path
+        self.__profile = None
+        self.__snapshot = None
+
+    def install(self, loop: asyncio.AbstractEventLoop):
+        """
+        the handlers run on `loop`, so they see its tasks and profile its thread
+        """
+        os.makedirs(self.__path, exist_ok=True)
+        loop.add_signal_handler(signal.SIGUSR1, self.dump)
+        loop.add_signal_handler(signal.SIGUSR2, self.toggle_profile)
+        loop.add_signal_handler(signal.SIGTTIN, self.snapshot)
+
+    def dump(self):
+        faulthandler.dump_traceback()
+        file = output(self.__path, "tasks", "txt")
+        with open(file, "w") as f:
+            n = dump_tasks(f)
+        logging.warning(f"dumped {n} tasks to {file}")
+
+    def toggle_profile(self):
+        if self.__profile is None:
+            self.__profile = cProfile.Profile()
+            self.__profile.enable()
+            logging.warning("profiling started, send SIGUSR2 again to stop")
+            return
+        self.__profile.disable()
+        file = output(self.__path, "profile", "pstats")
+        # open it with `python -m pstats`, snakeviz, or flameprof for a flamegraph
+        self.__profile.dump_stats(file)
+        self.__profile = None
+        logging.warning(f"profiling stopped, stats are written to {file}")
+
+    def snapshot(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(TRACE_FRAMES)
+            self.__snapshot = take_snapshot()
+            logging.warning("memory tracing started, send SIGTTIN again to see what's allocated since now")
+            return
+        snapshot = take_snapshot()
+        file = output(self.__path, "memory", "snapshot")
+        snapshot.dump(file)
+        out = io.StringIO()
+        current, peak = tracemalloc.get_traced_memory()
+        out.write(f"traced memory {current / 1024:.0f}KiB, peak {peak / 1024:.0f}KiB, snapshot in {file}\n")
+        for stat in snapshot.compare_to(self.__snapshot, "lineno")[:TOP_ALLOCATIONS]:
+            out.write(f"{stat}\n")
+        self.__snapshot = snapshot
+        logging.warning(out.getvalue())
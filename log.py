@@ -0,0 +1,64 @@
+import json
+import logging
+import queue
+import sys
+from logging.handlers import QueueHandler, QueueListener, TimedRotatingFileHandler
+
+# attributes every record has, anything else is passed with `extra`
+RECORD_FIELDS = set(logging.LogRecord("", 0, "", 0, "", None, None).__dict__) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    a json object per line, fields passed with `extra` are kept as they are, e.g.
+
+        logging.info("send %s", d.link, extra={"uid": uid, "link": d.link})
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "message": record.getMessage(),
+        }
+        for k, v in record.__dict__.items():
+            if k not in RECORD_FIELDS:
+                data[k] = v
+        if record.exc_info:
+            data["exc"] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class LazyQueueHandler(QueueHandler):
+    """
+    queues records without formatting them, the writer thread does it
+
+    the args of a record are formatted later, don't change them after logging
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+def setup_logging(level, file: str = None, fmt: str = "text") -> QueueListener:
+    """
+    route all logs through a queue to a background thread, so formatting,
+    writing and rotating never block the caller, stop the returned listener
+    before exit to flush the logs
+    """
+    if file is None:
+        handler = logging.StreamHandler(sys.stderr)
+    else:
+        handler = TimedRotatingFileHandler(file, when="d", encoding="utf-8")
+    if fmt == "json":
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+    q = queue.SimpleQueue()
+    listener = QueueListener(q, handler, respect_handler_level=True)
+    logging.basicConfig(level=level, handlers=[LazyQueueHandler(q)])
+    # a line for every request otherwise, those are counted in the metrics already
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    logging.getLogger("httpcore").setLevel(logging.WARNING)
+    listener.start()
+    return listener
@@ -1,44 +1,64 @@
 import asyncio
-import random
-import threading
-import time
+import secrets
+import signal
 import logging
-from logging.handlers import TimedRotatingFileHandler
-
-import telegram
-from telegram import Update, Bot, InputMediaPhoto, ParseMode, InlineKeyboardMarkup, \
-    InlineKeyboardButton
-from telegram.ext import CallbackContext
+import time
+from collections import defaultdict
+from typing import Callable, Iterable, List, Optional, Tuple
+from urllib.parse import urlparse
+
+from telegram import Update, Bot
+from telegram.constants import ParseMode
+from telegram.ext import Application
+from telegram.ext import ContextTypes
 from telegram.ext import CommandHandler
-from telegram.ext import Filters
-from telegram.ext import Updater
-from telegram.ext import run_async
+from telegram.ext import filters
 
 import debug
+import log
+import metrics
 from bilibili.api import Bilibili
-from bilibili.model import Dynamic, DynamicType, LiveStatus, Live
-from config import TOKEN, UID_LIST, BOT_NAME, MIN_SEND_DELAY, MIN_FETCH_DELAY, FETCH_INTERVAL, ADMIN_USERNAMES, \
-    LOG_LEVEL, LOG_FILE
-from db import Database
-from utils import gen_token, async_wrap, format_time
-
-
-def send_msg(update: Update, context: CallbackContext, msg: str, md=False):
+from bilibili.live_ws import LiveStream, live_stream_available
+from bilibili.model import Dynamic, LiveStatus, Live
+from bilibili.throttle import RateController
+from config import TOKEN, UID_LIST, BOT_NAME, FETCH_INTERVAL, FETCH_MIN_INTERVAL, FETCH_MAX_INTERVAL, \
+    FETCH_CONCURRENCY, BACKFILL_LIMIT, LIVE_INTERVAL, BILIBILI_RATE, BILIBILI_BURST, \
+    BILIBILI_MIN_RATE, BILIBILI_MAX_RATE, THROTTLE_BACKOFF, THROTTLE_MAX_BACKOFF, ADMIN_USERNAMES, \
+    LOG_LEVEL, LOG_FILE, LOG_FORMAT, TELEGRAM_POOL_SIZE, BILIBILI_TIMEOUT, BILIBILI_MAX_CONNECTIONS, \
+    SEND_GLOBAL_RATE, SEND_GROUP_RATE, SEND_PRIVATE_RATE, SEND_WORKERS, SEND_QUEUE_SIZE, \
+    MEDIA_CACHE_SIZE, MEDIA_CACHE_FILE, DB_BACKEND, DB_FILE, DB_FLUSH_INTERVAL, \
+    DB_COMPACT_THRESHOLD, OUTBOX_MAX_ATTEMPTS, OUTBOX_BACKOFF, \
+    COALESCE_WINDOW, WEBHOOK_URL, WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_SECRET, \
+    LIVE_STREAM, LIVE_STREAM_URL, LIVE_STREAM_RECONCILE, \
+    MEDIA_DIR, MEDIA_DIR_SIZE, MEDIA_DOWNLOAD_CONCURRENCY, MEDIA_MAX_SIDE, METRICS_LISTEN, METRICS_PORT, \
+    DEBUG_DIR, BILIBILI_VC_API, BILIBILI_LIVE_API, TELEGRAM_API_URL, SHARD_WORKER, SHARD_LEASE_TTL, SHARD_CLAIM_TTL, \
+    ROOM_ID_TTL, NO_ROOM_TTL
+from coalesce import Coalescer
+from db import open_database
+from media import MediaCache, MediaStore
+from outbox import Outbox
+from poller import Poller
+from render import Payload, render_dynamic, render_digest, render_live
+from sender import Sender, PRIORITY_LIVE, PRIORITY_DYNAMIC
+from shard import Shard, outbox_table
+from utils import gen_token, TokenBucket
+
+
+async def send_msg(update: Update, context: ContextTypes.DEFAULT_TYPE, msg: str, md=False):
     chat_id = update.effective_chat.id
     reply_id = update.message.message_id
     if md:
-        context.bot.send_message(
+        await context.bot.send_message(
             chat_id=chat_id,
             reply_to_message_id=reply_id,
             text=msg,
             parse_mode=ParseMode.MARKDOWN_V2)
     else:
-        context.bot.send_message(chat_id=chat_id, reply_to_message_id=reply_id, text=msg)
+        await context.bot.send_message(chat_id=chat_id, reply_to_message_id=reply_id, text=msg)
 
 
-@run_async
-def cmd_start(update: Update, context: CallbackContext):
-    send_msg(update, context, "I'm Meumy bot to dispatch meumy dynamics")
+async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await send_msg(update, context, "I'm Meumy bot to dispatch meumy dynamics")
 
 
 def strip_msg(cmd, text: str) -> str:
@@ -47,295 +67,650 @@ def strip_msg(cmd, text: str) -> str:
     return text.strip()
 
 
+def parse_uids(args: List[str]) -> Optional[List[int]]:
+    """
+    uids in command arguments, all uids if there's no argument, None if any of them is unknown
+    """
+    if len(args) == 0:
+        return list(UID_LIST)
+    try:
+        uids = [int(uid) for uid in args]
+    except ValueError:
+        return None
+    for uid in uids:
+        if uid not in UID_LIST:
+            return None
+    return uids
+
+
 # register vtb for a chat
-# /register token
-@run_async
-def cmd_register(update: Update, context: CallbackContext):
+# /register token [uid...]
+async def cmd_register(update: Update, context: ContextTypes.DEFAULT_TYPE):
     msg = strip_msg("register", update.message.text)
     # /register@bot_name token
     if len(msg) == 0:
-        send_msg(update, context, "/register token")
+        await send_msg(update, context, "/register token [uid...]")
+        return
+    token, *args = msg.split()
+    uids = parse_uids(args)
+    if uids is None:
+        await send_msg(update, context, f"uid should be one of {UID_LIST}")
         return
-    token = msg.strip()
     if token in tokens:
         full_name = update.effective_user.full_name
         username = update.effective_user.username
         chat_username = update.effective_chat.username
         chat_id = update.effective_chat.id
-        logging.info(f"{full_name}({username}) register callback for {chat_username}({chat_id}))")
+        logging.info(f"{full_name}({username}) register callback for {chat_username}({chat_id})) on {uids}")
         tokens.remove(token)
-        chats.add(chat_id)
-        db.add_subscribe(chat_id)
-        send_msg(update, context, "success, this chat will be notified when meumy post new message")
+        db.add_subscribe(chat_id, uids)
+        await send_msg(update, context, "success, this chat will be notified when meumy post new message")
     else:
-        send_msg(update, context, "please contact the bot owner to get the token")
+        await send_msg(update, context, "please contact the bot owner to get the token")
 
 
 # unregister vtb for a chat
-# /unregister@bot_name token
-@run_async
-def cmd_unregister(update: Update, context: CallbackContext):
+# /unregister@bot_name token [uid...]
+async def cmd_unregister(update: Update, context: ContextTypes.DEFAULT_TYPE):
     msg = strip_msg("unregister", update.message.text)
     if len(msg) == 0:
-        send_msg(update, context, "/unregister token")
-    token = msg.strip()
+        await send_msg(update, context, "/unregister token [uid...]")
+        return
+    token, *args = msg.split()
+    uids = parse_uids(args)
+    if uids is None:
+        await send_msg(update, context, f"uid should be one of {UID_LIST}")
+        return
     if token in tokens:
         full_name = update.effective_user.full_name
         username = update.effective_user.username
         chat_username = update.effective_chat.username
         chat_id = update.effective_chat.id
-        logging.info(f"{full_name}({username}) unregister callback for {chat_username}({chat_id}))")
+        logging.info(f"{full_name}({username}) unregister callback for {chat_username}({chat_id})) on {uids}")
         tokens.remove(token)
-        chats.remove(chat_id)
-        db.del_subscribe(chat_id)
-        send_msg(update, context, "success, this chat will not be notified")
+        db.del_subscribe(chat_id, uids)
+        await send_msg(update, context, "success, this chat will not be notified")
     else:
-        send_msg(update, context, "this token is invalid")
+        await send_msg(update, context, "this token is invalid")
 
 
 # generate a token
 # only for admin
-@run_async
-def cmd_token(update: Update, context: CallbackContext):
+async def cmd_token(update: Update, context: ContextTypes.DEFAULT_TYPE):
     username = update.effective_user.username
     logging.info(f"{username} try to generate token")
     if username in ADMIN_USERNAMES:
         token = gen_token()
         tokens.add(token)
         logging.info(f"token generated by {username}")
-        send_msg(update, context, f"one time token generated: `{token}`", md=True)
+        await send_msg(update, context, f"one time token generated: `{token}`", md=True)
     else:
         logging.info(f"denied for {username}")
-        send_msg(update, context, "permission denied, please contact the bot owner")
-
-
-def origin_link(content):
-    return InlineKeyboardMarkup([[InlineKeyboardButton(text="link", url=content)]])
-
-
-def room_link(room_id):
-    return f"https://live.bilibili.com/{room_id}"
-
-
-async def send_live_to(chat_id, l: Live):
-    @async_wrap
-    def send(chat_id, l: Live):
-        bot: Bot = updater.bot
-        t = format_time(l.live_start_time)
-        text = f"{l.user} is living:\n{t}\n------\n{l.title}"
-        bot.send_photo(
-            chat_id=chat_id,
-            photo=l.cover,
-            caption=text,
-            reply_markup=origin_link(room_link(l.room_id))
-        )
-
-    try:
-        await send(chat_id, l)
-    except telegram.TelegramError as e:
-        logging.warning(f"failed to send {l} to {chat_id}: {e}")
-
-
-async def send_dynamic_to(chat_id, d: Dynamic):
-    @async_wrap
-    def send(chat_id, d: Dynamic):
-        bot: Bot = updater.bot
-        t = format_time(d.timestamp)
-        text = f"{d.user}:\n{t}\n------\n{d.text}"
-        try:
-            if d.type == DynamicType.FORWARD and len(d.photos) != 0 or \
-                    d.type == DynamicType.PHOTO:
-                if len(d.photos) == 1:
-                    if d.photos[0].endswith(".gif"):
-                        bot.send_animation(
-                            chat_id=chat_id,
-                            animation=d.photos[0],
-                            caption=text,
-                            reply_markup=origin_link(d.link)
-                        )
-                    else:
-                        bot.send_photo(
-                            chat_id=chat_id,
-                            photo=d.photos[0],
-                            caption=text,
-                            reply_markup=origin_link(d.link)
-                        )
-                else:
-                    medias = [
-                        InputMediaPhoto(photo) for photo in d.photos
-                    ]
-                    bot.send_media_group(
-                        chat_id=chat_id,
-                        media=medias,
-                    )
-                    bot.send_message(
-                        chat_id=chat_id,
-                        text=text,
-                        reply_markup=origin_link(d.link),
-                    )
-            elif d.type == DynamicType.FORWARD and len(d.photos) == 0 or \
-                    d.type == DynamicType.PLAIN:
-                bot.send_message(
-                    chat_id=chat_id,
-                    text=text,
-                    reply_markup=origin_link(d.link),
-                )
-            elif d.type == DynamicType.VIDEO:
-                bot.send_photo(
-                    chat_id=chat_id,
-                    photo=d.photos[0],
-                    caption=text,
-                    reply_markup=origin_link(d.link),
-                )
-        except telegram.error.TimedOut:
-            logging.warning(f"send message to {chat_id} time out, dynamic is {d}")
-
-    await asyncio.sleep(MIN_SEND_DELAY)
-    try:
-        await send(chat_id, d)
-    except telegram.TelegramError as e:
-        logging.warning(f"failed to send {d} to {chat_id}: {e}")
-
-
-async def send_to_all(d: Dynamic = None, l: Live = None):
-    tasks = []
-    if d is not None:
-        for chat_id in chats:
-            tasks.append(send_dynamic_to(chat_id, d))
+        await send_msg(update, context, "permission denied, please contact the bot owner")
+
+
+# stop uploading media one chat at a time after this many failures
+MAX_UPLOAD_ATTEMPTS = 3
+
+
+async def send_payloads(chat_id: int, payloads: List[Payload], progress: Callable[[int], None] = None):
+    """
+    `progress` is called with how many payloads are sent, so a retry doesn't send them again
+    """
+    bot: Bot = application.bot
+    for i, p in enumerate(payloads):
+        await p.send(bot, chat_id, media)
+        if progress is not None:
+            progress(i + 1)
+
+
+def describe(item) -> str:
+    """
+    short description of a dynamic, a live or a list of them for logs
+    """
+    if isinstance(item, list):
+        return ", ".join(describe(i) for i in item)
+    if isinstance(item, Dynamic):
+        return item.link
+    if isinstance(item, Live):
+        return f"live of {item.uid} in {item.room_id}"
+    return str(item)
+
+
+def posted_at(item) -> List[int]:
+    """
+    when a dynamic is posted or a live is started, for every item in a digest
+    """
+    if isinstance(item, list):
+        return [t for i in item for t in posted_at(i)]
+    if isinstance(item, Dynamic):
+        return [item.timestamp]
+    if isinstance(item, Live):
+        return [item.live_start_time]
+    return []
+
+
+async def deliver(chat_id: int, item, payloads: List[Payload], priority: int, label: str):
+    claims = [claim_key(i) for i in item] if isinstance(item, list) else [claim_key(item)]
+    if await outbox.deliver(chat_id, payloads, priority, label, claims):
+        now = time.time()
+        for t in posted_at(item):
+            metrics.DELIVERY_LAG.observe(now - t)
+
+
+async def fan_out(chats: Iterable[int], item, payloads: List[Payload], priority: int):
+    """
+    send rendered `payloads` of `item` to `chats`,
+    media is uploaded to one chat first, then the rest of chats reuse the file_id concurrently
+    """
+    if len(payloads) == 0:
+        return
+    start = time.monotonic()
+    urls = [url for p in payloads for url in p.media]
+    label = describe(item)
+    targets = list(chats)
+    count = len(targets)
+    attempts = 0
+    while len(targets) != 0 and not media.has_all(urls) and attempts < MAX_UPLOAD_ATTEMPTS:
+        chat_id = targets.pop(0)
+        await deliver(chat_id, item, payloads, priority, label)
+        attempts += 1
+    upload = time.monotonic() - start
+    await asyncio.gather(*[deliver(chat_id, item, payloads, priority, label) for chat_id in targets])
+    elapsed = time.monotonic() - start
+    logging.info("fan out %s to %d chats in %.2fs", label, count, elapsed,
+                 extra={"stage": "fan_out", "item": label, "chats": count, "upload": upload, "elapsed": elapsed})
+
+
+def claim_key(item) -> str:
+    if isinstance(item, Dynamic):
+        return f"dynamic/{item.dynamic_id}"
+    return f"live/{item.uid}/{item.live_start_time}"
+
+
+async def claim(chats: Iterable[int], item) -> Iterable[int]:
+    """
+    chats `item` should be sent to, with several workers it's sent to a chat by the first one claiming it
+    """
+    if shard is None:
+        return chats
+    return await shard.claim(chats, claim_key(item))
+
+
+async def send_to_all(uid: int, d: Dynamic = None, l: Live = None):
     if l is not None:
-        for chat_id in chats:
-            tasks.append(send_live_to(chat_id, l))
+        await fan_out(await claim(db.chats_of(uid), l), l, render_live(l), PRIORITY_LIVE)
+    if d is not None:
+        await fan_out(await claim(db.chats_of(uid), d), d, render_dynamic(d), PRIORITY_DYNAMIC)
+
+
+async def send_digest(items: List[Tuple[int, Dynamic]]):
+    """
+    send dynamics of a coalescing window, every chat gets the dynamics
+    of its uids merged, chats with the same dynamics share the rendered payloads
+    """
+    by_chat = defaultdict(list)
+    for uid, d in items:
+        for chat_id in await claim(db.chats_of(uid), d):
+            by_chat[chat_id].append(d)
+    groups = defaultdict(list)
+    for chat_id, dyns in by_chat.items():
+        groups[tuple(d.dynamic_id for d in dyns)].append(chat_id)
+    tasks = []
+    for chats in groups.values():
+        dyns = sorted(by_chat[chats[0]], key=lambda d: d.timestamp)
+        logging.info("send digest of %d dynamics to %d chats", len(dyns), len(chats),
+                     extra={"stage": "digest", "dynamics": len(dyns), "chats": len(chats)})
+        tasks.append(fan_out(chats, dyns, render_digest(dyns), PRIORITY_DYNAMIC))
     await asyncio.gather(*tasks)
+    # everything is in the outbox now
+    for uid, d in items:
+        if db.cursor().get(uid, 0) < d.dynamic_id:
+            db.set_cursor(uid, d.dynamic_id)
 
 
-async def fetch_and_send_single(uid: int):
-    try:
-        dyn = await fetcher.fetch(uid, fetch_record[uid])
-    except Exception as e:
-        logging.error(f"fetch dynamic for {uid}: {e}")
-        return
-    dyn.sort(key=lambda d: d.timestamp)
-
-    if (l := len(dyn)) != 0:
-        logging.info(f"fetched {l} dynamics for {uid}")
-    tasks = []
-    for d in dyn:
-        logging.info(f"send_to_all {d}")
-        tasks.append(send_to_all(d=d))
-        fetch_record[uid] = d.timestamp
-    await asyncio.gather(*tasks)
+async def handle_live(uid: int, l: Live):
     last_status = live_record[uid]
-    try:
-        l = await fetcher.live(uid, last_status)
-    except Exception as e:
-        logging.error(f"fetch live for {uid}: {e}")
-        return
-    if l is None:
-        return
+    # set before sending, so the same change seen by the stream and polling is sent once
+    live_record[uid] = l.status
+    metrics.LIVE_CHANGES.inc(status=l.status.name)
     if last_status == LiveStatus.PREPARE and l.status == LiveStatus.LIVE:
-        logging.info(f"{uid} is now living")
-        logging.debug(f"send_to_all {l}")
-        await send_to_all(l=l)
+        logging.info("%d is now living", uid, extra={"uid": uid, "room_id": l.room_id})
+        poller.record_activity(uid, l.live_start_time)
+        logging.debug("send_to_all %s", l)
         db.add_live(uid)
-    else:
+        try:
+            await send_to_all(uid, l=l)
+        except Exception as e:
+            # e.g. the claim database is locked, don't stop checking the other uids
+            logging.error("send live of %d: %s", uid, e, extra={"uid": uid, "stage": "live"})
+    elif l.status != LiveStatus.LIVE:
         db.del_live(uid)
-    live_record[uid] = l.status
 
 
-async def fetch_all():
-    for uid in fetch_record:
-        start = time.time()
-        await fetch_and_send_single(uid)
-        min_interval = MIN_FETCH_DELAY
-        t = random.random()
-        t += 1
-        t *= min_interval
-        t -= time.time() - start
-        if t <= 0:
-            logging.warning(f"sleep time {t} less than 0, skip")
-        else:
-            logging.debug(f"short sleep {t}")
+async def fetch_live_all() -> bool:
+    """
+    check live status of all uids with one request, returns False if
+    the batch request failed and every uid should be checked one by one
+    """
+    uids = owned_uids()
+    if len(uids) == 0:
+        return True
+    try:
+        lives = await fetcher.live_batch({uid: live_record[uid] for uid in uids})
+    except Exception as e:
+        logging.error(f"fetch live for all: {e}")
+        return False
+    if lives is None:
+        logging.warning("failed to fetch live status in batch, fallback to single fetch")
+        return False
+    await asyncio.gather(*[handle_live(l.uid, l) for l in lives])
+    return True
+
+
+async def on_live_event(uid: int, status: LiveStatus):
+    """
+    live status pushed by the live stream, room info is fetched for a new live
+    """
+    try:
+        if status != LiveStatus.LIVE:
+            if live_record[uid] != status:
+                await handle_live(uid, Live(uid, "", 0, "", "", status, 0))
+            return
+        # room info may lag behind the message for a few seconds
+        for t in (0, 2, 5):
             await asyncio.sleep(t)
+            if live_record[uid] == LiveStatus.LIVE:
+                return
+            l = await fetcher.live(uid, live_record[uid])
+            if l is not None:
+                await handle_live(uid, l)
+                return
+        logging.warning(f"live stream says {uid} is living, but the room info doesn't")
+    except Exception as e:
+        logging.error(f"handle live event of {uid}: {e}")
+
+
+def live_stream_covers_all() -> bool:
+    if live_stream is None:
+        return False
+    return all(live_stream.connected(uid) for uid in owned_uids() if len(db.chats_of(uid)) != 0)
+
+
+def owned_uids() -> List[int]:
+    """
+    uids polled by this process, some of them if it's one of several workers
+    """
+    if shard is None:
+        return UID_LIST
+    return shard.uids()
+
+
+async def acquire_uids(uids: List[int]):
+    """
+    start polling `uids` taken over from other workers, with the state they left
+    """
+    cursors = db.cursor()
+    living = set(db.live())
+    rooms = db.room()
+    fetcher.set_rooms({uid: rooms[uid] for uid in uids if uid in rooms})
+    for uid in uids:
+        fetch_record[uid] = cursors.get(uid, 0)
+        live_record[uid] = LiveStatus.LIVE if uid in living else LiveStatus.PREPARE
+        if live_stream is not None:
+            live_stream.watch(uid)
+    poller.add(uids)
+
+
+async def release_uids(uids: List[int]):
+    poller.remove(uids)
+    for uid in uids:
+        if live_stream is not None:
+            live_stream.unwatch(uid)
+
+
+async def lead(leading: bool):
+    """
+    only one worker receives telegram updates
+    """
+    if leading:
+        if not application.updater.running:
+            await start_updater()
+    elif application.updater.running:
+        logging.info("stop receiving telegram updates")
+        await application.updater.stop()
+
+
+def set_cursor(uid: int, dynamic_id: int):
+    fetch_record[uid] = dynamic_id
+    db.set_cursor(uid, dynamic_id)
+
+
+async def fetch_and_send_single(uid: int, check_live: bool = True) -> int:
+    """
+    fetch and send new dynamics of `uid`, returns how many are fetched
+    """
+    if len(db.chats_of(uid)) == 0:
+        return 0
+    cursor = fetch_record.get(uid, 0)
+    try:
+        if cursor == 0:
+            # first run for this uid, only remember where we are
+            dyn = await fetcher.fetch(uid, limit=1)
+            if len(dyn) != 0:
+                set_cursor(uid, dyn[0].dynamic_id)
+            dyn = []
+        else:
+            dyn = await fetcher.fetch(uid, cursor, limit=BACKFILL_LIMIT)
+    except Exception as e:
+        logging.error("fetch dynamic for %d: %s", uid, e, extra={"uid": uid, "stage": "fetch"})
+        return 0
+    dyn.sort(key=lambda d: d.dynamic_id)
 
-
-def fetch_loop():
-    while True:
-        start = time.time()
-        if len(chats) != 0:
-            asyncio.run(fetch_all())
-        t = FETCH_INTERVAL
-        t -= time.time() - start
-        if t <= 0:
-            logging.warning(f"sleep time {t} less than 0, skip")
+    if (l := len(dyn)) != 0:
+        logging.info("fetched %d dynamics for %d", l, uid, extra={"uid": uid, "stage": "fetch", "dynamics": l})
+        metrics.NEW_DYNAMICS.inc(l)
+    # one by one, so dynamics arrive in the order they were posted
+    for d in dyn:
+        poller.record_activity(uid, d.timestamp)
+        if COALESCE_WINDOW > 0:
+            # the cursor is saved after the digest is sent
+            logging.info("coalesce %s", d.link, extra={"uid": uid, "link": d.link, "stage": "coalesce"})
+            fetch_record[uid] = d.dynamic_id
+            coalescer.add(uid, d)
+            continue
+        logging.info("send_to_all %s", d.link, extra={"uid": uid, "link": d.link, "stage": "send"})
+        logging.debug("send_to_all %s", d)
+        await send_to_all(uid, d=d)
+        set_cursor(uid, d.dynamic_id)
+    if check_live:
+        try:
+            l = await fetcher.live(uid, live_record[uid])
+        except Exception as e:
+            logging.error("fetch live for %d: %s", uid, e, extra={"uid": uid, "stage": "live"})
+            return len(dyn)
+        if l is not None:
+            await handle_live(uid, l)
+    return len(dyn)
+
+
+async def poll_uid(uid: int) -> int:
+    if shard is not None and not shard.owns(uid):
+        # the lease has expired, another worker may be polling it now
+        return 0
+    start = time.monotonic()
+    # live status of this uid is checked here only if the batch request fails
+    new = await fetch_and_send_single(uid, check_live=not batch_live_ok)
+    elapsed = time.monotonic() - start
+    metrics.POLL_DURATION.observe(elapsed)
+    logging.debug("poll %d in %.2fs", uid, elapsed, extra={"uid": uid, "stage": "poll", "elapsed": elapsed})
+    return new
+
+
+async def warm_up():
+    """
+    room ids neither kept from the last run nor given by the first batch
+    live check are looked up concurrently, instead of one by one later
+    """
+    # the batch check gives most room ids for free, looking them all up first would delay it and the polls
+    await live_checked.wait()
+    start = time.monotonic()
+    await fetcher.warm_rooms([uid for uid in owned_uids() if len(db.chats_of(uid)) != 0])
+    elapsed = time.monotonic() - start
+    logging.info("warmed up room ids in %.2fs", elapsed, extra={"stage": "warm_up", "elapsed": elapsed})
+
+
+async def live_loop():
+    global batch_live_ok
+    last_check = 0
+    while not stop_event.is_set():
+        # polling is only a safety net while the live stream is connected
+        pushed = live_stream_covers_all() and time.monotonic() - last_check < LIVE_STREAM_RECONCILE
+        if len(db.subscriber()) != 0 and not pushed:
+            batch_live_ok = await fetch_live_all()
+            last_check = time.monotonic()
+        live_checked.set()
+        try:
+            await asyncio.wait_for(stop_event.wait(), LIVE_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+
+def stop():
+    logging.info("bot exiting")
+    stop_event.set()
+
+
+async def error_handler(update, ctx: ContextTypes.DEFAULT_TYPE):
+    logging.error(f"error while handling update {update}: {ctx.error}")
+    stop()
+
+
+def setup_metrics():
+    key = metrics.label_key
+    metrics.CHATS.collect = lambda: {(): len(db.subscriber())}
+    metrics.UIDS.collect = lambda: {(): len(owned_uids())}
+    metrics.QUEUE_DEPTH.collect = lambda: {
+        key({"queue": "sender"}): sender.qsize(),
+        key({"queue": "outbox"}): outbox.pending(),
+        key({"queue": "poll_overdue"}): len([t for t in poller.due().values() if t < time.time()]),
+    }
+    metrics.RESPONSE_CACHE.collect = lambda: {
+        key({"endpoint": endpoint, "result": result}): n
+        for endpoint, stats in fetcher.cache_stats().items() for result, n in stats.items()
+    }
+    metrics.REQUEST_RATE.collect = lambda: {(): budget.rate}
+    if live_stream is not None:
+        metrics.LIVE_STREAM.collect = lambda: {key({"state": k}): v for k, v in live_stream.stats().items()}
+
+
+async def start_updater():
+    """
+    receive updates with a webhook if it's configured, long polling otherwise
+    or if the webhook can't be set up
+    """
+    if WEBHOOK_URL is not None:
+        try:
+            await application.updater.start_webhook(
+                listen=WEBHOOK_LISTEN,
+                port=WEBHOOK_PORT,
+                url_path=urlparse(WEBHOOK_URL).path,
+                webhook_url=WEBHOOK_URL,
+                secret_token=webhook_secret,
+                bootstrap_retries=3,
+            )
+            logging.info(f"receive telegram updates on {WEBHOOK_LISTEN}:{WEBHOOK_PORT} for {WEBHOOK_URL}")
+            return
+        except Exception as e:
+            logging.error(f"failed to start webhook: {e}, fallback to polling")
+    logging.info("start polling telegram messages")
+    # this also removes the webhook if there's one
+    await application.updater.start_polling()
+
+
+async def run():
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM, signal.SIGABRT):
+        loop.add_signal_handler(sig, stop)
+    debugger.install(loop)
+
+    async with application:
+        await application.start()
+        sender.start()
+        outbox_task = asyncio.create_task(outbox.run(stop_event))
+        if shard is None:
+            await start_updater()
+            shard_task = asyncio.sleep(0)
         else:
-            logging.debug(f"long sleep {t}")
-            if event.wait(t):
-                # `wait` return true if event is set
-                return
+            logging.info(f"start worker {shard.worker}")
+            # uids and telegram updates are taken once the leases are acquired
+            shard_task = asyncio.create_task(shard.run(stop_event))
+        # fetching dynamics doesn't need room ids, the first cycle doesn't wait for them
+        warm_task = asyncio.create_task(warm_up())
+        logging.info("start fetch loop")
+        poll_task = asyncio.create_task(poller.run(stop_event))
+        live_task = asyncio.create_task(live_loop())
+        metrics_server = None
+        if METRICS_PORT is not None:
+            setup_metrics()
+            metrics_server = await metrics.serve(METRICS_LISTEN, METRICS_PORT)
+        if live_stream is not None:
+            logging.info("start live stream")
+            stream_task = asyncio.create_task(live_stream.run(owned_uids(), stop_event))
+        else:
+            stream_task = asyncio.sleep(0)
+        logging.info("bot is now running")
+        await stop_event.wait()
+        logging.info("wait for fetch loop")
+        warm_task.cancel()
+        await asyncio.gather(warm_task, return_exceptions=True)
+        await asyncio.gather(poll_task, live_task, stream_task, shard_task)
+        await coalescer.close()
+        await outbox_task
+        await sender.stop()
+        if shard is not None:
+            await shard.close()
+        if metrics_server is not None:
+            metrics_server.close()
+        if application.updater.running:
+            await application.updater.stop()
+        await application.stop()
+    await fetcher.close()
+    if store is not None:
+        await store.close()
+    media.save()
+    db.close()
 
 
 if __name__ == '__main__':
+    listener = log.setup_logging(LOG_LEVEL, LOG_FILE, LOG_FORMAT)
+    # thread tracebacks until the event loop is running
     debug.handle_sigusr1()
+    debugger = debug.Debugger(DEBUG_DIR)
 
-    event = threading.Event()
+    stop_event = asyncio.Event()
+    live_checked = asyncio.Event()
 
-    chats = set()
     tokens = set()
+    # uid -> dynamic_id of the last sent dynamic
     fetch_record = dict()
     live_record = dict()
 
-    fetcher = Bilibili()
-    now = int(time.time())
+    # every request to bilibili takes a token, this is the global request budget
+    budget = TokenBucket(BILIBILI_RATE, BILIBILI_BURST)
+    fetcher = Bilibili(
+        timeout=BILIBILI_TIMEOUT,
+        max_connections=BILIBILI_MAX_CONNECTIONS,
+        vc_api=BILIBILI_VC_API,
+        live_api=BILIBILI_LIVE_API,
+        budget=budget,
+        controller=RateController(budget, BILIBILI_MIN_RATE, BILIBILI_MAX_RATE),
+        throttle_backoff=THROTTLE_BACKOFF,
+        throttle_max_backoff=THROTTLE_MAX_BACKOFF,
+        room_ttl=ROOM_ID_TTL,
+        no_room_ttl=NO_ROOM_TTL,
+        # `db` is opened below, rooms are looked up after that
+        on_room=lambda uid, room_id, t: db.set_room(uid, room_id, t),
+    )
     for uid in UID_LIST:
-        fetch_record[uid] = now
         live_record[uid] = LiveStatus.PREPARE
-
-    db = Database("data.json")
-    for s in db.subscriber():
-        chats.add(s)
+    batch_live_ok = True
+
+    if SHARD_WORKER is not None and DB_BACKEND != "sqlite":
+        raise ValueError("workers can only share the sqlite database backend")
+
+    poller = Poller(
+        # a worker polls the uids it has leases of
+        UID_LIST if SHARD_WORKER is None else [],
+        poll_uid,
+        lambda uid: live_record[uid] == LiveStatus.LIVE,
+        interval=FETCH_INTERVAL,
+        min_interval=FETCH_MIN_INTERVAL,
+        max_interval=FETCH_MAX_INTERVAL,
+        concurrency=FETCH_CONCURRENCY,
+    )
+
+    sender = Sender(
+        global_rate=SEND_GLOBAL_RATE,
+        group_rate=SEND_GROUP_RATE / 60,
+        private_rate=SEND_PRIVATE_RATE,
+        workers=SEND_WORKERS,
+        max_queue=SEND_QUEUE_SIZE,
+    )
+
+    store = None
+    if MEDIA_DIR is not None:
+        store = MediaStore(
+            MEDIA_DIR,
+            max_bytes=MEDIA_DIR_SIZE * 1024 * 1024,
+            concurrency=MEDIA_DOWNLOAD_CONCURRENCY,
+            max_side=MEDIA_MAX_SIDE,
+        )
+    media = MediaCache(max_size=MEDIA_CACHE_SIZE, file=MEDIA_CACHE_FILE, store=store)
+
+    db = open_database(
+        DB_BACKEND,
+        DB_FILE,
+        flush_interval=DB_FLUSH_INTERVAL,
+        compact_threshold=DB_COMPACT_THRESHOLD,
+        default_uids=UID_LIST,
+        outbox_table="outbox" if SHARD_WORKER is None else outbox_table(SHARD_WORKER),
+    )
     for uid in db.live():
         live_record[uid] = LiveStatus.LIVE
+    for uid, dynamic_id in db.cursor().items():
+        fetch_record[uid] = dynamic_id
+    fetcher.set_rooms(db.room())
+    live_stream = None
+    if LIVE_STREAM:
+        if live_stream_available():
+            live_stream = LiveStream(fetcher, on_live_event, url=LIVE_STREAM_URL)
+        else:
+            logging.warning("websockets is not installed, live status is polled")
+    shard = None
+    if SHARD_WORKER is not None:
+        shard = Shard(
+            db,
+            DB_FILE,
+            SHARD_WORKER,
+            UID_LIST,
+            acquire_uids,
+            release_uids,
+            lead,
+            lease_ttl=SHARD_LEASE_TTL,
+            claim_ttl=SHARD_CLAIM_TTL,
+        )
+    coalescer = Coalescer(COALESCE_WINDOW, send_digest)
+    outbox = Outbox(
+        db,
+        sender,
+        send_payloads,
+        lambda chat_id: db.del_subscribe(chat_id),
+        max_attempts=OUTBOX_MAX_ATTEMPTS,
+        backoff=OUTBOX_BACKOFF,
+    )
+
+    # telegram sends this in every webhook request, requests without it are rejected
+    webhook_secret = WEBHOOK_SECRET or secrets.token_urlsafe(32)
+    # updates are handled concurrently on the event loop, this replaces `run_async`
+    application = Application.builder() \
+        .token(TOKEN) \
+        .base_url(TELEGRAM_API_URL) \
+        .concurrent_updates(True) \
+        .connection_pool_size(TELEGRAM_POOL_SIZE) \
+        .build()
+    application.add_handler(CommandHandler("start", cmd_start, filters=filters.ChatType.PRIVATE))
+    application.add_handler(CommandHandler("register", cmd_register))
+    application.add_handler(CommandHandler("unregister", cmd_unregister))
+    application.add_handler(CommandHandler("token", cmd_token, filters=filters.ChatType.PRIVATE))
+    application.add_error_handler(error_handler)
 
-    updater = Updater(TOKEN, use_context=True)
-    dispatcher = updater.dispatcher
-    dispatcher.add_handler(CommandHandler("start", cmd_start, filters=Filters.private))
-    dispatcher.add_handler(CommandHandler("register", cmd_register))
-    dispatcher.add_handler(CommandHandler("unregister", cmd_unregister))
-    dispatcher.add_handler(CommandHandler("token", cmd_token, filters=Filters.private))
-
-
-    def stop():
-        logging.info("bot exiting")
-        updater.stop()
-        event.set()
-
-
-    def error_handler(update, ctx):
-        stop()
-
-
-    dispatcher.add_error_handler(error_handler)
-    t = threading.Thread(target=fetch_loop)
-
-    rotate_handler = TimedRotatingFileHandler(LOG_FILE, when="d")
-    logging.basicConfig(format='%(asctime)s %(message)s', level=LOG_LEVEL, handlers=[rotate_handler])
-    logging.info("start fetch loop")
-    t.start()
-    logging.info("start polling telegram messages")
-    updater.start_polling()
-    logging.info("bot is now running")
-
-    from signal import SIGABRT, SIGINT, SIGTERM, signal
-
-    for sig in (SIGINT, SIGTERM, SIGABRT):
-        signal(sig, lambda signum, frame: stop())
-
-    logging.info("join async thread")
     try:
-        t.join()
+        asyncio.run(run())
     except Exception as e:
-        logging.warning(f"async thread exit with err: {e}")
-        stop()
+        logging.warning(f"event loop exit with err: {e}")
+        listener.stop()
         # exit with non-zero code can tell systemd to restart this
         exit(1)
     logging.info("bot exited")
+    listener.stop()
@@ -0,0 +1,305 @@
+import asyncio
+import hashlib
+import io
+import json
+import logging
+import os
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Union
+
+import httpx
+from telegram import InputFile, Message
+
+from utils import async_wrap
+
+try:
+    # optional, recompress oversized pictures locally instead of asking bilibili for a smaller one
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# telegram limit of an uploaded photo
+MAX_PHOTO_BYTES = 10 * 1024 * 1024
+# telegram limit of a file uploaded by a bot
+MAX_FILE_BYTES = 50 * 1024 * 1024
+
+
+def file_id_of(msg: Message) -> Optional[str]:
+    if msg.photo:
+        # the last one is the biggest size
+        return msg.photo[-1].file_id
+    if msg.animation:
+        return msg.animation.file_id
+    if msg.document:
+        return msg.document.file_id
+    return None
+
+
+def is_animation(url: str) -> bool:
+    return url.endswith(".gif")
+
+
+def resized_url(url: str, max_side: int) -> str:
+    """
+    bilibili image servers scale pictures with a suffix, the ratio is kept
+    """
+    return f"{url}@{max_side}w_{max_side}h_1e.jpg"
+
+
+def shrink(data: bytes, max_side: int) -> Optional[bytes]:
+    """
+    downscale and recompress a picture to jpeg, None if it can't be decoded
+    """
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            img.thumbnail((max_side, max_side))
+            if img.mode != "RGB":
+                img = img.convert("RGB")
+            out = io.BytesIO()
+            img.save(out, "JPEG", quality=85, optimize=True)
+    except Exception as e:
+        logging.warning(f"failed to shrink picture: {e}")
+        return None
+    return out.getvalue()
+
+
+def needs_shrink(data: bytes, max_side: int) -> bool:
+    if len(data) > MAX_PHOTO_BYTES:
+        return True
+    if Image is None:
+        return False
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            return max(img.size) > max_side
+    except Exception:
+        return False
+
+
+def read_file(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def write_file(path: str, data: bytes):
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+class MediaStore:
+    """
+    local copies of pictures to upload, so telegram never fetches the big originals itself
+
+    a picture is downloaded once into a size-bounded directory, oversized ones
+    are downscaled with Pillow if it's installed or fetched again with the resize
+    suffix of bilibili, gifs are kept as they are
+    """
+
+    def __init__(self, path: str, max_bytes: int = 512 * 1024 * 1024, concurrency: int = 4,
+                 max_side: int = 2560, timeout: float = 30):
+        self.__path = path
+        self.__max_bytes = max_bytes
+        self.__max_side = max_side
+        self.__semaphore = asyncio.Semaphore(concurrency)
+        self.__downloading: Dict[str, asyncio.Future] = {}
+        # file name -> size, least recently used first
+        self.__files = OrderedDict()
+        self.__size = 0
+        self.__client = httpx.AsyncClient(
+            timeout=timeout,
+            follow_redirects=True,
+            headers={"User-Agent": "Mozilla/5.0", "Referer": "https://www.bilibili.com/"},
+        )
+        self.__read = async_wrap(read_file)
+        self.__write = async_wrap(write_file)
+        self.__shrink = async_wrap(shrink)
+        os.makedirs(path, exist_ok=True)
+        self.__scan()
+
+    def __scan(self):
+        entries = []
+        for entry in os.scandir(self.__path):
+            if entry.name.endswith(".tmp"):
+                os.remove(entry.path)
+                continue
+            stat = entry.stat()
+            entries.append((stat.st_mtime, entry.name, stat.st_size))
+        for _, name, size in sorted(entries):
+            self.__files[name] = size
+            self.__size += size
+        self.__evict()
+
+    def __evict(self):
+        while self.__size > self.__max_bytes and len(self.__files) != 0:
+            name, size = self.__files.popitem(last=False)
+            self.__size -= size
+            try:
+                os.remove(os.path.join(self.__path, name))
+            except FileNotFoundError:
+                pass
+
+    @staticmethod
+    def name_of(url: str) -> str:
+        ext = os.path.splitext(url.split("?")[0])[1] or ".jpg"
+        return hashlib.sha1(url.encode()).hexdigest() + ext
+
+    async def close(self):
+        await self.__client.aclose()
+
+    def stats(self) -> Dict[str, int]:
+        return {"files": len(self.__files), "bytes": self.__size}
+
+    async def get(self, url: str) -> Optional[bytes]:
+        """
+        the picture of `url` ready to upload, None if it can't be downloaded
+        """
+        name = self.name_of(url)
+        if name in self.__files:
+            self.__files.move_to_end(name)
+            try:
+                return await self.__read(os.path.join(self.__path, name))
+            except OSError:
+                self.__size -= self.__files.pop(name)
+        # concurrent sends of the same picture share one download
+        if url in self.__downloading:
+            return await asyncio.shield(self.__downloading[url])
+        f = asyncio.get_running_loop().create_future()
+        self.__downloading[url] = f
+        try:
+            data = await self.__prepare(url)
+        except asyncio.CancelledError:
+            f.cancel()
+            raise
+        except Exception as e:
+            logging.warning(f"failed to download {url}: {e}")
+            data = None
+        finally:
+            del self.__downloading[url]
+        f.set_result(data)
+        if data is None:
+            return None
+        try:
+            await self.__write(os.path.join(self.__path, name), data)
+        except OSError as e:
+            logging.warning(f"failed to save {url}: {e}")
+            return data
+        self.__files[name] = len(data)
+        self.__size += len(data)
+        self.__evict()
+        return data
+
+    async def __download(self, url: str, limit: int) -> Optional[bytes]:
+        """
+        None if it's larger than `limit`, the body is not read then
+        """
+        async with self.__semaphore:
+            async with self.__client.stream("GET", url) as resp:
+                resp.raise_for_status()
+                length = resp.headers.get("Content-Length")
+                if length is not None and int(length) > limit:
+                    return None
+                data = await resp.aread()
+        if len(data) > limit:
+            return None
+        return data
+
+    async def __prepare(self, url: str) -> Optional[bytes]:
+        if is_animation(url):
+            return await self.__download(url, MAX_FILE_BYTES)
+        if Image is None:
+            data = await self.__download(url, MAX_PHOTO_BYTES)
+            if data is None:
+                logging.info(f"{url} is too large, download a smaller one")
+                data = await self.__download(resized_url(url, self.__max_side), MAX_PHOTO_BYTES)
+            return data
+        data = await self.__download(url, MAX_FILE_BYTES)
+        if data is not None and needs_shrink(data, self.__max_side):
+            data = await self.__shrink(data, self.__max_side)
+        if data is None or len(data) > MAX_PHOTO_BYTES:
+            data = await self.__download(resized_url(url, self.__max_side), MAX_PHOTO_BYTES)
+        return data
+
+
+class MediaCache:
+    """
+    source url -> telegram file_id, so a picture is uploaded once and reused for every other chat
+
+    with a `store` pictures which are never uploaded are sent as local copies
+    """
+
+    def __init__(self, max_size: int = 1024, file: str = None, store: MediaStore = None):
+        self.__max_size = max_size
+        self.__file = file
+        self.__store = store
+        self.__cache = OrderedDict()
+        if file is not None:
+            self.__load()
+
+    def __load(self):
+        try:
+            with open(self.__file) as f:
+                data = f.read()
+        except FileNotFoundError:
+            logging.info("no old media cache file")
+            return
+        try:
+            for url, file_id in json.loads(data):
+                self.put(url, file_id)
+        except (json.JSONDecodeError, ValueError):
+            logging.warning(f"failed to load {self.__file}")
+
+    def save(self):
+        if self.__file is None:
+            return
+        with open(self.__file, "w") as f:
+            f.write(json.dumps(list(self.__cache.items())))
+
+    def __len__(self):
+        return len(self.__cache)
+
+    def get(self, url: str) -> str:
+        """
+        returns the cached file_id, or the url itself if it's never uploaded
+        """
+        file_id = self.__cache.get(url)
+        if file_id is None:
+            return url
+        self.__cache.move_to_end(url)
+        return file_id
+
+    async def resolve(self, url: str, attach: bool = False) -> Union[str, InputFile]:
+        """
+        the cached file_id, a local copy to upload, or the url itself if there's neither,
+        a local copy in an album must be `attach`ed or telegram gets no media for it
+        """
+        file_id = self.get(url)
+        if file_id != url or self.__store is None:
+            return file_id
+        data = await self.__store.get(url)
+        if data is None:
+            return url
+        return InputFile(data, filename=MediaStore.name_of(url), attach=attach)
+
+    async def resolve_all(self, urls: Iterable[str], attach: bool = False) -> List[Union[str, InputFile]]:
+        return list(await asyncio.gather(*[self.resolve(url, attach) for url in urls]))
+
+    def has_all(self, urls: Iterable[str]) -> bool:
+        return all(url in self.__cache for url in urls)
+
+    def put(self, url: str, file_id: str):
+        self.__cache[url] = file_id
+        self.__cache.move_to_end(url)
+        while len(self.__cache) > self.__max_size:
+            self.__cache.popitem(last=False)
+
+    def remember(self, urls: List[str], messages: List[Message]):
+        """
+        record file_ids of `messages`, which are sent with `urls` in the same order
+        """
+        for url, msg in zip(urls, messages):
+            if url in self.__cache:
+                continue
+            file_id = file_id_of(msg)
+            if file_id is not None:
+                self.put(url, file_id)
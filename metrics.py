@@ -0,0 +1,187 @@
+import asyncio
+import logging
+import math
+from typing import Callable, Dict, List, Optional, Tuple
+
+# seconds, for requests and sends
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+# seconds, from a post to its delivery
+LAG_BUCKETS = (1, 5, 10, 15, 30, 60, 120, 300, 600, 1800, 3600)
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+
+def label_key(labels: Dict[str, object]) -> LabelKey:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def format_labels(key: LabelKey, extra: Tuple[str, str] = None) -> str:
+    pairs = list(key)
+    if extra is not None:
+        pairs.append(extra)
+    if len(pairs) == 0:
+        return ""
+    escaped = [(k, v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for k, v in pairs]
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+
+def format_value(v: float) -> str:
+    if math.isinf(v):
+        return "+Inf" if v > 0 else "-Inf"
+    if v == int(v):
+        return str(int(v))
+    return repr(v)
+
+
+class Metric:
+    type = ""
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        REGISTRY.append(self)
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        return "\n".join(lines + self.samples())
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, help: str):
+        super().__init__(name, help)
+        self.__values: Dict[LabelKey, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = label_key(labels)
+        self.__values[key] = self.__values.get(key, 0) + amount
+
+    def samples(self) -> List[str]:
+        return [f"{self.name}{format_labels(k)} {format_value(v)}" for k, v in self.__values.items()]
+
+
+class Gauge(Metric):
+    """
+    a value which is set, or read from `collect` when it's scraped
+    """
+    type = "gauge"
+
+    def __init__(self, name: str, help: str, collect: Callable[[], Dict[LabelKey, float]] = None):
+        super().__init__(name, help)
+        self.__values: Dict[LabelKey, float] = {}
+        self.collect = collect
+
+    def set(self, value: float, **labels):
+        self.__values[label_key(labels)] = value
+
+    def samples(self) -> List[str]:
+        values = dict(self.__values)
+        if self.collect is not None:
+            try:
+                values.update(self.collect())
+            except Exception as e:
+                logging.warning(f"failed to collect {self.name}: {e}")
+        return [f"{self.name}{format_labels(k)} {format_value(v)}" for k, v in values.items()]
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        super().__init__(name, help)
+        self.__buckets = tuple(buckets) + (math.inf,)
+        # label key -> (bucket counts, sum)
+        self.__values: Dict[LabelKey, Tuple[List[int], float]] = {}
+
+    def observe(self, value: float, **labels):
+        key = label_key(labels)
+        if key not in self.__values:
+            self.__values[key] = ([0] * len(self.__buckets), 0.0)
+        counts, total = self.__values[key]
+        for i, bound in enumerate(self.__buckets):
+            if value <= bound:
+                counts[i] += 1
+                break
+        self.__values[key] = (counts, total + value)
+
+    def samples(self) -> List[str]:
+        lines = []
+        for key, (counts, total) in self.__values.items():
+            cumulative = 0
+            for bound, n in zip(self.__buckets, counts):
+                cumulative += n
+                le = format_labels(key, ("le", format_value(bound)))
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(key)} {format_value(total)}")
+            lines.append(f"{self.name}_count{format_labels(key)} {cumulative}")
+        return lines
+
+
+REGISTRY: List[Metric] = []
+
+BILIBILI_LATENCY = Histogram("bilibili_request_seconds", "latency of bilibili api requests")
+BILIBILI_THROTTLED = Counter("bilibili_throttled_total", "throttled bilibili api requests")
+BILIBILI_ERRORS = Counter("bilibili_errors_total", "failed bilibili api requests")
+PARSE_CARD = Histogram("parse_card_seconds", "time to parse a dynamic card",
+                       (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05))
+POLL_DURATION = Histogram("poll_seconds", "time to poll a uid, including sending new dynamics", LAG_BUCKETS)
+NEW_DYNAMICS = Counter("new_dynamics_total", "new dynamics found")
+LIVE_CHANGES = Counter("live_changes_total", "live status changes")
+SEND_LATENCY = Histogram("telegram_send_seconds", "latency of sending to a chat")
+SENDS = Counter("telegram_sends_total", "messages sent to telegram")
+SEND_FAILURES = Counter("telegram_send_failures_total", "failed sends to telegram")
+TELEGRAM_THROTTLED = Counter("telegram_throttled_total", "flood control responses of telegram")
+DELIVERY_LAG = Histogram("delivery_lag_seconds", "time from a post or live start to its delivery to a chat",
+                         LAG_BUCKETS)
+# set up by the caller, they read the state when scraped
+CHATS = Gauge("chats", "subscribed chats")
+UIDS = Gauge("uids", "watched uids")
+QUEUE_DEPTH = Gauge("queue_depth", "pending jobs per queue")
+RESPONSE_CACHE = Gauge("response_cache_requests", "response cache hits and misses per endpoint")
+REQUEST_RATE = Gauge("bilibili_request_rate", "allowed bilibili requests per second")
+LIVE_STREAM = Gauge("live_stream_rooms", "rooms by live stream state")
+
+
+def render() -> str:
+    return "\n".join(m.render() for m in REGISTRY) + "\n"
+
+
+async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        line = await asyncio.wait_for(reader.readline(), 10)
+        # skip the headers
+        while (await asyncio.wait_for(reader.readline(), 10)) not in (b"\r\n", b"\n", b""):
+            pass
+        parts = line.decode(errors="replace").split()
+        if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+            status, body = "200 OK", render().encode()
+        else:
+            status, body = "404 Not Found", b"not found\n"
+        writer.write(
+            f"HTTP/1.1 {status}\r\n"
+            f"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError) as e:
+        logging.debug(f"metrics request: {e}")
+    finally:
+        writer.close()
+
+
+async def serve(host: str, port: int) -> Optional[asyncio.AbstractServer]:
+    """
+    serve the metrics in prometheus text format on `/metrics`
+    """
+    try:
+        server = await asyncio.start_server(handle, host, port)
+    except OSError as e:
+        logging.error(f"failed to serve metrics on {host}:{port}: {e}")
+        return None
+    logging.info(f"serve metrics on {host}:{port}")
+    return server
@@ -0,0 +1,159 @@
+import asyncio
+import logging
+import time
+import uuid
+from typing import Awaitable, Callable, List
+
+import telegram
+
+from db import Database
+from render import Payload
+from sender import Sender, PRIORITY_RETRY
+
+
+def is_chat_gone(e: Exception) -> bool:
+    """
+    the bot is blocked, kicked or the chat is deleted, sending to it again is useless
+    """
+    if isinstance(e, telegram.error.Forbidden):
+        return True
+    if isinstance(e, telegram.error.BadRequest) and "chat not found" in e.message.lower():
+        return True
+    return False
+
+
+def is_retryable(e: Exception) -> bool:
+    """
+    the send may succeed later, a bad request like a too long message or
+    a wrong file identifier never does
+    """
+    if isinstance(e, telegram.error.BadRequest):
+        return False
+    # TimedOut is a NetworkError
+    return isinstance(e, (telegram.error.NetworkError, telegram.error.RetryAfter))
+
+
+class Outbox:
+    """
+    durable deliveries of payloads to chats
+
+    every delivery is recorded in the `outbox` table before it's sent and
+    removed once telegram accepts it, a delivery failed by the network or
+    flood control is retried in the background with exponential backoff,
+    one rejected by telegram is dropped, pending deliveries are picked up
+    again after a restart
+
+    `send` reports every payload sent through its third argument, a retry
+    starts from the first payload not sent yet
+    """
+
+    def __init__(self, db: Database, sender: Sender,
+                 send: Callable[[int, List[Payload], Callable[[int], None]], Awaitable],
+                 unsubscribe: Callable[[int], None], max_attempts: int = 8, backoff: float = 30,
+                 interval: float = 10):
+        self.__db = db
+        self.__sender = sender
+        self.__send = send
+        self.__unsubscribe = unsubscribe
+        self.__max_attempts = max_attempts
+        self.__backoff = backoff
+        self.__interval = interval
+        self.__inflight = set()
+        self.__tasks = set()
+
+    def pending(self) -> int:
+        return len(self.__db.outbox())
+
+    async def deliver(self, chat_id: int, payloads: List[Payload], priority: int, label: str = "",
+                      claims: List[str] = ()) -> bool:
+        """
+        record and send `payloads` to `chat_id`, returns True if it's sent now
+
+        `label` describes the payloads in logs, `claims` are the keys `chat_id`
+        is claimed with for them, see shard.Shard.claim
+        """
+        key = f"{chat_id}_{uuid.uuid4().hex}"
+        record = {
+            "chat_id": chat_id,
+            "payloads": [p.to_dict() for p in payloads],
+            "attempts": 0,
+            "next_at": 0,
+            # payloads sent already
+            "sent": 0,
+            "label": label,
+            "claims": list(claims),
+        }
+        self.__db.add_outbox(key, record)
+        return await self.__attempt(key, record, payloads, priority)
+
+    async def __attempt(self, key: str, record: dict, payloads: List[Payload], priority: int) -> bool:
+        chat_id = record["chat_id"]
+        start = record.get("sent", 0)
+        payloads = payloads[start:]
+        cost = sum(p.cost for p in payloads)
+        sent = start
+
+        def progress(n: int):
+            nonlocal sent
+            sent = start + n
+
+        self.__inflight.add(key)
+        try:
+            f = await self.__sender.submit(chat_id, lambda: self.__send(chat_id, payloads, progress), priority, cost)
+            await f
+        except Exception as e:
+            self.__failed(key, dict(record, sent=sent), e)
+            return False
+        finally:
+            self.__inflight.discard(key)
+        self.__db.del_outbox(key)
+        return True
+
+    def __failed(self, key: str, record: dict, e: Exception):
+        chat_id = record["chat_id"]
+        if is_chat_gone(e):
+            logging.warning("chat %d is gone (%s), unsubscribe it", chat_id, e, extra={"chat_id": chat_id})
+            self.__unsubscribe(chat_id)
+            for k, r in self.__db.outbox().items():
+                if r["chat_id"] == chat_id:
+                    self.__db.del_outbox(k)
+            return
+        attempts = record["attempts"] + 1
+        if not is_retryable(e):
+            # retrying takes the shared send budget from every other delivery
+            logging.error("drop %s to %d, it can't be sent: %s", record.get("label"), chat_id, e,
+                          extra={"chat_id": chat_id, "item": record.get("label"), "attempts": attempts})
+            self.__db.del_outbox(key)
+            return
+        if attempts >= self.__max_attempts:
+            logging.error("give up sending %s to %d after %d attempts: %s", record.get("label"), chat_id, attempts, e,
+                          extra={"chat_id": chat_id, "item": record.get("label"), "attempts": attempts})
+            self.__db.del_outbox(key)
+            return
+        t = self.__backoff * 2 ** (attempts - 1)
+        logging.warning("failed to send %s to %d: %s, retry in %.0fs", record.get("label"), chat_id, e, t,
+                        extra={"chat_id": chat_id, "item": record.get("label"), "attempts": attempts})
+        record = dict(record, attempts=attempts, next_at=time.time() + t)
+        self.__db.add_outbox(key, record)
+
+    def __retry_due(self):
+        now = time.time()
+        for key, record in self.__db.outbox().items():
+            if key in self.__inflight or record["next_at"] > now:
+                continue
+            payloads = [Payload.from_dict(p) for p in record["payloads"]]
+            # retries go after new posts, a slow chat doesn't hold up the others
+            task = asyncio.create_task(self.__attempt(key, record, payloads, PRIORITY_RETRY))
+            self.__tasks.add(task)
+            task.add_done_callback(self.__tasks.discard)
+
+    async def run(self, stop: asyncio.Event):
+        while not stop.is_set():
+            self.__retry_due()
+            try:
+                await asyncio.wait_for(stop.wait(), self.__interval)
+            except asyncio.TimeoutError:
+                pass
+        for task in self.__tasks:
+            task.cancel()
+        await asyncio.gather(*self.__tasks, return_exceptions=True)
@@ -0,0 +1,147 @@
+import asyncio
+import heapq
+import logging
+import random
+import time
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+
+# idle interval grows by this factor after each poll without new content
+BACKOFF = 1.5
+# weight of the old history when recording new activity, makes old habits fade
+DECAY = 0.98
+
+
+class UidState:
+    def __init__(self, uid: int, interval: float):
+        self.uid = uid
+        self.interval = interval
+        # when it's polled next, None while it's being polled
+        self.due: Optional[float] = None
+        # activity count per hour of day
+        self.hours = [0.0] * 24
+
+    def record(self, t: int):
+        self.hours = [h * DECAY for h in self.hours]
+        self.hours[time.localtime(t).tm_hour] += 1
+
+    def activity(self, now: float) -> float:
+        """
+        how usual it is for this uid to be active around `now`, from 0 to 1
+        """
+        top = max(self.hours)
+        if top == 0:
+            return 0
+        hour = time.localtime(now).tm_hour
+        # the hour before is counted too, a post or live usually comes a little late
+        around = max(self.hours[hour], self.hours[(hour - 1) % 24], self.hours[(hour + 1) % 24])
+        return around / top
+
+
+class Poller:
+    """
+    polls uids by their next due time instead of a fixed round
+
+    up to `concurrency` uids are polled at the same time, the interval of a uid shrinks to `min_interval`
+    while it's live, after new content and around the hours it's usually
+    active, and grows up to `max_interval` while it's idle, uids can be
+    added and removed while it's running
+    """
+
+    def __init__(self, uids: Iterable[int], poll: Callable[[int], Awaitable[int]], is_live: Callable[[int], bool],
+                 interval: float = 60, min_interval: float = 15, max_interval: float = 600,
+                 concurrency: int = 4):
+        self.__poll = poll
+        self.__is_live = is_live
+        self.__interval = interval
+        self.__min_interval = min_interval
+        self.__max_interval = max_interval
+        self.__semaphore = asyncio.Semaphore(concurrency)
+        self.__state: Dict[int, UidState] = {}
+        self.__concurrency = concurrency
+        self.__heap: List[Tuple[float, int]] = []
+        self.__wakeup = asyncio.Event()
+        self.add(uids)
+
+    def __schedule(self, state: UidState, due: float):
+        state.due = due
+        heapq.heappush(self.__heap, (due, state.uid))
+
+    def add(self, uids: Iterable[int]):
+        now = time.time()
+        new = [uid for uid in uids if uid not in self.__state]
+        for i, uid in enumerate(new):
+            self.__state[uid] = UidState(uid, self.__interval)
+            # spread the first round so it doesn't hit bilibili in a burst
+            self.__schedule(self.__state[uid], now + i * self.__min_interval / self.__concurrency)
+        self.__wakeup.set()
+
+    def remove(self, uids: Iterable[int]):
+        """
+        stop polling `uids`, a poll already started still finishes
+        """
+        for uid in uids:
+            self.__state.pop(uid, None)
+
+    def record_activity(self, uid: int, t: int):
+        if uid in self.__state:
+            self.__state[uid].record(t)
+
+    def next_interval(self, uid: int, new: int) -> float:
+        state = self.__state[uid]
+        if new != 0:
+            # posts often come in bursts
+            state.interval = self.__min_interval
+        else:
+            state.interval = min(max(state.interval, self.__interval) * BACKOFF, self.__max_interval)
+        if self.__is_live(uid):
+            t = self.__min_interval
+        else:
+            a = state.activity(time.time())
+            t = state.interval * (1 - a) + self.__min_interval * a
+        t = min(max(t, self.__min_interval), self.__max_interval)
+        # jitter avoids polling many uids in lockstep
+        return t * random.uniform(0.9, 1.1)
+
+    def due(self) -> Dict[int, float]:
+        return {uid: state.due for uid, state in self.__state.items() if state.due is not None}
+
+    async def __run_one(self, state: UidState):
+        uid = state.uid
+        new = 0
+        try:
+            async with self.__semaphore:
+                new = await self.__poll(uid)
+        except Exception as e:
+            logging.error("poll %d: %s", uid, e, extra={"uid": uid})
+        finally:
+            # unless it's removed while being polled
+            if self.__state.get(uid) is state:
+                t = self.next_interval(uid, new)
+                logging.debug("next poll for %d in %.1fs", uid, t)
+                self.__schedule(state, time.time() + t)
+                self.__wakeup.set()
+
+    async def run(self, stop: asyncio.Event):
+        tasks = set()
+        while not stop.is_set():
+            if len(self.__heap) == 0:
+                t = self.__max_interval
+            else:
+                t = self.__heap[0][0] - time.time()
+            if t > 0:
+                self.__wakeup.clear()
+                waiters = [asyncio.create_task(stop.wait()), asyncio.create_task(self.__wakeup.wait())]
+                await asyncio.wait(waiters, timeout=t, return_when=asyncio.FIRST_COMPLETED)
+                for w in waiters:
+                    w.cancel()
+                continue
+            due, uid = heapq.heappop(self.__heap)
+            state = self.__state.get(uid)
+            # left behind by a removed uid
+            if state is None or state.due != due:
+                continue
+            state.due = None
+            task = asyncio.create_task(self.__run_one(state))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        await asyncio.gather(*tasks, return_exceptions=True)
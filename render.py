@@ -0,0 +1,254 @@
+from dataclasses import dataclass, field
+from typing import List, Tuple
+
+from telegram import Bot, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto
+
+from bilibili.model import Dynamic, DynamicType, Live
+from media import MediaCache
+from utils import format_time
+
+# telegram limit of a media caption
+MAX_CAPTION = 1024
+# telegram limit of media in an album
+MAX_ALBUM = 10
+# telegram limit of a text message
+MAX_MESSAGE = 4096
+
+SEND_MESSAGE = "send_message"
+SEND_PHOTO = "send_photo"
+SEND_ANIMATION = "send_animation"
+SEND_MEDIA_GROUP = "send_media_group"
+
+
+def origin_link(content):
+    return InlineKeyboardMarkup([[InlineKeyboardButton(text="link", url=content)]])
+
+
+def room_link(room_id):
+    return f"https://live.bilibili.com/{room_id}"
+
+
+@dataclass(frozen=True)
+class Payload:
+    """
+    a rendered outbound message, the same for every chat
+
+    `media` holds the source urls, they are swapped for cached
+    file_ids or local copies when sending
+    """
+    method: str
+    text: str
+    link: str = ""
+    media: Tuple[str, ...] = ()
+    reply_markup: InlineKeyboardMarkup = field(default=None, compare=False, repr=False)
+
+    def __post_init__(self):
+        if self.link and self.method != SEND_MEDIA_GROUP:
+            object.__setattr__(self, "reply_markup", origin_link(self.link))
+
+    @property
+    def cost(self) -> int:
+        """
+        number of telegram messages this payload produces
+        """
+        if self.method == SEND_MEDIA_GROUP:
+            return len(self.media)
+        return 1
+
+    def to_dict(self) -> dict:
+        return {"method": self.method, "text": self.text, "link": self.link, "media": list(self.media)}
+
+    @classmethod
+    def from_dict(cls, d: dict) -> "Payload":
+        return cls(d["method"], d["text"], d["link"], tuple(d["media"]))
+
+    async def send(self, bot: Bot, chat_id: int, cache: MediaCache):
+        if self.method == SEND_MESSAGE:
+            return await bot.send_message(chat_id=chat_id, text=self.text, reply_markup=self.reply_markup)
+        # pictures of an album are downloaded concurrently
+        files = await cache.resolve_all(self.media, attach=self.method == SEND_MEDIA_GROUP)
+        if self.method == SEND_MEDIA_GROUP:
+            medias = [InputMediaPhoto(files[0], caption=self.text)]
+            medias += [InputMediaPhoto(f) for f in files[1:]]
+            msgs = await bot.send_media_group(chat_id=chat_id, media=medias)
+            cache.remember(list(self.media), msgs)
+            return msgs
+        if self.method == SEND_ANIMATION:
+            msg = await bot.send_animation(
+                chat_id=chat_id,
+                animation=files[0],
+                caption=self.text,
+                reply_markup=self.reply_markup,
+            )
+        else:
+            msg = await bot.send_photo(
+                chat_id=chat_id,
+                photo=files[0],
+                caption=self.text,
+                reply_markup=self.reply_markup,
+            )
+        cache.remember([self.media[0]], [msg])
+        return msg
+
+
+def album_chunks(photos: List[str]) -> List[List[str]]:
+    """
+    split photos into albums of at most `MAX_ALBUM`, an album needs at least 2 of them
+    """
+    chunks = [photos[i:i + MAX_ALBUM] for i in range(0, len(photos), MAX_ALBUM)]
+    if len(chunks) > 1 and len(chunks[-1]) == 1:
+        chunks[-1].insert(0, chunks[-2].pop())
+    return chunks
+
+
+def split_text(text: str, limit: int) -> List[str]:
+    """
+    split `text` into parts of at most `limit`, at a line break if there's one in the second half
+    """
+    parts = []
+    while len(text) > limit:
+        cut = text.rfind("\n", limit // 2, limit + 1)
+        if cut == -1:
+            parts.append(text[:limit])
+            text = text[limit:]
+        else:
+            parts.append(text[:cut])
+            text = text[cut + 1:]
+    parts.append(text)
+    return parts
+
+
+def render_text(text: str, link: str) -> List[Payload]:
+    """
+    text messages of at most `MAX_MESSAGE`, the last one has the link
+    """
+    parts = split_text(text, MAX_MESSAGE)
+    return [Payload(SEND_MESSAGE, part) for part in parts[:-1]] + [Payload(SEND_MESSAGE, parts[-1], link)]
+
+
+def render_media(method: str, text: str, link: str, url: str) -> List[Payload]:
+    """
+    a captioned photo or animation, a caption too long is sent as text after it
+    """
+    if len(text) <= MAX_CAPTION:
+        return [Payload(method, text, link, (url,))]
+    return [Payload(method, "", link, (url,))] + render_text(text, link)
+
+
+def render_album(text: str, link: str, photos: List[str]) -> List[Payload]:
+    """
+    a captioned album, albums can't have buttons so the link goes into the caption
+    """
+    payloads = []
+    chunks = album_chunks(photos)
+    caption = f"{text}\n{link}"
+    if len(caption) <= MAX_CAPTION:
+        for chunk in chunks[:-1]:
+            payloads.append(Payload(SEND_MEDIA_GROUP, "", media=tuple(chunk)))
+        payloads.append(Payload(SEND_MEDIA_GROUP, caption, media=tuple(chunks[-1])))
+    else:
+        # too long for a caption, send the text after the album
+        for chunk in chunks:
+            payloads.append(Payload(SEND_MEDIA_GROUP, "", media=tuple(chunk)))
+        payloads += render_text(text, link)
+    return payloads
+
+
+def render_dynamic(d: Dynamic) -> List[Payload]:
+    t = format_time(d.timestamp)
+    text = f"{d.user}:\n{t}\n------\n{d.text}"
+    if d.type == DynamicType.FORWARD and len(d.photos) != 0 or \
+            d.type == DynamicType.PHOTO:
+        if len(d.photos) == 1:
+            if d.photos[0].endswith(".gif"):
+                return render_media(SEND_ANIMATION, text, d.link, d.photos[0])
+            return render_media(SEND_PHOTO, text, d.link, d.photos[0])
+        return render_album(text, d.link, d.photos)
+    elif d.type == DynamicType.FORWARD and len(d.photos) == 0 or \
+            d.type == DynamicType.PLAIN:
+        return render_text(text, d.link)
+    elif d.type == DynamicType.VIDEO:
+        return render_media(SEND_PHOTO, text, d.link, d.photos[0])
+    return []
+
+
+def render_live(l: Live) -> List[Payload]:
+    t = format_time(l.live_start_time)
+    text = f"{l.user} is living:\n{t}\n------\n{l.title}"
+    return render_media(SEND_PHOTO, text, room_link(l.room_id), l.cover)
+
+
+def is_text_dynamic(d: Dynamic) -> bool:
+    return d.type == DynamicType.PLAIN or d.type == DynamicType.FORWARD and len(d.photos) == 0
+
+
+def is_album_dynamic(d: Dynamic) -> bool:
+    if d.type != DynamicType.PHOTO and d.type != DynamicType.FORWARD:
+        return False
+    # a single gif is sent as an animation, it can't be put into an album
+    return len(d.photos) > 1 or len(d.photos) == 1 and not d.photos[0].endswith(".gif")
+
+
+def digest_entry(d: Dynamic) -> str:
+    t = format_time(d.timestamp)
+    return f"{d.user}:\n{t}\n{d.text}\n{d.link}"
+
+
+def join_entries(entries: List[str], limit: int) -> List[str]:
+    """
+    join entries into as few texts as possible, each of them is at most `limit` long
+    """
+    texts = []
+    current = ""
+    sep = "\n------\n"
+    for e in entries:
+        e = e[:limit]
+        if len(current) == 0:
+            current = e
+        elif len(current) + len(sep) + len(e) <= limit:
+            current = f"{current}{sep}{e}"
+        else:
+            texts.append(current)
+            current = e
+    if len(current) != 0:
+        texts.append(current)
+    return texts
+
+
+def render_digest(dyns: List[Dynamic]) -> List[Payload]:
+    """
+    merge dynamics posted in a burst
+
+    text dynamics become digest messages with a link per item, photos of
+    photo dynamics are grouped into albums, other dynamics are sent as usual
+    """
+    if len(dyns) == 1:
+        return render_dynamic(dyns[0])
+    payloads = []
+    texts = [d for d in dyns if is_text_dynamic(d)]
+    albums = [d for d in dyns if is_album_dynamic(d)]
+    others = [d for d in dyns if not is_text_dynamic(d) and not is_album_dynamic(d)]
+
+    if len(albums) == 1:
+        payloads += render_dynamic(albums[0])
+    elif len(albums) > 1:
+        chunks = album_chunks([url for d in albums for url in d.photos])
+        captions = join_entries([digest_entry(d) for d in albums], MAX_CAPTION)
+        if len(captions) == 1:
+            for chunk in chunks[:-1]:
+                payloads.append(Payload(SEND_MEDIA_GROUP, "", media=tuple(chunk)))
+            payloads.append(Payload(SEND_MEDIA_GROUP, captions[0], media=tuple(chunks[-1])))
+        else:
+            for chunk in chunks:
+                payloads.append(Payload(SEND_MEDIA_GROUP, "", media=tuple(chunk)))
+            texts = albums + texts
+
+    if len(texts) == 1:
+        payloads += render_dynamic(texts[0])
+    elif len(texts) > 1:
+        for text in join_entries([digest_entry(d) for d in texts], MAX_MESSAGE):
+            payloads.append(Payload(SEND_MESSAGE, text))
+
+    for d in others:
+        payloads += render_dynamic(d)
+    return payloads
@@ -0,0 +1,173 @@
+import asyncio
+import itertools
+import logging
+import time
+from collections import defaultdict
+from datetime import timedelta
+from typing import Awaitable, Callable, Dict, List
+
+import telegram
+
+import metrics
+from utils import TokenBucket
+
+# lower value is sent first
+PRIORITY_LIVE = 0
+PRIORITY_DYNAMIC = 1
+PRIORITY_RETRY = 2
+
+# give up a single message after hitting flood control this many times
+MAX_RETRY_AFTER = 5
+# share of telegram's limits we use, telegram counts a bit differently than our clock
+RATE_MARGIN = 0.9
+# tokens a full bucket holds, a burst plus the refill over telegram's window
+# (a second, or a minute for groups) stays under the limit
+GLOBAL_BURST = 2
+CHAT_BURST = 1
+
+
+def global_bucket(rate: float) -> TokenBucket:
+    return TokenBucket(rate * RATE_MARGIN, GLOBAL_BURST)
+
+
+def chat_bucket(chat_id: int, group_rate: float, private_rate: float) -> TokenBucket:
+    # negative chat id is a group or channel
+    rate = group_rate if chat_id < 0 else private_rate
+    return TokenBucket(rate * RATE_MARGIN, CHAT_BURST)
+
+
+def retry_after_seconds(e: telegram.error.RetryAfter) -> float:
+    # `retry_after` is an int in older ptb releases and a timedelta in newer ones
+    t = e.retry_after
+    if isinstance(t, timedelta):
+        return t.total_seconds()
+    return float(t)
+
+
+class Job:
+    def __init__(self, priority: int, seq: int, chat_id: int, send: Callable[[], Awaitable], cost: int):
+        self.priority = priority
+        self.seq = seq
+        self.chat_id = chat_id
+        self.send = send
+        self.cost = cost
+        self.retries = 0
+        self.future = asyncio.get_running_loop().create_future()
+
+    def __lt__(self, other: "Job"):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class Sender:
+    """
+    central outbound scheduler for telegram messages
+
+    all sends go through a global token bucket and a bucket per chat,
+    jobs are picked by priority and then by submit order, messages to the
+    same chat never run concurrently so they keep their order
+
+    the rates are telegram's limits, buckets refill a bit slower than them
+    and hold only a small burst, so the sends stay under them
+    """
+
+    def __init__(self, global_rate: float = 30, group_rate: float = 20 / 60, private_rate: float = 1,
+                 workers: int = 16, max_queue: int = 10000):
+        self.__global = global_bucket(global_rate)
+        self.__group_rate = group_rate
+        self.__private_rate = private_rate
+        self.__chat_buckets: Dict[int, TokenBucket] = {}
+        self.__queue: asyncio.PriorityQueue = asyncio.PriorityQueue()
+        # bounds the number of jobs which are queued or running
+        self.__slots = asyncio.Semaphore(max_queue)
+        self.__busy = set()
+        self.__waiting: Dict[int, List[Job]] = defaultdict(list)
+        self.__paused_until: Dict[int, float] = {}
+        self.__seq = itertools.count()
+        self.__worker_count = workers
+        self.__workers: List[asyncio.Task] = []
+
+    def start(self):
+        for _ in range(self.__worker_count):
+            self.__workers.append(asyncio.create_task(self.__work()))
+
+    async def stop(self):
+        for w in self.__workers:
+            w.cancel()
+        await asyncio.gather(*self.__workers, return_exceptions=True)
+        self.__workers.clear()
+
+    def qsize(self) -> int:
+        return self.__queue.qsize()
+
+    async def submit(self, chat_id: int, send: Callable[[], Awaitable], priority: int = PRIORITY_DYNAMIC,
+                     cost: int = 1) -> asyncio.Future:
+        """
+        queue `send` for `chat_id`, wait if the queue is full
+
+        `cost` is the number of telegram messages `send` produces,
+        the returned future resolves to the result of `send`
+        """
+        await self.__slots.acquire()
+        job = Job(priority, next(self.__seq), chat_id, send, cost)
+        job.future.add_done_callback(lambda _: self.__slots.release())
+        self.__queue.put_nowait(job)
+        return job.future
+
+    def __chat_bucket(self, chat_id: int) -> TokenBucket:
+        if chat_id not in self.__chat_buckets:
+            self.__chat_buckets[chat_id] = chat_bucket(chat_id, self.__group_rate, self.__private_rate)
+        return self.__chat_buckets[chat_id]
+
+    def __park(self, job: Job, t: float):
+        asyncio.get_running_loop().call_later(t, self.__queue.put_nowait, job)
+
+    def __release_chat(self, chat_id: int):
+        self.__busy.discard(chat_id)
+        for job in self.__waiting.pop(chat_id, []):
+            self.__queue.put_nowait(job)
+
+    async def __work(self):
+        while True:
+            job: Job = await self.__queue.get()
+            if job.future.done():
+                continue
+            chat_id = job.chat_id
+            if chat_id in self.__busy:
+                self.__waiting[chat_id].append(job)
+                continue
+            bucket = self.__chat_bucket(chat_id)
+            t = max(bucket.delay(job.cost), self.__paused_until.get(chat_id, 0) - time.monotonic())
+            if t > 0:
+                # this chat is out of budget, let other chats go first
+                self.__park(job, t)
+                continue
+            self.__busy.add(chat_id)
+            try:
+                await self.__global.acquire(job.cost)
+                bucket.take(job.cost)
+                await self.__run(job)
+            finally:
+                self.__release_chat(chat_id)
+
+    async def __run(self, job: Job):
+        chat = "group" if job.chat_id < 0 else "private"
+        start = time.monotonic()
+        try:
+            result = await job.send()
+        except telegram.error.RetryAfter as e:
+            metrics.TELEGRAM_THROTTLED.inc()
+            t = retry_after_seconds(e)
+            job.retries += 1
+            if job.retries > MAX_RETRY_AFTER:
+                job.future.set_exception(e)
+                return
+            logging.warning("flood control for %d, retry after %ss", job.chat_id, t, extra={"chat_id": job.chat_id})
+            self.__paused_until[job.chat_id] = time.monotonic() + t
+            self.__park(job, t)
+        except Exception as e:
+            metrics.SEND_FAILURES.inc(chat=chat)
+            job.future.set_exception(e)
+        else:
+            metrics.SEND_LATENCY.observe(time.monotonic() - start, chat=chat)
+            metrics.SENDS.inc(job.cost, chat=chat)
+            job.future.set_result(result)
@@ -0,0 +1,274 @@
+import asyncio
+import bisect
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Set
+
+from db import Database
+
+# points of every worker on the hash ring, more points split uids more evenly
+REPLICAS = 64
+# the lease of the worker receiving telegram updates, uids are leased by their str
+UPDATES = "updates"
+# pending deliveries of a worker are in the `outbox/<worker>` table of db.SqliteDatabase
+OUTBOX = "outbox/"
+
+
+def outbox_table(worker: str) -> str:
+    return f"{OUTBOX}{worker}"
+
+
+def ring_hash(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    """
+    consistent hashing, a worker joining or leaving only moves the keys
+    between it and its neighbours on the ring
+    """
+
+    def __init__(self, workers: Iterable[str], replicas: int = REPLICAS):
+        points = sorted((ring_hash(f"{w}#{i}"), w) for w in workers for i in range(replicas))
+        self.__hashes = [h for h, _ in points]
+        self.__workers = [w for _, w in points]
+
+    def owner(self, key: str) -> Optional[str]:
+        if len(self.__hashes) == 0:
+            return None
+        i = bisect.bisect(self.__hashes, ring_hash(key)) % len(self.__hashes)
+        return self.__workers[i]
+
+
+class Shard:
+    """
+    one of the workers sharing a sqlite database
+
+    workers heartbeat in the `worker` table and split uids among the live
+    ones with a hash ring, a worker polls a uid only while it holds its lease
+    in the `lease` table, leases of a dead worker expire after `lease_ttl`
+    seconds and are taken over by the next owner on the ring; the `updates`
+    lease picks the worker receiving telegram updates, and the `claim` table
+    makes sure a post is sent to a chat by one worker only
+
+    a worker gone for `lease_ttl` leaves its outbox and claims behind, the
+    worker receiving updates adopts its outbox with the claims those records
+    cover, a claim the dead worker never recorded a delivery for is taken by
+    the next worker claiming it, so every post is sent at least once
+
+    `acquire` and `release` are called with the uids this worker starts and
+    stops polling, `lead` with whether it receives telegram updates now
+    """
+
+    def __init__(self, db: Database, file: str, worker: str, uids: Iterable[int],
+                 acquire: Callable[[List[int]], Awaitable], release: Callable[[List[int]], Awaitable],
+                 lead: Callable[[bool], Awaitable], lease_ttl: float = 30, claim_ttl: float = 7 * 86400):
+        self.__db = db
+        self.__worker = worker
+        self.__uids = list(uids)
+        self.__acquire = acquire
+        self.__release = release
+        self.__lead = lead
+        self.__lease_ttl = lease_ttl
+        self.__claim_ttl = claim_ttl
+        # lease name -> when it expires
+        self.__held: Dict[str, float] = {}
+        self.__lock = threading.Lock()
+        self.__conn = sqlite3.connect(file, timeout=lease_ttl / 3, check_same_thread=False)
+        self.__conn.execute("PRAGMA journal_mode=WAL")
+        self.__conn.execute("PRAGMA synchronous=NORMAL")
+        with self.__conn:
+            self.__conn.execute("CREATE TABLE IF NOT EXISTS worker (id TEXT PRIMARY KEY, heartbeat REAL NOT NULL)")
+            self.__conn.execute(
+                "CREATE TABLE IF NOT EXISTS lease ("
+                "name TEXT PRIMARY KEY, worker TEXT NOT NULL, expires REAL NOT NULL)"
+            )
+            self.__conn.execute(
+                "CREATE TABLE IF NOT EXISTS claim ("
+                "chat_id INTEGER NOT NULL, item TEXT NOT NULL, worker TEXT NOT NULL, at REAL NOT NULL, "
+                "PRIMARY KEY (chat_id, item))"
+            )
+            self.__conn.execute("CREATE INDEX IF NOT EXISTS claim_at ON claim (at)")
+
+    @property
+    def worker(self) -> str:
+        return self.__worker
+
+    def owns(self, uid: int) -> bool:
+        return self.__held.get(str(uid), 0) > time.time()
+
+    def uids(self) -> List[int]:
+        return [uid for uid in self.__uids if self.owns(uid)]
+
+    def leading(self) -> bool:
+        return self.__held.get(UPDATES, 0) > time.time()
+
+    def __wanted(self) -> Set[str]:
+        """
+        heartbeat, then the leases this worker should hold
+        """
+        now = time.time()
+        with self.__lock, self.__conn:
+            self.__conn.execute(
+                "INSERT OR REPLACE INTO worker (id, heartbeat) VALUES (?, ?)", (self.__worker, now)
+            )
+            workers = [w for w, in self.__conn.execute(
+                "SELECT id FROM worker WHERE heartbeat > ?", (now - self.__lease_ttl,)
+            )]
+            # forget workers gone for long, and what's delivered long ago
+            self.__conn.execute("DELETE FROM worker WHERE heartbeat < ?", (now - self.__claim_ttl,))
+            self.__conn.execute("DELETE FROM claim WHERE at < ?", (now - self.__claim_ttl,))
+        ring = HashRing(workers)
+        names = [str(uid) for uid in self.__uids] + [UPDATES]
+        return {name for name in names if ring.owner(name) == self.__worker}
+
+    def __lease(self, names: Set[str]) -> Dict[str, float]:
+        """
+        take or renew leases of `names` unless another worker holds them, returns what's held
+        """
+        now = time.time()
+        expires = now + self.__lease_ttl
+        with self.__lock, self.__conn:
+            self.__conn.executemany(
+                "INSERT INTO lease (name, worker, expires) VALUES (?, ?, ?) "
+                "ON CONFLICT (name) DO UPDATE SET worker = excluded.worker, expires = excluded.expires "
+                "WHERE lease.worker = excluded.worker OR lease.expires < ?",
+                [(name, self.__worker, expires, now) for name in names]
+            )
+            held = self.__conn.execute(
+                "SELECT name, expires FROM lease WHERE worker = ? AND expires > ?", (self.__worker, now)
+            ).fetchall()
+        return {name: t for name, t in held if name in names}
+
+    def __drop(self, names: Iterable[str]):
+        with self.__lock, self.__conn:
+            self.__conn.executemany(
+                "DELETE FROM lease WHERE name = ? AND worker = ?", [(name, self.__worker) for name in names]
+            )
+
+    def __claim(self, chats: List[int], item: str) -> List[int]:
+        now = time.time()
+        claimed = []
+        with self.__lock, self.__conn:
+            for chat_id in chats:
+                # a dead worker may have claimed it without recording the delivery in its outbox
+                cur = self.__conn.execute(
+                    "INSERT INTO claim (chat_id, item, worker, at) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT (chat_id, item) DO UPDATE SET worker = excluded.worker, at = excluded.at "
+                    "WHERE claim.worker NOT IN (SELECT id FROM worker WHERE heartbeat > ?) "
+                    "AND NOT EXISTS (SELECT 1 FROM kv, json_each(kv.value, '$.claims') AS c "
+                    "WHERE kv.tbl = ? || claim.worker AND json_extract(kv.value, '$.chat_id') = claim.chat_id "
+                    "AND c.value = claim.item)",
+                    (chat_id, item, self.__worker, now, now - self.__lease_ttl, OUTBOX)
+                )
+                if cur.rowcount == 1:
+                    claimed.append(chat_id)
+        return claimed
+
+    async def claim(self, chats: Iterable[int], item: str) -> List[int]:
+        """
+        chats `item` is not sent to by any worker yet, this worker sends it to them
+        """
+        chats = list(chats)
+        if len(chats) == 0:
+            return []
+        return await asyncio.to_thread(self.__claim, chats, item)
+
+    def __adopt(self) -> int:
+        """
+        move outboxes of dead workers into this one's with the claims they cover,
+        returns the number of adopted deliveries
+        """
+        now = time.time()
+        mine = outbox_table(self.__worker)
+        adopted = 0
+        with self.__lock, self.__conn:
+            alive = {w for w, in self.__conn.execute(
+                "SELECT id FROM worker WHERE heartbeat > ?", (now - self.__lease_ttl,)
+            )}
+            tables = [t for t, in self.__conn.execute("SELECT DISTINCT tbl FROM kv WHERE tbl GLOB ?", (OUTBOX + "*",))]
+            for table in tables:
+                worker = table[len(OUTBOX):]
+                if worker in alive or worker == self.__worker:
+                    continue
+                covered = []
+                for value, in self.__conn.execute("SELECT value FROM kv WHERE tbl = ?", (table,)):
+                    record = json.loads(value)
+                    covered += [(self.__worker, record["chat_id"], item, worker) for item in record.get("claims", [])]
+                self.__conn.executemany(
+                    "UPDATE claim SET worker = ? WHERE chat_id = ? AND item = ? AND worker = ?", covered
+                )
+                cur = self.__conn.execute("UPDATE OR REPLACE kv SET tbl = ? WHERE tbl = ?", (mine, table))
+                logging.info("worker %s adopts %d deliveries of %s", self.__worker, cur.rowcount, worker,
+                             extra={"stage": "shard", "deliveries": cur.rowcount})
+                adopted += cur.rowcount
+        return adopted
+
+    async def __changed(self, acquired: Set[str], released: Set[str]):
+        if UPDATES in released:
+            await self.__lead(False)
+        uids = sorted(int(name) for name in released if name != UPDATES)
+        if len(uids) != 0:
+            logging.info("worker %s releases %d uids", self.__worker, len(uids),
+                         extra={"stage": "shard", "uids": len(uids)})
+            await self.__release(uids)
+        uids = sorted(int(name) for name in acquired if name != UPDATES)
+        if len(uids) != 0:
+            logging.info("worker %s acquires %d uids", self.__worker, len(uids),
+                         extra={"stage": "shard", "uids": len(uids)})
+            await self.__acquire(uids)
+        if UPDATES in acquired:
+            await self.__lead(True)
+
+    async def rebalance(self):
+        wanted = await asyncio.to_thread(self.__wanted)
+        dropped = set(self.__held) - wanted
+        if len(dropped) != 0:
+            for name in dropped:
+                del self.__held[name]
+            await self.__changed(set(), dropped)
+            # what's moving to other workers is written out before they can take it
+            await asyncio.to_thread(self.__db.flush)
+            await asyncio.to_thread(self.__drop, dropped)
+        now = time.time()
+        old = set(self.__held)
+        valid = {name for name, t in self.__held.items() if t > now}
+        self.__held = await asyncio.to_thread(self.__lease, wanted)
+        # subscriptions changed by other workers, and state left by the last owners of new leases
+        await asyncio.to_thread(self.__db.refresh)
+        if self.leading() and await asyncio.to_thread(self.__adopt) != 0:
+            # the outbox picks them up on its next retry
+            await asyncio.to_thread(self.__db.refresh, (self.__db.outbox_table,))
+        # an expired lease may be taken by another worker in the meantime
+        await self.__changed(set(self.__held) - valid, old - set(self.__held))
+
+    async def run(self, stop: asyncio.Event):
+        while not stop.is_set():
+            try:
+                await self.rebalance()
+            except sqlite3.Error as e:
+                # leases expire by themselves if this keeps failing
+                logging.error(f"rebalance worker {self.__worker}: {e}")
+            try:
+                await asyncio.wait_for(stop.wait(), self.__lease_ttl / 3)
+            except asyncio.TimeoutError:
+                pass
+
+    async def close(self):
+        """
+        give up all leases so other workers take over right away
+        """
+        names = list(self.__held)
+        self.__held = {}
+        await asyncio.to_thread(self.__db.flush)
+        try:
+            await asyncio.to_thread(self.__drop, names)
+            with self.__lock, self.__conn:
+                self.__conn.execute("DELETE FROM worker WHERE id = ?", (self.__worker,))
+        except sqlite3.Error as e:
+            logging.error(f"release leases of worker {self.__worker}: {e}")
+        self.__conn.close()
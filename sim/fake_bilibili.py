@@ -0,0 +1,248 @@
+"""
+a stand-in for the bilibili apis the bot polls
+
+every uid posts dynamics and goes live on a random schedule, everything
+that happens is recorded so the harness can tell what should be delivered
+"""
+import heapq
+import itertools
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+from utils import TokenBucket
+
+PAGE_SIZE = 12
+# live_status of bilibili
+LIVE = 1
+PREPARE = 2
+
+# generated dynamic types: forward, photo, plain and video
+DYNAMIC_TYPES = [1, 2, 4, 8]
+
+
+def room_of(uid: int) -> int:
+    return uid + 10_000_000
+
+
+def make_card(uid: int, name: str, t: int, dynamic_id: int, now: int, pictures: int) -> dict:
+    text = f"dynamic {dynamic_id} of {uid}"
+    pictures = [{"img_src": f"https://i0.hdslb.com/bfs/album/{dynamic_id}_{i}.jpg"} for i in range(pictures)]
+    if t == 2:
+        card = {"item": {"description": text, "pictures": pictures, "upload_time": now}, "user": {"name": name}}
+    elif t == 4:
+        card = {"item": {"content": text, "timestamp": now}, "user": {"uname": name}}
+    elif t == 8:
+        card = {"title": text, "owner": {"name": name}, "aid": dynamic_id,
+                "pic": f"https://i0.hdslb.com/bfs/archive/{dynamic_id}.jpg", "pubdate": now, "ctime": now}
+    else:
+        origin = {"item": {"content": f"origin of {dynamic_id}", "timestamp": now}, "user": {"uname": "someone"}}
+        card = {"item": {"content": text, "orig_type": 4, "orig_dy_id": dynamic_id - 1, "timestamp": now},
+                "user": {"uname": name}, "origin": json.dumps(origin)}
+    return {"desc": {"uid": uid, "type": t, "dynamic_id": dynamic_id, "timestamp": now}, "card": json.dumps(card)}
+
+
+class UidState:
+    def __init__(self, uid: int):
+        self.uid = uid
+        self.name = f"user{uid}"
+        # newest first
+        self.cards: List[dict] = []
+        self.live_status = PREPARE
+        self.live_time = 0
+        self.title = f"live of {uid}"
+        # when the first page is requested for the first time, posts before that are not expected
+        self.first_seen: Optional[float] = None
+
+
+class FakeBilibili:
+    """
+    `post_interval` and `live_interval` are the mean seconds between posts and
+    lives of a uid, a live lasts `live_duration` seconds on average,
+    with `rate` more than that many requests per second are throttled
+    """
+
+    def __init__(self, uids: List[int], post_interval: float = 120, live_interval: float = 600,
+                 live_duration: float = 120, rate: float = None, seed: int = 0):
+        self.__uids = {uid: UidState(uid) for uid in uids}
+        self.__post_interval = post_interval
+        self.__live_interval = live_interval
+        self.__live_duration = live_duration
+        self.__random = random.Random(seed)
+        self.__ids = itertools.count(700_000_000_000_000_000)
+        self.__lock = threading.Lock()
+        self.__bucket = TokenBucket(rate, rate) if rate is not None else None
+        self.__stop = threading.Event()
+        self.__server: Optional[ThreadingHTTPServer] = None
+        # (time, uid, kind)
+        self.__schedule: List[Tuple[float, int, str]] = []
+        self.events: List[dict] = []
+        self.requests: Dict[str, int] = {}
+        self.throttled = 0
+
+    @property
+    def url(self) -> str:
+        host, port = self.__server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self, host: str = "127.0.0.1", port: int = 0):
+        now = time.time()
+        for state in self.__uids.values():
+            # history before the bot starts, the bot only remembers where it is on the first fetch
+            self.__post(state, now - self.__random.uniform(0, self.__post_interval), schedule=False)
+        for uid in self.__uids:
+            heapq.heappush(self.__schedule, (now + self.__random.expovariate(1 / self.__post_interval), uid, "post"))
+            heapq.heappush(self.__schedule, (now + self.__random.expovariate(1 / self.__live_interval), uid, "live"))
+        self.__server = ThreadingHTTPServer((host, port), self.__handler())
+        self.__server.daemon_threads = True
+        threading.Thread(target=self.__server.serve_forever, daemon=True).start()
+        threading.Thread(target=self.__tick, daemon=True).start()
+
+    def stop(self):
+        self.__stop.set()
+        self.__server.shutdown()
+
+    def __tick(self):
+        while not self.__stop.wait(0.05):
+            now = time.time()
+            with self.__lock:
+                while len(self.__schedule) != 0 and self.__schedule[0][0] <= now:
+                    _, uid, kind = heapq.heappop(self.__schedule)
+                    if kind == "post":
+                        self.__post(self.__uids[uid], now)
+                    else:
+                        self.__live(self.__uids[uid], now)
+
+    def __post(self, state: UidState, now: float, schedule: bool = True):
+        dynamic_id = next(self.__ids)
+        t = self.__random.choice(DYNAMIC_TYPES)
+        state.cards.insert(0, make_card(state.uid, state.name, t, dynamic_id, int(now), self.__random.randint(1, 4)))
+        self.events.append({"kind": "dynamic", "uid": state.uid, "id": dynamic_id, "time": now,
+                            "expected": state.first_seen is not None})
+        if schedule:
+            heapq.heappush(self.__schedule,
+                           (now + self.__random.expovariate(1 / self.__post_interval), state.uid, "post"))
+
+    def __live(self, state: UidState, now: float):
+        if state.live_status == LIVE:
+            state.live_status = PREPARE
+            t = now + self.__random.expovariate(1 / self.__live_interval)
+        else:
+            state.live_status = LIVE
+            state.live_time = int(now)
+            self.events.append({"kind": "live", "uid": state.uid, "id": room_of(state.uid), "time": now,
+                                "expected": True})
+            t = now + self.__random.expovariate(1 / self.__live_duration)
+        heapq.heappush(self.__schedule, (t, state.uid, "live"))
+
+    def throttle(self) -> bool:
+        if self.__bucket is None:
+            return False
+        with self.__lock:
+            if self.__bucket.delay() > 0:
+                self.throttled += 1
+                return True
+            self.__bucket.take()
+            return False
+
+    def count(self, endpoint: str):
+        with self.__lock:
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+
+    def space_history(self, payload: dict) -> dict:
+        uid = int(payload["host_uid"])
+        offset = int(payload.get("offset_dynamic_id", 0))
+        with self.__lock:
+            state = self.__uids.get(uid)
+            if state is None:
+                return {"code": 0, "data": {"has_more": 0, "cards": [], "next_offset": 0}}
+            if offset == 0 and state.first_seen is None:
+                state.first_seen = time.time()
+            cards = [c for c in state.cards if offset == 0 or c["desc"]["dynamic_id"] < offset][:PAGE_SIZE]
+            more = len(cards) == PAGE_SIZE
+        next_offset = cards[-1]["desc"]["dynamic_id"] if len(cards) != 0 else 0
+        return {"code": 0, "data": {"has_more": int(more), "cards": cards, "next_offset": next_offset}}
+
+    def status_info(self, uids: List[int]) -> dict:
+        data = {}
+        with self.__lock:
+            for uid in uids:
+                state = self.__uids.get(uid)
+                if state is None:
+                    continue
+                data[str(uid)] = {
+                    "title": state.title, "room_id": room_of(uid), "uid": uid, "live_time": state.live_time,
+                    "live_status": state.live_status, "uname": state.name, "cover_from_user": "",
+                    "keyframe": f"https://i0.hdslb.com/bfs/live-key-frame/{uid}.jpg",
+                }
+        return {"code": 0, "msg": "success", "data": data}
+
+    def room_info(self, room_id: int) -> Optional[dict]:
+        state = self.__uids.get(room_id - 10_000_000)
+        if state is None:
+            return None
+        with self.__lock:
+            return {"code": 0, "data": {
+                "room_info": {"uid": state.uid, "room_id": room_id, "title": state.title,
+                              "cover": f"https://i0.hdslb.com/bfs/live/{state.uid}.jpg",
+                              "keyframe": "", "live_status": state.live_status, "live_start_time": state.live_time},
+                "anchor_info": {"base_info": {"uname": state.name}},
+            }}
+
+    def __handler(self):
+        bilibili = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def reply(self, data: dict, status: int = 200):
+                body = json.dumps(data).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def route(self, payload: Optional[dict]):
+                url = urlparse(self.path)
+                endpoint = url.path.rsplit("/", 1)[-1]
+                if re.fullmatch(r"/bili/living_v2/\d+", url.path):
+                    endpoint = "living_v2"
+                bilibili.count(endpoint)
+                if bilibili.throttle():
+                    self.reply({"code": -412, "message": "请求被拦截"}, 412)
+                    return
+                query = parse_qs(url.query)
+                if endpoint == "space_history":
+                    self.reply(bilibili.space_history(payload or {}))
+                elif endpoint == "living_v2":
+                    uid = int(url.path.rsplit("/", 1)[-1])
+                    self.reply({"code": 0, "data": {"url": f"https://live.bilibili.com/{room_of(uid)}"}})
+                elif endpoint == "getInfoByRoom":
+                    data = bilibili.room_info(int(query["room_id"][0]))
+                    self.reply(data if data is not None else {"code": 1, "message": "no room"})
+                elif endpoint == "get_status_info_by_uids":
+                    self.reply(bilibili.status_info([int(uid) for uid in (payload or {}).get("uids", [])]))
+                elif endpoint == "getDanmuInfo":
+                    # no live message stream here, the bot falls back to polling
+                    self.reply({"code": 1, "message": "not supported"})
+                else:
+                    self.reply({"code": -404, "message": "not found"}, 404)
+
+            def do_GET(self):
+                self.route(None)
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                body = self.rfile.read(length)
+                self.route(json.loads(body) if body else {})
+
+        return Handler
@@ -0,0 +1,89 @@
+"""
+a stand-in for the bilibili live message websocket
+
+it speaks the packet protocol of bilibili.live_ws: auth, heartbeats and
+zlib compressed room messages, messages are pushed and connections
+dropped by the caller
+"""
+import json
+import struct
+import zlib
+from typing import List, Optional, Set
+
+import websockets
+from websockets.asyncio.server import Server, ServerConnection, serve
+
+from bilibili.live_ws import (OP_AUTH, OP_AUTH_REPLY, OP_HEARTBEAT, OP_HEARTBEAT_REPLY, OP_MESSAGE,
+                              PROTO_INT, PROTO_JSON, PROTO_ZLIB, pack, unpack)
+
+
+class FakeLive:
+    """
+    rooms are authed with `token`, an auth with a wrong token is rejected
+    with a non-zero code like bilibili does
+    """
+
+    def __init__(self, token: str):
+        self.__token = token
+        self.__server: Optional[Server] = None
+        # authed connections and their rooms
+        self.__rooms = {}
+        # the body of every auth
+        self.auths: List[dict] = []
+        self.heartbeats = 0
+        self.connections = 0
+
+    @property
+    def url(self) -> str:
+        host, port = list(self.__server.sockets)[0].getsockname()[:2]
+        return f"ws://{host}:{port}/sub"
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0):
+        self.__server = await serve(self.__serve, host, port)
+
+    async def stop(self):
+        self.__server.close()
+        await self.__server.wait_closed()
+
+    def authed(self) -> Set[int]:
+        return set(self.__rooms.values())
+
+    async def __serve(self, ws: ServerConnection):
+        self.connections += 1
+        try:
+            async for data in ws:
+                for op, body in unpack(data):
+                    if op == OP_AUTH:
+                        auth = json.loads(body)
+                        self.auths.append(auth)
+                        code = 0 if auth.get("key") == self.__token else -101
+                        await ws.send(pack(OP_AUTH_REPLY, json.dumps({"code": code}).encode(), PROTO_JSON))
+                        if code != 0:
+                            return
+                        self.__rooms[ws] = auth["roomid"]
+                    elif op == OP_HEARTBEAT:
+                        self.heartbeats += 1
+                        # the popularity of the room
+                        await ws.send(pack(OP_HEARTBEAT_REPLY, struct.pack(">I", 1), PROTO_INT))
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            self.__rooms.pop(ws, None)
+
+    async def push(self, room_id: int, *messages: dict):
+        """
+        send `messages` to `room_id` zlib compressed in one packet
+        """
+        inner = b"".join(pack(OP_MESSAGE, json.dumps(m).encode(), PROTO_JSON) for m in messages)
+        data = pack(OP_MESSAGE, zlib.compress(inner), PROTO_ZLIB)
+        for ws, room in list(self.__rooms.items()):
+            if room == room_id:
+                await ws.send(data)
+
+    async def drop(self, room_id: int):
+        """
+        close connections of `room_id` like a server restart
+        """
+        for ws, room in list(self.__rooms.items()):
+            if room == room_id:
+                await ws.close(1012)
@@ -0,0 +1,205 @@
+"""
+a stand-in for the telegram bot api
+
+it answers the methods the bot uses, enforces telegram's flood limits with
+429 responses and records every delivered message
+"""
+import itertools
+import json
+import re
+import threading
+import time
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Set, Tuple
+from urllib.parse import parse_qs
+
+from utils import TokenBucket
+
+# links of dynamics and live rooms in a message tell what's delivered
+DYNAMIC_LINK = re.compile(r"t\.bilibili\.com/(\d+)|bilibili\.com/video/av(\d+)")
+ROOM_LINK = re.compile(r"live\.bilibili\.com/(\d+)")
+
+SEND_METHODS = {"sendMessage", "sendPhoto", "sendAnimation", "sendMediaGroup"}
+
+
+def parse_form(content_type: str, body: bytes) -> Tuple[Dict[str, object], Set[str]]:
+    """
+    parameters of a bot api request, values are json encoded, and names of uploaded files
+    """
+    files = set()
+    if content_type.startswith("multipart/form-data"):
+        msg = BytesParser(policy=HTTP).parsebytes(f"Content-Type: {content_type}\r\n\r\n".encode() + body)
+        raw = {}
+        for part in msg.iter_parts():
+            name = part.get_param("name", header="content-disposition")
+            if part.get_filename() is not None:
+                files.add(name)
+                continue
+            raw[name] = part.get_content()
+    elif content_type.startswith("application/json"):
+        return (json.loads(body) if body else {}), files
+    else:
+        raw = {k: v[0] for k, v in parse_qs(body.decode()).items()}
+    params = {}
+    for k, v in raw.items():
+        try:
+            params[k] = json.loads(v)
+        except ValueError:
+            params[k] = v
+    return params, files
+
+
+def missing_media(method: str, params: dict, files: Set[str]) -> Optional[str]:
+    """
+    why telegram would reject the media of a send, None if it's fine
+    """
+    if method == "sendMediaGroup":
+        items = params.get("media", [])
+    elif method == "sendPhoto":
+        items = [{"media": params.get("photo")}]
+    elif method == "sendAnimation":
+        items = [{"media": params.get("animation")}]
+    else:
+        return None
+    for i, item in enumerate(items):
+        media = item.get("media")
+        if media is None:
+            # an uploaded file of sendPhoto and sendAnimation goes in a part of its own name
+            if method != "sendMediaGroup" and len(files) != 0:
+                continue
+            return f"Bad Request: there is no media in the request parameter #{i}"
+        if isinstance(media, str) and media.startswith("attach://") and media[len("attach://"):] not in files:
+            return f"Bad Request: can't find attached file of media #{i}"
+    return None
+
+
+class FakeTelegram:
+    """
+    `global_rate` messages per second for all chats, `private_rate` per second
+    for a private chat and `group_rate` per minute for a group, like telegram
+    """
+
+    def __init__(self, global_rate: float = 30, private_rate: float = 1, group_rate: float = 20,
+                 retry_after: int = 5):
+        self.__global = TokenBucket(global_rate, global_rate)
+        self.__private_rate = private_rate
+        self.__group_rate = group_rate / 60
+        self.__retry_after = retry_after
+        self.__chats: Dict[int, TokenBucket] = {}
+        self.__lock = threading.Lock()
+        self.__message_ids = itertools.count(1)
+        self.__server: Optional[ThreadingHTTPServer] = None
+        # {"time", "chat_id", "method", "text", "dynamics", "rooms"}
+        self.deliveries: List[dict] = []
+        self.flood_control = 0
+        # descriptions of sends rejected for their media
+        self.rejected: List[str] = []
+        self.calls: Dict[str, int] = {}
+
+    @property
+    def url(self) -> str:
+        host, port = self.__server.server_address[:2]
+        return f"http://{host}:{port}/bot"
+
+    def start(self, host: str = "127.0.0.1", port: int = 0):
+        self.__server = ThreadingHTTPServer((host, port), self.__handler())
+        self.__server.daemon_threads = True
+        threading.Thread(target=self.__server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.__server.shutdown()
+
+    def __chat_bucket(self, chat_id: int) -> TokenBucket:
+        if chat_id not in self.__chats:
+            if chat_id < 0:
+                self.__chats[chat_id] = TokenBucket(self.__group_rate, self.__group_rate * 60)
+            else:
+                self.__chats[chat_id] = TokenBucket(self.__private_rate, self.__private_rate)
+        return self.__chats[chat_id]
+
+    def __allow(self, chat_id: int, cost: int) -> bool:
+        with self.__lock:
+            bucket = self.__chat_bucket(chat_id)
+            if self.__global.delay(cost) > 0 or bucket.delay(cost) > 0:
+                self.flood_control += 1
+                return False
+            self.__global.take(cost)
+            bucket.take(cost)
+            return True
+
+    def __message(self, chat_id: int, params: dict, photo: bool = False) -> dict:
+        msg = {
+            "message_id": next(self.__message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "group" if chat_id < 0 else "private"},
+        }
+        if photo:
+            file_id = f"file_{msg['message_id']}"
+            msg["photo"] = [{"file_id": file_id, "file_unique_id": file_id, "width": 1280, "height": 720}]
+        if "text" in params:
+            msg["text"] = params["text"]
+        return msg
+
+    def call(self, method: str, params: dict, files: Set[str] = frozenset()) -> dict:
+        with self.__lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+        if method == "getMe":
+            return {"ok": True, "result": {"id": 1, "is_bot": True, "first_name": "sim", "username": "simbot"}}
+        if method in ("deleteWebhook", "setWebhook", "setMyCommands"):
+            return {"ok": True, "result": True}
+        if method == "getUpdates":
+            # long polling with nothing to tell
+            time.sleep(min(float(params.get("timeout", 0)), 1))
+            return {"ok": True, "result": []}
+        if method not in SEND_METHODS:
+            return {"ok": False, "error_code": 404, "description": f"Not Found: method {method} not found"}
+        error = missing_media(method, params, files)
+        if error is not None:
+            with self.__lock:
+                self.rejected.append(error)
+            return {"ok": False, "error_code": 400, "description": error}
+        chat_id = int(params["chat_id"])
+        media = params.get("media", [])
+        cost = len(media) if method == "sendMediaGroup" else 1
+        if not self.__allow(chat_id, cost):
+            return {"ok": False, "error_code": 429, "description": f"Too Many Requests: retry after {self.__retry_after}",
+                    "parameters": {"retry_after": self.__retry_after}}
+        text = json.dumps(params, ensure_ascii=False)
+        dynamics = {int(a or b) for a, b in DYNAMIC_LINK.findall(text)}
+        rooms = {int(r) for r in ROOM_LINK.findall(text)}
+        with self.__lock:
+            self.deliveries.append({"time": time.time(), "chat_id": chat_id, "method": method,
+                                    "text": params.get("text", params.get("caption")),
+                                    "dynamics": sorted(dynamics), "rooms": sorted(rooms)})
+        if method == "sendMediaGroup":
+            return {"ok": True, "result": [self.__message(chat_id, {}, photo=True) for _ in media]}
+        return {"ok": True, "result": self.__message(chat_id, params, photo=method != "sendMessage")}
+
+    def __handler(self):
+        telegram = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def handle_request(self):
+                # /bot<token>/<method>
+                method = self.path.split("?")[0].rsplit("/", 1)[-1]
+                length = int(self.headers.get("Content-Length", 0))
+                params, files = parse_form(self.headers.get("Content-Type", ""), self.rfile.read(length))
+                result = telegram.call(method, params, files)
+                body = json.dumps(result).encode()
+                self.send_response(200 if result["ok"] else result["error_code"])
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            do_GET = handle_request
+            do_POST = handle_request
+
+        return Handler
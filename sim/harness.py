@@ -0,0 +1,218 @@
+"""
+end-to-end load simulation, runs the real bot against local stand-ins of
+bilibili and the telegram bot api and reports what's delivered
+
+    python -m sim.harness --uids 2000 --chats 200 --duration 300 --output sim.json
+
+the bot runs in a subprocess with a generated config in a temporary
+directory, extra config lines can be passed with --set, e.g.
+--set "COALESCE_WINDOW = 5", with --workers it runs as that many workers
+sharing a sqlite database
+"""
+import argparse
+import json
+import os
+import random
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from typing import Dict, List, Set, Tuple
+
+from db import open_database
+from sim.fake_bilibili import FakeBilibili
+from sim.fake_telegram import FakeTelegram
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# config.py of the work directory goes before the one of the repo
+BOOT = "import runpy, sys; sys.path[:0] = sys.argv[1:3]; runpy.run_path(sys.argv[3], run_name='__main__')"
+
+
+def percentile(values: List[float], p: float) -> float:
+    if len(values) == 0:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def db_file(path: str, workers: int) -> str:
+    return os.path.join(path, "data.json" if workers == 0 else "data.db")
+
+
+def write_config(path: str, bilibili: FakeBilibili, telegram: FakeTelegram, uids: List[int], workers: int,
+                 extra: List[str]):
+    with open(os.path.join(ROOT, "config.example")) as f:
+        config = f.read()
+    if workers == 0:
+        shard = ["SHARD_WORKER = None", 'DB_BACKEND = "json"']
+        name = ""
+    else:
+        shard = ["import os", 'SHARD_WORKER = os.environ["SHARD_WORKER"]', 'DB_BACKEND = "sqlite"']
+        # every worker has its own files but the database
+        name = "-{SHARD_WORKER}"
+    overrides = shard + [
+        'TOKEN = "1:sim"',
+        'BOT_NAME = "simbot"',
+        f"UID_LIST = {uids}",
+        f'LOG_FILE = f"{path}/bot{name}.log"',
+        f"DB_FILE = {db_file(path, workers)!r}",
+        f'MEDIA_CACHE_FILE = f"{path}/media{name}.json"',
+        "MEDIA_DIR = None",
+        f'DEBUG_DIR = f"{path}/debug{name}"',
+        "WEBHOOK_URL = None",
+        "LIVE_STREAM = False",
+        f"BILIBILI_VC_API = {bilibili.url!r}",
+        f"BILIBILI_LIVE_API = {bilibili.url!r}",
+        f"TELEGRAM_API_URL = {telegram.url!r}",
+    ]
+    with open(os.path.join(path, "config.py"), "w") as f:
+        f.write(config + "\n# simulation\n" + "\n".join(overrides + extra) + "\n")
+
+
+def subscribe(path: str, workers: int, uids: List[int], chats: int, per_chat: int, groups: float,
+              seed: int) -> Dict[int, Set[int]]:
+    """
+    random subscriptions written straight into the bot's database, returns uid -> chats
+    """
+    rnd = random.Random(seed)
+    db = open_database("json" if workers == 0 else "sqlite", db_file(path, workers), flush_interval=0.1)
+    subscribers = defaultdict(set)
+    for i in range(1, chats + 1):
+        chat_id = -i if rnd.random() < groups else i
+        followed = rnd.sample(uids, min(per_chat, len(uids)))
+        db.add_subscribe(chat_id, followed)
+        for uid in followed:
+            subscribers[uid].add(chat_id)
+    db.close()
+    return subscribers
+
+
+def analyze(events: List[dict], deliveries: List[dict], subscribers: Dict[int, Set[int]],
+            started: float, until: float) -> dict:
+    """
+    events between `started` and `until` should be delivered to every subscriber once,
+    every delivery mentions the link of a dynamic or a live room in exactly one message
+    """
+    delivered: Dict[Tuple[int, str, int], List[float]] = defaultdict(list)
+    for d in deliveries:
+        for dynamic_id in d["dynamics"]:
+            delivered[(d["chat_id"], "dynamic", dynamic_id)].append(d["time"])
+        for room_id in d["rooms"]:
+            delivered[(d["chat_id"], "live", room_id)].append(d["time"])
+    # a live room is the same for every live, a live owns the deliveries until the next one
+    ends = {}
+    next_start = {}
+    for e in sorted(events, key=lambda e: e["time"], reverse=True):
+        if e["kind"] == "live":
+            ends[id(e)] = next_start.get(e["id"], float("inf"))
+            next_start[e["id"]] = e["time"]
+
+    report = {}
+    for kind in ("dynamic", "live"):
+        lags = []
+        expected = missed = duplicated = 0
+        for e in events:
+            if e["kind"] != kind or not e["expected"] or not started <= e["time"] <= until:
+                continue
+            end = ends.get(id(e), float("inf"))
+            for chat_id in subscribers.get(e["uid"], ()):
+                expected += 1
+                times = [t for t in delivered.get((chat_id, kind, e["id"]), []) if e["time"] <= t < end]
+                if len(times) == 0:
+                    missed += 1
+                    continue
+                lags.append(min(times) - e["time"])
+                if len(times) > 1:
+                    duplicated += 1
+        report[kind] = {
+            "expected": expected,
+            "delivered": expected - missed,
+            "missed": missed,
+            "duplicated": duplicated,
+            "lag_p50_s": round(percentile(lags, 0.5), 2),
+            "lag_p99_s": round(percentile(lags, 0.99), 2),
+            "lag_max_s": round(max(lags), 2) if len(lags) != 0 else 0,
+        }
+    return report
+
+
+def run(args) -> dict:
+    uids = list(range(1, args.uids + 1))
+    bilibili = FakeBilibili(uids, post_interval=args.post_interval, live_interval=args.live_interval,
+                            live_duration=args.live_duration, rate=args.bilibili_rate, seed=args.seed)
+    telegram = FakeTelegram(retry_after=args.retry_after)
+    bilibili.start()
+    telegram.start()
+    path = tempfile.mkdtemp(prefix="meumy-sim-")
+    write_config(path, bilibili, telegram, uids, args.workers, args.set)
+    subscribers = subscribe(path, args.workers, uids, args.chats, args.per_chat, args.groups, args.seed)
+    print(f"work directory {path}", file=sys.stderr)
+
+    started = time.time()
+    command = [sys.executable, "-c", BOOT, path, ROOT, os.path.join(ROOT, "main.py")]
+    if args.workers == 0:
+        bots = [subprocess.Popen(command, cwd=path)]
+    else:
+        bots = [subprocess.Popen(command, cwd=path, env=dict(os.environ, SHARD_WORKER=f"w{i}"))
+                for i in range(args.workers)]
+    deadline = started + args.duration
+    for bot in bots:
+        try:
+            bot.wait(max(deadline - time.time(), 0))
+            print(f"bot exited early with {bot.returncode}", file=sys.stderr)
+        except subprocess.TimeoutExpired:
+            pass
+    # events of the last `grace` seconds may still be on their way
+    until = time.time() - args.grace
+    for bot in bots:
+        bot.send_signal(signal.SIGTERM)
+    for bot in bots:
+        try:
+            bot.wait(60)
+        except subprocess.TimeoutExpired:
+            bot.kill()
+    bilibili.stop()
+    telegram.stop()
+
+    return {
+        "args": vars(args),
+        "work_dir": path,
+        "exit_codes": [bot.returncode for bot in bots],
+        "deliveries": analyze(bilibili.events, telegram.deliveries, subscribers, started, until),
+        "bilibili": {"requests": bilibili.requests, "throttled": bilibili.throttled},
+        "telegram": {"calls": telegram.calls, "flood_control": telegram.flood_control},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--uids", type=int, default=1000)
+    parser.add_argument("--chats", type=int, default=100)
+    parser.add_argument("--per-chat", type=int, default=10, help="uids subscribed by a chat")
+    parser.add_argument("--groups", type=float, default=0.5, help="share of group chats")
+    parser.add_argument("--duration", type=float, default=120, help="unit second")
+    parser.add_argument("--grace", type=float, default=30,
+                        help="events this many seconds before the end are not counted, unit second")
+    parser.add_argument("--post-interval", type=float, default=300, help="mean seconds between posts of a uid")
+    parser.add_argument("--live-interval", type=float, default=600, help="mean seconds between lives of a uid")
+    parser.add_argument("--live-duration", type=float, default=120, help="mean seconds of a live")
+    parser.add_argument("--bilibili-rate", type=float, default=None,
+                        help="requests per second bilibili allows before throttling")
+    parser.add_argument("--retry-after", type=int, default=5, help="retry_after of telegram flood control")
+    parser.add_argument("--workers", type=int, default=0, help="run as this many workers, 0 for a single process")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--set", action="append", default=[], help="extra config line")
+    parser.add_argument("--output", help="write the report to this json file")
+    args = parser.parse_args()
+
+    report = run(args)
+    print(json.dumps(report, indent=2))
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""
+checks bilibili.live_ws.LiveStream against a local fake live message websocket
+
+    python -m sim.live_stream
+
+LIVE and PREPARING messages should reach on_event, and the stream should
+reconnect after the server drops the connection
+"""
+import asyncio
+import sys
+import time
+from typing import Callable, List, Optional, Tuple
+
+from bilibili.live_ws import LiveStream
+from bilibili.model import LiveStatus
+from sim.fake_live import FakeLive
+
+UID = 1
+ROOM_ID = 10_000_001
+TOKEN = "sim-live-token"
+
+
+class Fetcher:
+    """
+    the lookups LiveStream does with bilibili.api.Bilibili
+    """
+
+    def __init__(self, url: str):
+        self.__url = url
+
+    async def room_id(self, uid: int) -> int:
+        return ROOM_ID if uid == UID else 0
+
+    async def danmu_info(self, room_id: int) -> Optional[Tuple[str, str]]:
+        return TOKEN, self.__url
+
+
+async def wait_for(cond: Callable[[], bool], timeout: float) -> bool:
+    deadline = time.monotonic() + timeout
+    while not cond():
+        if time.monotonic() > deadline:
+            return False
+        await asyncio.sleep(0.05)
+    return True
+
+
+async def check() -> List[str]:
+    """
+    failed checks
+    """
+    failures = []
+    server = FakeLive(TOKEN)
+    await server.start()
+    events: List[Tuple[int, LiveStatus]] = []
+
+    async def on_event(uid: int, status: LiveStatus):
+        events.append((uid, status))
+
+    stream = LiveStream(Fetcher(server.url), on_event, heartbeat=0.2, max_backoff=2)
+    stop = asyncio.Event()
+    task = asyncio.create_task(stream.run([UID], stop))
+    try:
+        if not await wait_for(lambda: stream.connected(UID) and ROOM_ID in server.authed(), 5):
+            failures.append("live stream is not connected")
+            return failures
+        auth = server.auths[0]
+        if auth.get("roomid") != ROOM_ID or auth.get("protover") != 2:
+            failures.append(f"unexpected auth {auth}")
+        if not await wait_for(lambda: server.heartbeats >= 2, 5):
+            failures.append(f"got {server.heartbeats} heartbeats")
+
+        await server.push(ROOM_ID, {"cmd": "LIVE", "roomid": ROOM_ID},
+                          {"cmd": "DANMU_MSG:4:0:2:2:2:0", "info": []})
+        await server.push(ROOM_ID, {"cmd": "PREPARING", "roomid": str(ROOM_ID)})
+        await wait_for(lambda: len(events) >= 2, 5)
+        if events != [(UID, LiveStatus.LIVE), (UID, LiveStatus.PREPARE)]:
+            failures.append(f"got events {events}")
+
+        await server.drop(ROOM_ID)
+        if not await wait_for(lambda: server.connections >= 2 and ROOM_ID in server.authed(), 10):
+            failures.append("live stream is not reconnected after the connection is dropped")
+            return failures
+        if not stream.connected(UID):
+            failures.append("live stream is not marked connected after reconnecting")
+        await server.push(ROOM_ID, {"cmd": "LIVE", "roomid": ROOM_ID})
+        await wait_for(lambda: len(events) >= 3, 5)
+        if events[2:] != [(UID, LiveStatus.LIVE)]:
+            failures.append(f"got events {events[2:]} after reconnecting")
+    finally:
+        stop.set()
+        await task
+        await server.stop()
+    return failures
+
+
+def main():
+    failures = asyncio.run(check())
+    for f in failures:
+        print(f"FAIL {f}")
+    if len(failures) != 0:
+        sys.exit(1)
+    print("ok")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+"""
+checks sending pictures which are never uploaded as local copies
+
+    python -m sim.media_upload
+
+with a media store the bot downloads pictures itself and uploads them,
+an album, a photo and the album again with the file_ids telegram gave
+back are sent to the fake bot api, which rejects media it can't find
+"""
+import asyncio
+import io
+import sys
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List
+
+from telegram import Bot
+
+from media import MediaCache, MediaStore
+from render import SEND_MEDIA_GROUP, SEND_PHOTO, Payload
+from sim.fake_telegram import FakeTelegram
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+CHAT_ID = 5
+LINK = "https://t.bilibili.com/700000000000000001"
+
+
+def picture() -> bytes:
+    if Image is None:
+        # never decoded without Pillow
+        return b"\xff\xd8\xff\xe0" + bytes(1024)
+    out = io.BytesIO()
+    Image.new("RGB", (64, 48), (255, 128, 0)).save(out, "JPEG")
+    return out.getvalue()
+
+
+class Pictures:
+    """
+    a stand-in for the bilibili image servers, every path is a picture
+    """
+
+    def __init__(self):
+        self.__server = None
+        self.requests = 0
+
+    @property
+    def url(self) -> str:
+        host, port = self.__server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        data = picture()
+        pictures = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                pictures.requests += 1
+                self.send_response(200)
+                self.send_header("Content-Type", "image/jpeg")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        self.__server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.__server.daemon_threads = True
+        threading.Thread(target=self.__server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.__server.shutdown()
+
+
+async def check(telegram: FakeTelegram, pictures: Pictures) -> List[str]:
+    """
+    failed checks
+    """
+    failures = []
+    urls = tuple(f"{pictures.url}/bfs/album/1_{i}.jpg" for i in range(3))
+    store = MediaStore(tempfile.mkdtemp(prefix="meumy-media-"))
+    cache = MediaCache(store=store)
+    album = Payload(SEND_MEDIA_GROUP, f"album\n{LINK}", LINK, urls)
+    photo = Payload(SEND_PHOTO, "photo", LINK, (f"{pictures.url}/bfs/album/2_0.jpg",))
+    async with Bot("1:sim", base_url=telegram.url) as bot:
+        for name, payload in (("album", album), ("photo", photo), ("cached album", album)):
+            try:
+                await payload.send(bot, CHAT_ID, cache)
+            except Exception as e:
+                failures.append(f"send {name}: {e}")
+    await store.close()
+    if not cache.has_all(urls):
+        failures.append("file_ids of the uploaded album are not cached")
+    if pictures.requests != len(urls) + 1:
+        failures.append(f"{pictures.requests} pictures are downloaded, expected {len(urls) + 1}")
+    methods = [d["method"] for d in telegram.deliveries]
+    if methods != ["sendMediaGroup", "sendPhoto", "sendMediaGroup"]:
+        failures.append(f"delivered {methods}")
+    failures += [f"rejected: {e}" for e in telegram.rejected]
+    return failures
+
+
+def main():
+    # no flood control in the way
+    telegram = FakeTelegram(global_rate=100, private_rate=100)
+    pictures = Pictures()
+    telegram.start()
+    pictures.start()
+    try:
+        failures = asyncio.run(check(telegram, pictures))
+    finally:
+        telegram.stop()
+        pictures.stop()
+    for f in failures:
+        print(f"FAIL {f}")
+    if len(failures) != 0:
+        sys.exit(1)
+    print("ok")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+"""
+checks the webhook of the real bot with a local client posting fake updates
+
+    python -m sim.webhook
+
+an update with the secret token should reach /register and get a reply,
+one without it should be rejected with 403
+"""
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+from sim.fake_bilibili import FakeBilibili
+from sim.fake_telegram import FakeTelegram
+from sim.harness import BOOT, ROOT, write_config
+
+SECRET = "sim-webhook-secret"
+CHAT_ID = 5
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_port(port: int, timeout: float) -> bool:
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), 0.5).close()
+            return True
+        except OSError:
+            time.sleep(0.2)
+    return False
+
+
+def register_update(update_id: int) -> dict:
+    text = "/register key_invalid"
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": CHAT_ID, "type": "private", "username": "sim"},
+            "from": {"id": CHAT_ID, "is_bot": False, "first_name": "sim", "username": "sim"},
+            "text": text,
+            "entities": [{"type": "bot_command", "offset": 0, "length": len("/register")}],
+        },
+    }
+
+
+def post(url: str, update: dict, secret: str = None) -> int:
+    headers = {"Content-Type": "application/json"}
+    if secret is not None:
+        headers["X-Telegram-Bot-Api-Secret-Token"] = secret
+    req = urllib.request.Request(url, json.dumps(update).encode(), headers)
+    try:
+        with urllib.request.urlopen(req, timeout=10) as resp:
+            return resp.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def replies(telegram: FakeTelegram) -> list:
+    return [d for d in telegram.deliveries if d["chat_id"] == CHAT_ID and d["method"] == "sendMessage"]
+
+
+def check(telegram: FakeTelegram, url: str) -> list:
+    """
+    failed checks
+    """
+    failures = []
+    status = post(url, register_update(1))
+    if status != 403:
+        failures.append(f"update without the secret token got {status}, expected 403")
+    status = post(url, register_update(2), "wrong")
+    if status != 403:
+        failures.append(f"update with a wrong secret token got {status}, expected 403")
+    time.sleep(1)
+    if len(replies(telegram)) != 0:
+        failures.append("a rejected update is handled")
+    status = post(url, register_update(3), SECRET)
+    if status != 200:
+        failures.append(f"update with the secret token got {status}, expected 200")
+    deadline = time.time() + 10
+    while len(replies(telegram)) == 0 and time.time() < deadline:
+        time.sleep(0.2)
+    texts = [d["text"] for d in replies(telegram)]
+    if texts != ["please contact the bot owner to get the token"]:
+        failures.append(f"/register got replies {texts}")
+    return failures
+
+
+def main():
+    bilibili = FakeBilibili([1])
+    telegram = FakeTelegram()
+    bilibili.start()
+    telegram.start()
+    path = tempfile.mkdtemp(prefix="meumy-webhook-")
+    port = free_port()
+    url = f"http://127.0.0.1:{port}/meumy"
+    write_config(path, bilibili, telegram, [1], 0, [
+        f"WEBHOOK_URL = {url!r}",
+        'WEBHOOK_LISTEN = "127.0.0.1"',
+        f"WEBHOOK_PORT = {port}",
+        f"WEBHOOK_SECRET = {SECRET!r}",
+    ])
+    print(f"work directory {path}", file=sys.stderr)
+    bot = subprocess.Popen([sys.executable, "-c", BOOT, path, ROOT, os.path.join(ROOT, "main.py")], cwd=path)
+    try:
+        if not wait_port(port, 30):
+            failures = ["webhook server is not started"]
+        else:
+            failures = check(telegram, url)
+    finally:
+        bot.send_signal(signal.SIGTERM)
+        try:
+            bot.wait(30)
+        except subprocess.TimeoutExpired:
+            bot.kill()
+        bilibili.stop()
+        telegram.stop()
+    if telegram.calls.get("setWebhook", 0) == 0:
+        failures.append("webhook is not set")
+    for f in failures:
+        print(f"FAIL {f}")
+    if len(failures) != 0:
+        sys.exit(1)
+    print("ok")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+import asyncio
+import json
+import time
+
+import httpx
+
+from bilibili.api import Bilibili
+from bilibili.model import LiveStatus
+
+UID = 1
+ROOM_ID = 100
+ETAG = '"v1"'
+
+
+class Server:
+    """
+    answers the live apis with `status`, and 304 while the etag matches
+    """
+
+    def __init__(self, status: LiveStatus):
+        self.status = status
+        self.requests = []
+
+    def handle(self, request: httpx.Request) -> httpx.Response:
+        conditional = request.headers.get("If-None-Match") == ETAG
+        self.requests.append((request.url.path, conditional))
+        if conditional:
+            return httpx.Response(304)
+        if request.url.path.endswith("getInfoByRoom"):
+            data = {
+                "room_info": {"live_status": int(self.status), "title": "title", "cover": "cover",
+                              "keyframe": "", "live_start_time": 1},
+                "anchor_info": {"base_info": {"uname": "user"}},
+            }
+        else:
+            uids = json.loads(request.content)["uids"]
+            data = {str(uid): {"room_id": ROOM_ID + uid, "live_status": int(self.status), "uname": "user",
+                               "title": "title", "cover_from_user": "cover", "keyframe": "", "live_time": 1}
+                    for uid in uids}
+        return httpx.Response(200, json={"code": 0, "data": data}, headers={"ETag": ETAG})
+
+
+def fetcher(server: Server) -> Bilibili:
+    f = Bilibili(transport=httpx.MockTransport(server.handle))
+    f.set_rooms({UID: (ROOM_ID, time.time())})
+    return f
+
+
+def test_live_not_modified_uses_caller_status():
+    async def run():
+        server = Server(LiveStatus.PREPARE)
+        f = fetcher(server)
+        assert await f.live(UID, LiveStatus.PREPARE) is None
+        # 304 with the status the caller knows
+        assert await f.live(UID, LiveStatus.PREPARE) is None
+        # the caller saw LIVE elsewhere, the unchanged response still says PREPARE
+        live = await f.live(UID, LiveStatus.LIVE)
+        assert live is not None and live.status == LiveStatus.PREPARE
+        assert server.requests[-2:] == [("/xlive/web-room/v1/index/getInfoByRoom", True),
+                                        ("/xlive/web-room/v1/index/getInfoByRoom", False)]
+        await f.close()
+
+    asyncio.run(run())
+
+
+def test_live_batch_not_modified_uses_caller_status():
+    async def run():
+        server = Server(LiveStatus.PREPARE)
+        f = fetcher(server)
+        assert await f.live_batch({UID: LiveStatus.PREPARE, 2: LiveStatus.PREPARE}) == []
+        assert await f.live_batch({UID: LiveStatus.PREPARE, 2: LiveStatus.PREPARE}) == []
+        assert server.requests[-1][1]
+        # the caller saw LIVE elsewhere, the unchanged response still says PREPARE
+        lives = await f.live_batch({UID: LiveStatus.LIVE, 2: LiveStatus.PREPARE})
+        assert [(l.uid, l.status) for l in lives] == [(UID, LiveStatus.PREPARE)]
+        assert server.requests[-1][1]
+        await f.close()
+
+    asyncio.run(run())
+
+
+def test_live_batch_not_modified_for_other_uids():
+    async def run():
+        server = Server(LiveStatus.LIVE)
+        f = fetcher(server)
+        lives = await f.live_batch({UID: LiveStatus.PREPARE})
+        assert [l.uid for l in lives] == [UID]
+        # a 304 doesn't tell about uids which weren't in the last response
+        lives = await f.live_batch({UID: LiveStatus.LIVE, 2: LiveStatus.PREPARE})
+        assert [l.uid for l in lives] == [2]
+        assert server.requests[-2:] == [("/room/v1/Room/get_status_info_by_uids", True),
+                                        ("/room/v1/Room/get_status_info_by_uids", False)]
+        await f.close()
+
+    asyncio.run(run())
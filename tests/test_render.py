@@ -0,0 +1,101 @@
+from bilibili.model import Dynamic, DynamicType, Live, LiveStatus
+from render import (MAX_CAPTION, MAX_MESSAGE, SEND_ANIMATION, SEND_MEDIA_GROUP, SEND_MESSAGE, SEND_PHOTO,
+                    render_dynamic, render_live)
+
+LINK = "https://t.bilibili.com/1"
+PHOTO = "https://i0.hdslb.com/bfs/album/1.jpg"
+GIF = "https://i0.hdslb.com/bfs/album/1.gif"
+
+
+def dynamic(t: DynamicType, text: str, photos=()) -> Dynamic:
+    return Dynamic("user", t, text, list(photos), LINK, 0, 1)
+
+
+def check_limits(payloads):
+    for p in payloads:
+        limit = MAX_MESSAGE if p.method == SEND_MESSAGE else MAX_CAPTION
+        assert len(p.text) <= limit, f"{p.method} of {len(p.text)}"
+
+
+def text_of(payloads) -> str:
+    return "\n".join(p.text for p in payloads if p.text)
+
+
+def check_overflow(payloads, method, text):
+    check_limits(payloads)
+    assert payloads[0].method == method
+    assert payloads[0].text == ""
+    assert all(p.method == SEND_MESSAGE for p in payloads[1:])
+    assert text in text_of(payloads)
+    # the link is a button on the media and the last message
+    assert payloads[-1].link == LINK
+
+
+def test_short_captions_are_kept():
+    for t, photos, method in [
+        (DynamicType.PHOTO, [PHOTO], SEND_PHOTO),
+        (DynamicType.PHOTO, [GIF], SEND_ANIMATION),
+        (DynamicType.VIDEO, [PHOTO], SEND_PHOTO),
+        (DynamicType.FORWARD, [PHOTO], SEND_PHOTO),
+        (DynamicType.PLAIN, [], SEND_MESSAGE),
+    ]:
+        payloads = render_dynamic(dynamic(t, "hello", photos))
+        assert [p.method for p in payloads] == [method]
+        assert payloads[0].text.endswith("hello")
+
+
+def test_photo_long_caption():
+    text = "x" * 2000
+    check_overflow(render_dynamic(dynamic(DynamicType.PHOTO, text, [PHOTO])), SEND_PHOTO, text)
+
+
+def test_animation_long_caption():
+    text = "x" * 2000
+    check_overflow(render_dynamic(dynamic(DynamicType.PHOTO, text, [GIF])), SEND_ANIMATION, text)
+
+
+def test_video_long_caption():
+    text = "x" * 2000
+    check_overflow(render_dynamic(dynamic(DynamicType.VIDEO, text, [PHOTO])), SEND_PHOTO, text)
+
+
+def test_forward_long_caption():
+    text = "x" * 2000
+    check_overflow(render_dynamic(dynamic(DynamicType.FORWARD, text, [PHOTO])), SEND_PHOTO, text)
+
+
+def test_long_text_is_split():
+    text = "\n".join(f"line {i} " + "x" * 90 for i in range(100))
+    for t in (DynamicType.PLAIN, DynamicType.FORWARD):
+        payloads = render_dynamic(dynamic(t, text))
+        check_limits(payloads)
+        assert len(payloads) > 1
+        assert all(p.method == SEND_MESSAGE for p in payloads)
+        assert text in text_of(payloads)
+        assert [p.link for p in payloads] == [""] * (len(payloads) - 1) + [LINK]
+
+
+def test_long_text_without_line_breaks_is_split():
+    text = "x" * 5000
+    payloads = render_dynamic(dynamic(DynamicType.PLAIN, text))
+    check_limits(payloads)
+    assert "".join(p.text for p in payloads).endswith(text)
+
+
+def test_album_long_caption():
+    text = "x" * 5000
+    payloads = render_dynamic(dynamic(DynamicType.PHOTO, text, [PHOTO] * 3))
+    check_limits(payloads)
+    assert payloads[0].method == SEND_MEDIA_GROUP and payloads[0].text == ""
+    assert all(p.method == SEND_MESSAGE for p in payloads[1:])
+    assert len(payloads) > 2
+
+
+def test_live_long_title():
+    title = "x" * 2000
+    live = Live(1, "user", 2, title, PHOTO, LiveStatus.LIVE, 0)
+    payloads = render_live(live)
+    check_limits(payloads)
+    assert payloads[0].method == SEND_PHOTO
+    assert title in text_of(payloads)
+    assert payloads[-1].link == "https://live.bilibili.com/2"
@@ -0,0 +1,60 @@
+from types import SimpleNamespace
+
+import utils
+from sender import chat_bucket, global_bucket
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+
+def max_in_window(times, window: float) -> int:
+    most = 0
+    start = 0
+    for end, t in enumerate(times):
+        while t - times[start] >= window:
+            start += 1
+        most = max(most, end - start + 1)
+    return most
+
+
+def greedy(monkeypatch, make_bucket, duration: float, cost: int = 1, step: float = 0.001):
+    """
+    send whenever the bucket allows it, times of every message sent
+    """
+    clock = Clock()
+    monkeypatch.setattr(utils, "time", SimpleNamespace(monotonic=clock.monotonic))
+    bucket = make_bucket()
+    times = []
+    end = clock.now + duration
+    while clock.now < end:
+        while bucket.delay(cost) == 0:
+            bucket.take(cost)
+            times += [clock.now] * cost
+        clock.now += step
+    return times
+
+
+def test_global_rate_stays_under_limit(monkeypatch):
+    times = greedy(monkeypatch, lambda: global_bucket(30), 10)
+    assert max_in_window(times, 1) <= 30
+
+
+def test_group_rate_stays_under_limit(monkeypatch):
+    times = greedy(monkeypatch, lambda: chat_bucket(-1, 20 / 60, 1), 300, step=0.01)
+    assert max_in_window(times, 60) <= 20
+
+
+def test_private_rate_stays_under_limit(monkeypatch):
+    times = greedy(monkeypatch, lambda: chat_bucket(1, 20 / 60, 1), 30)
+    assert max_in_window(times, 1) <= 1
+
+
+def test_group_album_stays_under_limit(monkeypatch):
+    # a 10 pictures album is 10 messages at once, the bucket goes into debt
+    times = greedy(monkeypatch, lambda: chat_bucket(-1, 20 / 60, 1), 300, cost=10, step=0.01)
+    assert max_in_window(times, 60) <= 20
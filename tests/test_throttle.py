@@ -0,0 +1,52 @@
+import time
+
+from bilibili.throttle import BreakerState, CircuitBreaker
+
+
+def open_breaker() -> CircuitBreaker:
+    breaker = CircuitBreaker("test", backoff=0.05, max_backoff=1)
+    assert breaker.allow()
+    breaker.failure()
+    assert breaker.state == BreakerState.OPEN
+    return breaker
+
+
+def test_in_flight_success_keeps_breaker_open():
+    breaker = open_breaker()
+    # a request sent before the breaker opened
+    breaker.success()
+    assert breaker.state == BreakerState.OPEN
+    assert not breaker.allow()
+
+
+def test_in_flight_success_doesnt_close_half_open():
+    breaker = open_breaker()
+    time.sleep(0.06)
+    assert breaker.allow()
+    assert breaker.state == BreakerState.HALF_OPEN
+    breaker.success()
+    assert breaker.state == BreakerState.HALF_OPEN
+    # the probe is still out
+    assert not breaker.allow()
+    breaker.success(probe=True)
+    assert breaker.state == BreakerState.CLOSED
+
+
+def test_backoff_grows_until_probe_succeeds():
+    breaker = open_breaker()
+    breaker.success()
+    time.sleep(0.06)
+    assert breaker.allow()
+    breaker.failure()
+    # the in-flight success didn't reset the failures, the backoff of 0.05s doubled with jitter
+    assert breaker.retry_after() > 0.045
+
+
+def test_release_of_in_flight_request_keeps_probe():
+    breaker = open_breaker()
+    time.sleep(0.06)
+    assert breaker.allow()
+    breaker.release()
+    assert not breaker.allow()
+    breaker.release(probe=True)
+    assert breaker.allow()
@@ -28,3 +28,38 @@ def format_time(t: int):
     return time.strftime("%Y-%m-%d %H:%M:%S %z", t)
 
 
+class TokenBucket:
+    """
+    classic token bucket, `rate` tokens are added per second up to `capacity`
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.__tokens = capacity
+        self.__updated = time.monotonic()
+
+    def __refill(self, now: float):
+        self.__tokens = min(self.capacity, self.__tokens + (now - self.__updated) * self.rate)
+        self.__updated = now
+
+    def delay(self, cost: float = 1) -> float:
+        """
+        seconds to wait before `cost` tokens are available, 0 means ready
+        """
+        self.__refill(time.monotonic())
+        missing = min(cost, self.capacity) - self.__tokens
+        if missing <= 0:
+            return 0
+        return missing / self.rate
+
+    def take(self, cost: float = 1):
+        self.__refill(time.monotonic())
+        self.__tokens -= cost
+
+    async def acquire(self, cost: float = 1):
+        while (t := self.delay(cost)) > 0:
+            await asyncio.sleep(t)
+        self.take(cost)
+
+